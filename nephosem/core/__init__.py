@@ -3,5 +3,6 @@ from .matrix import *
 from .terms import *
 from .vocab import *
 from .graph import *
+from .neighbors import *
 
 # __all__ = []
@@ -31,7 +31,7 @@ import networkx as nx
 import xml
 from xml.dom import minidom
 
-from nephosem.specutils.deputils import match_graph, tree_match, get_depth, draw_tree, draw_match, parse_pattern
+from nephosem.specutils.deputils import match_graph, tree_match, get_depth, draw_tree, draw_match, parse_pattern, PatternMatcher, SentenceTree
 
 logger = logging.getLogger(__name__)
 
@@ -199,6 +199,15 @@ class DiGraph(object):
 
 
 class SentenceGraph(DiGraph):
+    """A sentence (dependency tree) stored in arrays, see :class:`~nephosem.specutils.deputils.SentenceTree`:
+    the node ids and attribute dicts by position, the head position of each node
+    and the successors of each node (with the edge attribute dicts) in CSR form.
+    A `networkx.DiGraph` is only built (by the `graph` property) when it is needed, i.e. for `show()`.
+
+    Attributes
+    ----------
+    tree : :class:`~nephosem.specutils.deputils.SentenceTree`
+    """
     def __init__(self, nodes=None, edges=None, sentence=None, formatter=None, mode='type', fname="", settings=None):
         """Construct a graph by a sentence and id2node.
         When the nodes and edges are provided, directly create a sentence graph based on them.
@@ -213,10 +222,11 @@ class SentenceGraph(DiGraph):
             Each string line has the same format as the `formatter` indicates.
         formatter : :class:`~nephosem.core.terms.CorpusFormatter`
         """
-        super(SentenceGraph, self).__init__()
         self.mode = mode
         self.fid = fname
         self.formatter = formatter
+        self.tree = None
+        self._graph = None
         if nodes and edges:
             self.generate_graph(nodes, edges)
         elif sentence:
@@ -224,11 +234,89 @@ class SentenceGraph(DiGraph):
         else:
             raise ValueError("Please provide a sentence!")
 
+    @property
+    def graph(self):
+        """The sentence as a `networkx.DiGraph` (built at the first access)."""
+        if self._graph is None:
+            gx = nx.DiGraph()
+            tree = self.tree
+            for v, attrs in zip(tree.ids, tree.node_attrs):
+                gx.add_node(v, **attrs)
+            for i, v in enumerate(tree.ids):
+                for k in range(tree.childptr[i], tree.childptr[i + 1]):
+                    gx.add_edge(v, tree.ids[tree.children[k]], **tree.edge_attrs[k])
+            self._graph = gx
+        return self._graph
+
+    @property
+    def nodes(self):
+        """Node view: iterating gives (node id, attribute dict) pairs, indexing by a node id gives its attribute dict."""
+        return SentenceNodeView(self.tree)
+
+    @property
+    def edges(self):
+        """Edge view: iterating gives (head id, dependent id) pairs, indexing by such a pair gives its attribute dict."""
+        return SentenceEdgeView(self.tree)
+
+    @property
+    def istree(self):
+        return self.tree.istree
+
+    def out_degree(self, v):
+        i = self.tree.pos[v]
+        return self.tree.childptr[i + 1] - self.tree.childptr[i]
+
+    def in_degree(self, v):
+        i = self.tree.pos[v]
+        return sum(1 for c in self.tree.children if c == i)
+
+    def successors(self, v):
+        tree = self.tree
+        return iter([tree.ids[c] for c in tree.successors(tree.pos[v])])
+
+    def predecessors(self, v):
+        tree = self.tree
+        i = tree.pos[v]
+        return iter([tree.ids[p] for p in range(len(tree)) if i in tree.successors(p)])
+
+    def add_node(self, v_id, **kwargs):
+        """Add a node with id and attributes (or update the attributes of an existing node) to the sentence.
+        The arrays of the tree are rebuilt, so that the node is seen by `istree`, `successors()` and the matching.
+        """
+        nodes, edges = self._attr_dicts()
+        nodes.setdefault(v_id, dict()).update(kwargs)
+        self.tree = SentenceTree.from_edges(nodes, edges)
+        self._graph = None
+
+    def add_edge(self, e_id, from_v, to_v, **kwargs):
+        """Add an edge (or update the attributes of an existing edge) to the sentence.
+        Like `add_node()`, the arrays of the tree are rebuilt.
+        """
+        nodes, edges = self._attr_dicts()
+        edges.setdefault((from_v, to_v), dict()).update(id=e_id, **kwargs)
+        self.tree = SentenceTree.from_edges(nodes, edges)
+        self._graph = None
+
+    def _attr_dicts(self):
+        """The node attribute dicts (node id -> dict) and edge attribute dicts
+        ((head id, dependent id) -> dict) of the tree, in the order of its arrays.
+        """
+        tree = self.tree
+        nodes = dict(zip(tree.ids, tree.node_attrs))
+        edges = dict()
+        for i, v in enumerate(tree.ids):
+            for k in range(tree.childptr[i], tree.childptr[i + 1]):
+                edges[(v, tree.ids[tree.children[k]])] = tree.edge_attrs[k]
+        return nodes, edges
+
     def generate_graph(self, nodes, edges):
-        for idx, vals in nodes.items():
-            self.add_node(idx, **vals)
-        for idx, (e, lb) in enumerate(edges.items()):
-            self.add_edge(idx+1, e[0], e[1], **lb)
+        """Create the sentence from node attribute dicts (node id -> dict) and edge attribute dicts
+        ((head id, dependent id) -> dict). The edges get an (1-based) `id` attribute.
+        """
+        nodes = {idx: dict(vals) for idx, vals in nodes.items()}
+        edges = {e: dict(id=idx+1, **lb) for idx, (e, lb) in enumerate(edges.items())}
+        self.tree = SentenceTree.from_edges(nodes, edges)
+        self._graph = None
 
     def build_graph(self, sentence):
         """Build a graph from raw text (of a sentence)
@@ -236,36 +324,37 @@ class SentenceGraph(DiGraph):
         Parameters
         ----------
         sentence : iterable
-            A list of strings
+            A list of (line index, string line) tuples
         """
-        nodes = defaultdict(lambda: defaultdict(str))
-        edges = defaultdict(lambda: defaultdict(str))
+        formatter = self.formatter
+        node_columns, edge_columns = formatter.node_columns, formatter.edge_columns
+        # get column names of current index and head index
+        currID = formatter.column_index(formatter.settings.get('currID', 'id'))
+        headID = formatter.column_index(formatter.settings.get('headID', 'head'))
+        nodes, edges = dict(), dict()
         for lid, line in sentence:
-            line = line.strip()
-            match = self.formatter.match_line(line)
+            match = formatter.match_line(line.strip())
             if match is None:
                 continue
-            node_attr = self.formatter.node_attr.split(',')
-            edge_attr = self.formatter.edge_attr.split(',')
-            # get column names of current index and head index
-#             currID_column = self.formatter.settings.get('currID', 'ID')
-#             headID_column = self.formatter.settings.get('headID', 'HEAD')
-            currID_column = self.formatter.settings.get('currID', 'id')
-            headID_column = self.formatter.settings.get('headID', 'head')
-            node_idx = int(self.formatter.get(match, currID_column))
-            head_idx = int(self.formatter.get(match, headID_column))
-            for col in self.formatter.global_columns:
-                val = self.formatter.get(match, col)
-                if col in node_attr:
-                    nodes[node_idx][col] = val
-                elif col in edge_attr:
-                    edges[(head_idx, node_idx)][col] = val
+            group = match.group
+            node_idx, head_idx = int(group(currID)), int(group(headID))
+            attrs = nodes.get(node_idx)
+            if attrs is None:
+                attrs = nodes[node_idx] = dict()
+            for col, gid in node_columns:
+                attrs[col] = group(gid)
             # add line index to node attributes
-            nodes[node_idx]['lid'] = lid
+            attrs['lid'] = lid
+            if edge_columns:
+                eattrs = edges.get((head_idx, node_idx))
+                if eattrs is None:
+                    eattrs = edges[(head_idx, node_idx)] = dict()
+                for col, gid in edge_columns:
+                    eattrs[col] = group(gid)
 
         self.generate_graph(nodes, edges)
 
-    def match_pattern(self, macro):
+    def match_pattern(self, macro, anchors=None):
         """Match a sentence with a feature pattern (and target pair).
         Append the results to the attribute lists `matched_nodes` and `matched_edges` of the feature object.
         A `matched node` is a dict mapping node index to type string.
@@ -278,8 +367,10 @@ class SentenceGraph(DiGraph):
         ----------
         macro : :class:`~nephosem.core.graph.MacroGraph`
             The feature pattern to be matched to the sentence.
+        anchors : iterable of int, optional
+            Positions of the sentence nodes to which the target node of the macro should be matched.
         """
-        tree_match(self, macro)
+        tree_match(self, macro, anchors=anchors)
 
     def match_target_feature(self, feature):
         """Match a graph with a path (a tree/graph object).
@@ -319,12 +410,61 @@ class SentenceGraph(DiGraph):
             output += '\ne: {e1} {e2} {rel}'.format(e1=e1, e2=e2, rel=rel)
         output += '\n'
         '''
-        nodes = [None] * self.graph.number_of_nodes()
-        for v in self.graph.nodes():
-            nodes[v] = self.graph.nodes[v].get('label', 'ROOT')
+        nodes = [None] * len(self.tree)
+        for v, attrs in self.nodes:
+            nodes[v] = attrs.get('label', 'ROOT')
         return ' '.join(nodes)
 
 
+class SentenceNodeView(object):
+    """Read-only view of the nodes of a :class:`SentenceGraph` (like a networkx node data view)."""
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __iter__(self):
+        return zip(self.tree.ids, self.tree.node_attrs)
+
+    def __len__(self):
+        return len(self.tree)
+
+    def __contains__(self, v):
+        return v in self.tree.pos
+
+    def __getitem__(self, v):
+        return self.tree.node_attrs[self.tree.pos[v]]
+
+
+class SentenceEdgeView(object):
+    """Read-only view of the edges of a :class:`SentenceGraph` (like a networkx edge view)."""
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __iter__(self):
+        tree = self.tree
+        for i, v in enumerate(tree.ids):
+            for c in tree.successors(i):
+                yield v, tree.ids[c]
+
+    def __len__(self):
+        return len(self.tree.children)
+
+    def __contains__(self, e):
+        return self._index(e) >= 0
+
+    def _index(self, e):
+        u, v = e
+        pos = self.tree.pos
+        if u not in pos or v not in pos:
+            return -1
+        return self.tree.edge(pos[u], pos[v])
+
+    def __getitem__(self, e):
+        k = self._index(e)
+        if k < 0:
+            raise KeyError(e)
+        return self.tree.edge_attrs[k]
+
+
 def match_sub_template(sentence=None, feature=None, valid_nodes=None, valid_edges=None):
     if len(valid_nodes) == feature.graph.number_of_nodes():
         matched_nodes = {idx: sentence.graph.nodes[vid]['label'] for vid, idx in valid_nodes}
@@ -421,6 +561,7 @@ class PatternGraph(DiGraph):
 
         self.repr_ = None
         self.nonlinear = not self.islinear(self.graph)
+        self._matcher = None
 
         self.node_repr_fmt = "lemma/pos"
         self.edge_repr_fmt = "deprel"
@@ -500,6 +641,18 @@ class PatternGraph(DiGraph):
             match[attr] = m
         return match
 
+    def compile(self):
+        """Compile the pattern into a matching plan with precompiled regular expressions.
+        The plan is built once and cached, see :class:`~nephosem.specutils.deputils.PatternMatcher`.
+
+        Returns
+        -------
+        :class:`~nephosem.specutils.deputils.PatternMatcher`
+        """
+        if getattr(self, '_matcher', None) is None:
+            self._matcher = PatternMatcher(self.graph)
+        return self._matcher
+
     def show(self, v_label='label', e_label='rel', figsize=(5.0, 5.0)):
         draw_tree(self.graph, v_label=v_label, e_label=e_label, figsize=figsize)
 
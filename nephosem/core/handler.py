@@ -33,12 +33,24 @@ try:
 except ImportError:
     import pickle as _pickle
 
-import codecs
 import logging
+import mmap
 import os
+import tempfile
+from collections import deque, namedtuple
 from copy import deepcopy
 import multiprocessing as mp
 
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+try:
+    from multiprocessing import resource_tracker, shared_memory  # Python 3.8+
+except ImportError:
+    resource_tracker = shared_memory = None
+
 import nephosem
 from nephosem import progbar, trange
 from nephosem.core.terms import CorpusFormatter, Window
@@ -48,6 +60,53 @@ logger = logging.getLogger(__name__)
 homedir = os.path.expanduser('~')
 
 
+class FileShard(namedtuple('FileShard', ['filename', 'start', 'end', 'lid'])):
+    """A job covering the byte range [start, end) of a (large) corpus file.
+    `lid` is the number of lines of the file before `start`.
+    See :meth:`BaseHandler.shard_file`.
+    """
+    __slots__ = ()
+
+
+def job_filename(job):
+    """The corpus file name of a job (a file name or a :class:`FileShard`)."""
+    return job.filename if isinstance(job, FileShard) else job
+
+
+def read_lines(job, encoding='utf-8'):
+    """Read the lines of a job (a file name or a :class:`FileShard`).
+    On both paths, lines are only split on '\\n' (not on the other line boundaries of
+    `str.splitlines()`, such as '\\r' or '\\u2028'), the same as the byte offsets of the shards.
+    So a file and its shards give the same lines and line numbers.
+
+    Parameters
+    ----------
+    job : str or :class:`FileShard`
+    encoding : str
+
+    Returns
+    -------
+    generator of (lid, line)
+        Line number (1-based, in the whole file) and the line.
+    """
+    if isinstance(job, FileShard):
+        with open(job.filename, 'rb') as fin:
+            fin.seek(job.start)
+            pos, lid = job.start, job.lid
+            for bline in fin:
+                if pos >= job.end:
+                    break
+                pos += len(bline)
+                lid += 1
+                yield lid, bline.decode(encoding)
+    else:
+        with open(job, 'r', encoding=encoding, newline='\n') as fin:
+            lid = 0
+            for line in fin:
+                lid += 1
+                yield lid, line
+
+
 class Paralleler(object):
     """This is a base class of all classes that work parallel.
     This class contains a framework for parallel tasks.
@@ -77,13 +136,21 @@ class Paralleler(object):
         Number of CPU cores to be used parallel.
     tmpdir : str
         The path of the temporary directory used by the Class
+    transport : str
+        How the results of the workers are sent back to the main process:
+            * 'manager' (default): through a `multiprocessing.Manager().Queue()`,
+            * 'shm': through shared memory blocks, see :class:`SharedResultQueue`.
 
     Notes
     -----
 
     """
+    transports = ('manager', 'shm')
 
-    def __init__(self, workers=0, **kwargs):
+    def __init__(self, workers=0, transport='manager', **kwargs):
+        if transport not in self.transports:
+            raise ValueError("Unsupported result transport: {}".format(transport))
+        self.transport = transport
         # the number of CPU cores used by the program
         self.workers = workers if 0 < workers < mp.cpu_count() else mp.cpu_count()-1
         # add other possible arguments to the `__dict__` of the class
@@ -122,11 +189,16 @@ class Paralleler(object):
                 * ColFreqHandler: returns a `TypeTokenMatrix` co-occurrence frequency matrix,
                 * TokenHandler: returns a Python dict mapping the type strings to their lists of tokens (`TokenNode` objects).
         """
-        # define IPC manager
-        manager = mp.Manager()
-        # define two list (queue) for tasks and results
-        job_queue = manager.Queue()
-        res_queue = manager.Queue()
+        if self.transport == 'shm':
+            # plain queues, the results themselves are put in shared memory
+            job_queue = mp.SimpleQueue()
+            res_queue = SharedResultQueue(tmpdir=self.tmpdir)
+        else:
+            # define IPC manager
+            manager = mp.Manager()
+            # define two list (queue) for tasks and results
+            job_queue = manager.Queue()
+            res_queue = manager.Queue()
 
         # create a number of (`self.workers`) worker processes
         workers = [
@@ -143,26 +215,36 @@ class Paralleler(object):
             worker.start()
 
         # produce the job queue
-        self._job_producer(fnames, job_queue)
-        
+        jobs = self.make_jobs(fnames)
+        self._job_producer(jobs, job_queue)
+        if self.transport == 'shm':
+            # receive the descriptors while the workers are running
+            res_queue.collect(workers)
+
         for worker in workers:
             worker.join()
 
         # merge results of different sub-processes
-        result = self._process_results(res_queue, n=len(fnames))
+        result = self._process_results(res_queue, n=len(jobs))
         
         return result
 
+    def make_jobs(self, fnames):
+        """Transform the file names into the list of jobs.
+        Each job is just a filename here, see `BaseHandler.make_jobs()` for file shards.
+        """
+        return fnames
+
     def _job_producer(self, fnames, job_queue, **kwargs):
         """Fill the jobs queue using the input fnames.
 
-        Each job is just a filename (Python str). One could also add other necessary objects into each job by
-        overriding this method in sub-classes.
+        Each job is just a filename (Python str) or a :class:`FileShard`. One could also add other necessary
+        objects into each job by overriding this method in sub-classes.
 
         Parameters
         ----------
-        fnames : iterable of str
-            A list of file names.
+        fnames : iterable of str or :class:`FileShard`
+            A list of file names (jobs).
         job_queue : Queue of (str)
             A queue of jobs still to be processed. The worker will take up jobs from this queue.
         """
@@ -202,6 +284,98 @@ class Paralleler(object):
         raise NotImplementedError
 
 
+class SharedResultQueue(object):
+    """A result queue which sends the results of the worker processes through shared memory.
+
+    Progress indicators and tmp file names (None, numbers and strings) go directly through
+    a plain `multiprocessing.Queue`. Any other result (i.e. a frequency dict or a `type2toks` dict)
+    is pickled once by the worker into a `multiprocessing.shared_memory` block, or into a tmp file
+    which is memory-mapped when read if shared memory is not supported (Python < 3.8).
+    Only a small descriptor (name and size of the block) goes through the queue.
+
+    The main process drains the descriptors while the workers are running (`collect()`),
+    so that the workers never block on a full pipe, and it attaches to a block only
+    when the result is taken by `get()`. The block is released right after.
+    So there is no manager process which keeps a second copy of all results.
+    """
+
+    def __init__(self, tmpdir=None):
+        self._queue = mp.Queue()
+        self._received = deque()
+        self.tmpdir = tmpdir if tmpdir else tempfile.gettempdir()
+        if resource_tracker is not None:
+            # the workers inherit the tracker of the main process,
+            # otherwise a worker's own tracker unlinks its blocks when it exits
+            resource_tracker.ensure_running()
+
+    def put(self, obj):
+        """Send a result (called in a worker process)."""
+        if obj is None or isinstance(obj, (int, float, str)):
+            self._queue.put(('raw', obj))
+            return
+        payload = _pickle.dumps(obj, protocol=_pickle.HIGHEST_PROTOCOL)
+        if shared_memory is not None:
+            shm = shared_memory.SharedMemory(create=True, size=len(payload))
+            shm.buf[:len(payload)] = payload
+            self._queue.put(('shm', shm.name, len(payload)))
+            shm.close()  # the block is unlinked by the receiver
+        else:
+            make_dir(self.tmpdir)
+            fd, fname = tempfile.mkstemp(suffix='.res', dir=self.tmpdir)
+            with os.fdopen(fd, 'wb') as fout:
+                fout.write(payload)
+            self._queue.put(('mmap', fname, len(payload)))
+
+    def collect(self, workers, timeout=0.1):
+        """Receive descriptors until all worker processes have exited."""
+        while any(worker.is_alive() for worker in workers):
+            try:
+                self._received.append(self._queue.get(timeout=timeout))
+            except Empty:
+                pass
+        # an exited worker has flushed all its descriptors into the pipe
+        while True:
+            try:
+                self._received.append(self._queue.get(timeout=timeout))
+            except Empty:
+                break
+
+    def get(self):
+        """Take the next result and release its shared memory block."""
+        if len(self._received) == 0:
+            raise Empty
+        desc = self._received.popleft()
+        kind = desc[0]
+        if kind == 'raw':
+            return desc[1]
+        elif kind == 'shm':
+            _, name, size = desc
+            shm = shared_memory.SharedMemory(name=name)
+            buf = shm.buf[:size]
+            try:
+                obj = _pickle.loads(buf)
+            finally:
+                buf.release()
+                shm.close()
+                shm.unlink()
+        else:
+            _, fname, size = desc
+            with open(fname, 'rb') as fin:
+                mm = mmap.mmap(fin.fileno(), size, access=mmap.ACCESS_READ)
+                try:
+                    obj = _pickle.loads(mm)
+                finally:
+                    mm.close()
+            os.remove(fname)
+        return obj
+
+    def qsize(self):
+        return len(self._received)
+
+    def empty(self):
+        return len(self._received) == 0
+
+
 class BaseHandler(Paralleler):
     """This is a base class of all handler classes.
 
@@ -231,6 +405,10 @@ class BaseHandler(Paralleler):
         If input_encoding is 'latin-1', but we don't want to use it for output files.
         We could use 'utf-8' for output files.
         Default 'utf-8'.
+    shardsize : int
+        If set (number of bytes), files larger than it are split into shards of about this size,
+        each one processed as a separate job (see `shard_file()`).
+        Default None, each file is one job.
 
     Notes
     -----
@@ -240,6 +418,8 @@ class BaseHandler(Paralleler):
 
     """
     tmpindicator = ''
+    shardsize = None
+    blocksize = 16777216  # size of the blocks read when counting lines
 
     def __init__(self, settings, workers=0, **kwargs):
         super(BaseHandler, self).__init__(workers=workers, **kwargs)
@@ -301,6 +481,75 @@ class BaseHandler(Paralleler):
     def process(self, fnames, **kwargs):
         return super(BaseHandler, self).process(fnames, **kwargs)
 
+    def make_jobs(self, fnames):
+        """Transform the file names into the list of jobs.
+        When `self.job_shardsize` is set, the large files are split into :class:`FileShard` jobs.
+        """
+        shardsize = self.job_shardsize
+        if not shardsize:
+            return fnames
+        jobs = []
+        for fname in fnames:
+            jobs.extend(self.shard_file(fname, shardsize=shardsize))
+        return jobs
+
+    @property
+    def job_shardsize(self):
+        """The size (in bytes) of the file shards made by `make_jobs()`, None for no sharding."""
+        return self.shardsize
+
+    def shard_file(self, filename, shardsize=None):
+        """Split a file into byte ranges of about `shardsize` bytes.
+        Each range (except the last one) ends right after a separator line,
+        so that a window never crosses the border of two shards.
+
+        Parameters
+        ----------
+        filename : str
+        shardsize : int, optional
+            Default is `self.shardsize`.
+
+        Returns
+        -------
+        list
+            The file name itself if it is not split, else a list of :class:`FileShard`.
+        """
+        shardsize = shardsize if shardsize else self.shardsize
+        size = os.path.getsize(filename)
+        if size <= shardsize:
+            return [filename]
+        bounds = [0]
+        with open(filename, 'rb') as fin:
+            target = shardsize
+            while target < size:
+                fin.seek(target)
+                fin.readline()  # skip the rest of the current line
+                for bline in iter(fin.readline, b''):
+                    line = bline.decode(self.input_encoding, errors='replace').strip()
+                    if self.formatter.match_line(line) is None and self.formatter.separator_line_machine(line):
+                        break
+                pos = fin.tell()
+                if pos >= size:
+                    break
+                bounds.append(pos)
+                target = pos + shardsize
+            bounds.append(size)
+
+            # count the lines before each shard
+            lids = [0]
+            fin.seek(0)
+            for start, end in zip(bounds[:-2], bounds[1:-1]):
+                nlines, remaining = 0, end - start
+                while remaining > 0:
+                    block = fin.read(min(self.blocksize, remaining))
+                    nlines += block.count(b'\n')
+                    remaining -= len(block)
+                lids.append(lids[-1] + nlines)
+
+        if len(bounds) == 2:
+            return [filename]
+        return [FileShard(filename, start, end, lid) for start, end, lid in zip(bounds[:-1], bounds[1:], lids)]
+
     def _do_process_job(self, fname, **kwargs):
         raise NotImplementedError()
 
@@ -318,24 +567,22 @@ class BaseHandler(Paralleler):
         win = Window(lspan, rspan)
 
         # process file
-        fname = os.path.splitext(os.path.relpath(filename, start=self.settings['corpus-path']))[0] # change 2023.04.07: assign fid based corpus path in settings (flexible softcoding)
+        fname = os.path.splitext(os.path.relpath(job_filename(filename), start=self.settings['corpus-path']))[0] # change 2023.04.07: assign fid based corpus path in settings (flexible softcoding)
         # fname = os.path.basename(filename).rsplit('.', 1)[0]  # for filename in token
-        with codecs.open(filename, 'r', input_encoding) as fin:
-            lid = 0  # line number (1-based)
-            for line in fin:
-                lid += 1
-                line = line.strip()
-                match = self.formatter.match_line(line)
-                if match is None:
-                    isseparator = True if self.formatter.separator_line_machine(line) else False
-                    if isseparator:
-                        # process the nodes in the right window, when reaching a separator line
-                        self.process_right_window(data, win, fid=fname)
-                        win = Window(lspan, rspan)
-                else:
-                    win.update((match, lid))  # append the current match to the right window
-                    # if it's a normal line, draws the type from the match
-                    self.update_one_match(data, win, lid=lid, fid=fname)
+        # the filename could also be a shard of a file, lid is the line number (1-based) in the file
+        for lid, line in read_lines(filename, input_encoding):
+            line = line.strip()
+            match = self.formatter.match_line(line)
+            if match is None:
+                isseparator = True if self.formatter.separator_line_machine(line) else False
+                if isseparator:
+                    # process the nodes in the right window, when reaching a separator line
+                    self.process_right_window(data, win, fid=fname)
+                    win = Window(lspan, rspan)
+            else:
+                win.update((match, lid))  # append the current match to the right window
+                # if it's a normal line, draws the type from the match
+                self.update_one_match(data, win, lid=lid, fid=fname)
         # deal with the final right window
         self.process_right_window(data, win, fid=fname)
 
@@ -57,16 +57,40 @@ import scipy.sparse as sp
 from nephosem.specutils import mxutils
 # import transform_spmatrix_to_dict, transform_dict_to_spmatrix, get_largest_k, get_smallest_k, centroid_of_cluster
 from nephosem.utils import is_string
+from .neighbors import NeighborIndex
 
 __all__ = ['TypeTokenMatrix']
 
 logger = logging.getLogger(__name__)
 
+MMX_EXT = '.mmx'  # extension of the memory-mappable matrix container
 
-def check_symmetric(arr, tol=1e-8):
+
+def encode_items(items, encoding='utf-8'):
+    """Encode a list of items into a binary table: the concatenated bytes (uint8) and the offsets (int64)."""
+    encoded = [e.encode(encoding) for e in items]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return blob, offsets
+
+
+def decode_items(blob, offsets, encoding='utf-8'):
+    """Decode the binary table of `encode_items()` back to a list of items."""
+    blob = blob.tobytes()
+    offsets = offsets.tolist()
+    return [blob[s:e].decode(encoding) for s, e in zip(offsets[:-1], offsets[1:])]
+
+
+def check_symmetric(arr, tol=1e-8, blocksize=1024):
     if arr.shape[0] != arr.shape[1]:
         return False
-    return np.allclose(arr, arr.T, atol=tol)
+    # compare by blocks of rows, so that no full-size temporary array is created
+    for start in range(0, arr.shape[0], blocksize):
+        end = start + blocksize
+        if not np.allclose(arr[start:end], arr[:, start:end].T, atol=tol):
+            return False
+    return True
 
 
 def empty_row_idx(npmx):
@@ -369,10 +393,18 @@ class SparseMatrix(BaseMatrix):
         return new_csr
 
     def most_similar(self, rowid, k=10, metric='cosine', descending=False):
-        raise NotImplementedError
+        """Get the indices of the most similar items of the target item, by sorting the values stored in its row
+        (i.e. of a sparse distance or similarity matrix keeping the `topk` values of each row).
+        The values which are not stored are not considered.
+        See `SquareMatrix.most_similar()` for `descending`.
+        """
+        row = self.matrix.getrow(rowid).tocsr()
+        vals = -row.data if descending else row.data
+        return row.indices[np.argsort(vals, kind='stable')[:k + 1]]
 
     def merge(self, self_row_items, self_col_items, othermx, other_row_items, other_col_items):
-        """Merge two sparse matrices.
+        """Merge (sum) two sparse matrices, which may have different row items and column items.
+        See :func:`~nephosem.specutils.mxutils.merge_spmatrices`.
 
         Parameters
         ----------
@@ -384,36 +416,12 @@ class SparseMatrix(BaseMatrix):
 
         Returns
         -------
-
+        tuple :
+            merged sparse matrix, row items (union), column items (union)
         """
-        mxdict1 = mxutils.transform_spmatrix_to_dict(self.matrix, self_row_items, self_col_items)
-        mxdict2 = mxutils.transform_spmatrix_to_dict(othermx, other_row_items, other_col_items)
-        row_items = sorted(set(self_row_items) | set(other_row_items))
-        col_items = sorted(set(self_col_items) | set(other_col_items))
-        mxdict = self._merge_matrix_dict(mxdict1, mxdict2)
-        spmx = mxutils.transform_dict_to_spmatrix(mxdict, row_items, col_items)
-        return spmx, row_items, col_items
-
-    @classmethod
-    def _merge_matrix_dict(cls, matrix1, matrix2):
-        """Merge two matrix (dict of dict)
-
-        Parameters
-        ----------
-        matrix1 : dict of dict
-        matrix2 : dict of dict
-
-        """
-        matrix = dict()
-        matrix.update(matrix1)
-        for rk, row in matrix2.items():
-            if rk not in matrix:
-                matrix[rk] = dict()
-            for ck, val in row.items():
-                if ck not in matrix[rk]:
-                    matrix[rk][ck] = 0
-                matrix[rk][ck] += val
-        return matrix
+        return mxutils.merge_spmatrices([self.matrix, othermx],
+                                        [self_row_items, other_row_items],
+                                        [self_col_items, other_col_items])
 
     def concatenate(self, othermx, axis=0):
         """Concatenate the other matrix with self.
@@ -644,6 +652,35 @@ class SquareMatrix(BaseMatrix):
         return idx
 
 
+class ItemIndex(object):
+    """Item tuple of one axis of a matrix, with its item -> index mapping (built at the first lookup).
+
+    The items are immutable, so the index (the tuple and its mapping) is shared, not copied,
+    by the matrices derived from a matrix with the same items. A new list of items gets a new index.
+    """
+    def __init__(self, items):
+        self.items = tuple(items)
+        self._item2id = None
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def item2id(self):
+        if self._item2id is None:
+            self._item2id = {e: i for i, e in enumerate(self.items)}
+        return self._item2id
+
+    def index(self, item):
+        """Get the index of an item (KeyError if not found)."""
+        return self.item2id[item]
+
+    def indices(self, items):
+        """Get the indices of a list of items as a numpy array (KeyError if one is not found)."""
+        item2id = self.item2id
+        return np.fromiter((item2id[e] for e in items), dtype=np.int64, count=len(items))
+
+
 class TypeTokenMatrix(BaseMatrix):
     """
     Examples
@@ -667,8 +704,14 @@ class TypeTokenMatrix(BaseMatrix):
     >>> sqMTX = TypeTokenMatrix(sqmx, col_items, col_items)
     >>> print(sqMTX)
 
+    The row and column items are stored as tuples. They could also be passed as :class:`ItemIndex` objects
+    (e.g. `row_index` of another matrix), which are then shared instead of copied.
+
+    A dense matrix is a square (symmetric) matrix if `check_symmetric()` says so.
+    Passing `square` (True or False) skips this check, which reads the whole matrix
+    (e.g. a memory-mapped matrix loaded by `load_container()`).
     """
-    def __init__(self, matrix, row_items, col_items, deep=True, **kwargs):
+    def __init__(self, matrix, row_items, col_items, deep=True, square=None, **kwargs):
         if deep:
             self.matrix = deepcopy(matrix)
         else:  # if the passed matrix is already a new object before passing in
@@ -681,16 +724,17 @@ class TypeTokenMatrix(BaseMatrix):
             raise ValueError("Inconsistent size of column item list ({}) with shape of matrix ({})!"
                              .format(len(col_items), self.matrix.shape[1]))
         self._mxbehavior = None
-        # always deep copy new row&column items, to keep them save
-        self.row_items = deepcopy(row_items)
-        self.col_items = deepcopy(col_items)
-        self._item2rowid = None
-        self._item2colid = None
+        # the row&column items are kept in (immutable) tuples, an ItemIndex is shared
+        self._rowindex = self._make_index(row_items)
+        self._colindex = self._make_index(col_items)
+        self._nnindex = None
 
         if isinstance(self.matrix, sp.spmatrix):
             self._mxbehavior = SparseMatrix(self.matrix)
         elif isinstance(self.matrix, np.ndarray):
-            if check_symmetric(self.matrix):
+            if square is None:
+                square = check_symmetric(self.matrix)
+            if square:
                 if self.row_items != self.col_items:
                     raise ValueError("The row items and column items are not equal!")
                 self._mxbehavior = SquareMatrix(self.matrix)
@@ -703,6 +747,39 @@ class TypeTokenMatrix(BaseMatrix):
     def shape(self):
         return self.matrix.shape
 
+    @staticmethod
+    def _make_index(items):
+        if isinstance(items, ItemIndex):
+            return items
+        return ItemIndex(items)
+
+    @property
+    def row_items(self):
+        return self._rowindex.items
+
+    @row_items.setter
+    def row_items(self, items):
+        self._rowindex = self._make_index(items)
+        self._nnindex = None
+
+    @property
+    def col_items(self):
+        return self._colindex.items
+
+    @col_items.setter
+    def col_items(self, items):
+        self._colindex = self._make_index(items)
+
+    @property
+    def row_index(self):
+        """:class:`ItemIndex` of the row items, shared by the derived matrices with the same rows."""
+        return self._rowindex
+
+    @property
+    def col_index(self):
+        """:class:`ItemIndex` of the column items, shared by the derived matrices with the same columns."""
+        return self._colindex
+
     @property
     def rowid2item(self):
         return self.row_items
@@ -714,36 +791,30 @@ class TypeTokenMatrix(BaseMatrix):
     @property
     def item2rowid(self):
         """Return a dict mapping from (row) items to corresponding indices.
-        If `self._item2rowid` is generated, just return it,
-        else, create the `self._item2rowid` dict and return it.
+        The dict is built once and shared by the matrices with the same row index.
 
         Returns
         -------
-        self._item2rowid : dict
+        dict
         """
-        if self._item2rowid is None:
-            self._item2rowid = {e: i for i, e in enumerate(self.rowid2item)}
-        return self._item2rowid
+        return self._rowindex.item2id
 
     @property
     def item2colid(self):
         """Return a dict mapping from (column) items to corresponding indices.
-        If `self._item2colid` is generated, just return it,
-        else, create the `self._item2colid` dict and return it.
+        The dict is built once and shared by the matrices with the same column index.
 
         Returns
         -------
-        self._item2colid : dict
+        dict
         """
-        if self._item2colid is None:
-            self._item2colid = {e: i for i, e in enumerate(self.colid2item)}
-        return self._item2colid
+        return self._colindex.item2id
 
     @property
     def meta_data(self):
         """Meta data of the matrix."""
         meta = dict()
-        notmeta = ['matrix', 'row_items', 'col_items', '_mxbehavior']
+        notmeta = ['matrix', '_rowindex', '_colindex', '_mxbehavior', '_nnindex']
         for k, v in self.__dict__.items():
             if k not in notmeta:
                 meta[k] = v
@@ -804,31 +875,31 @@ class TypeTokenMatrix(BaseMatrix):
     def multiply(self, other):
         # TODO: check consistency first!!!
         resmx = self._mxbehavior.multiply(other.matrix)
-        return TypeTokenMatrix(resmx, self.row_items, self.col_items, **self.meta_data)
+        return TypeTokenMatrix(resmx, self._rowindex, self._colindex, **self.meta_data)
 
     def __lt__(self, other):
         if type(other) not in [int, float]:
             raise ValueError("Error: please pass an int or float value!")
         resmx = self._mxbehavior.__lt__(other)
-        return TypeTokenMatrix(resmx, self.row_items, self.col_items, **self.meta_data)
+        return TypeTokenMatrix(resmx, self._rowindex, self._colindex, **self.meta_data)
 
     def __le__(self, other):
         if type(other) not in [int, float]:
             raise ValueError("Error: please pass an int or float value!")
         resmx = self._mxbehavior.__le__(other)
-        return TypeTokenMatrix(resmx, self.row_items, self.col_items, **self.meta_data)
+        return TypeTokenMatrix(resmx, self._rowindex, self._colindex, **self.meta_data)
 
     def __gt__(self, other):
         if type(other) not in [int, float]:
             raise ValueError("Error: please pass an int or float value!")
         resmx = self._mxbehavior.__gt__(other)
-        return TypeTokenMatrix(resmx, self.row_items, self.col_items, **self.meta_data)
+        return TypeTokenMatrix(resmx, self._rowindex, self._colindex, **self.meta_data)
 
     def __ge__(self, other):
         if type(other) not in [int, float]:
             raise ValueError("Error: please pass an int or float value!")
         resmx = self._mxbehavior.__ge__(other)
-        return TypeTokenMatrix(resmx, self.row_items, self.col_items, **self.meta_data)
+        return TypeTokenMatrix(resmx, self._rowindex, self._colindex, **self.meta_data)
 
     #def __deepcopy__(self, memodict={}):
     #    pass
@@ -903,18 +974,16 @@ class TypeTokenMatrix(BaseMatrix):
             else:
                 raise ValueError("Please do not pass empty list!")
         if row_item_based:
-            item2rowid = self.item2rowid
-            row = np.array([item2rowid[e] for e in row])
+            row = self._rowindex.indices(row)
         if col_item_based:
-            item2colid = self.item2colid
-            col = np.array([item2colid[e] for e in col])
+            col = self._colindex.indices(col)
         '''
         # mapping item strings to indices
         if row is not None:
             item2rowid = self.item2rowid
-            requested_rows = deepcopy(row)
+            requested_rows = row
             sub_row_items = [e for e in requested_rows if e in item2rowid]
-            row = np.array([item2rowid[e] for e in sub_row_items])
+            row = self._rowindex.indices(sub_row_items)
             #row = np.array([item2rowid.get(e, 0) for e in row])
             if len(row) == 0:
                 logger.warning("The row names provided do not exist.")
@@ -923,12 +992,12 @@ class TypeTokenMatrix(BaseMatrix):
                 lost_rows = len(requested_rows) - len(row)
                 logger.warning("{} rows have not been found.".format(str(lost_rows)))
         else:
-            sub_row_items = deepcopy(self.row_items)
+            sub_row_items = self._rowindex
         if col is not None:
             item2colid = self.item2colid
-            requested_cols = deepcopy(col)
+            requested_cols = col
             sub_col_items = [e for e in requested_cols if e in item2colid]
-            col = np.array([item2colid[e] for e in sub_col_items])
+            col = self._colindex.indices(sub_col_items)
             #col = np.array([item2colid.get(e, 0) for e in col])
             if len(col) == 0:
                 logger.warning("The column names provided do not exist.")
@@ -937,12 +1006,12 @@ class TypeTokenMatrix(BaseMatrix):
                 lost_cols = len(requested_cols) - len(col)
                 logger.warning("{} columns have not been found.".format(str(lost_cols)))
         else:
-            sub_col_items = deepcopy(self.col_items)
+            sub_col_items = self._colindex
         submx = self._mxbehavior.submatrix(row=row, col=col)
         # since we generate a new sub-matrix object, we need not deep copy when generating a new TypeTokenMatrix object
         return TypeTokenMatrix(submx, sub_row_items, sub_col_items, deep=False, **self.meta_data)
 
-    def most_similar(self, item, k=10, descending=False):
+    def most_similar(self, item, k=10, descending=False, metric=None):
         """Get most similar items of the target item.
 
         Parameters
@@ -958,17 +1027,49 @@ class TypeTokenMatrix(BaseMatrix):
             So for similarity matrix, set `descending` to True, as we want elements with largest values (similarities).
             For distance matrix, set `descending` to False.
             For similarity rank matrix, same to similarity matrix.
+        metric : str, optional
+            'cosine' for a matrix of feature vectors (i.e. an association measure matrix):
+            the rows are compared by cosine similarity with a (cached) :class:`~nephosem.NeighborIndex`,
+            see `neighbor_index()`, and `descending` is ignored.
+            Default None: the values of the row of the item are sorted (distance or similarity matrix).
+            For a sparse matrix, only the stored values are sorted.
 
         Returns
         -------
         a list of elements
         """
-        rid = self.row_items.index(item)  # item should be in row items!
+        if metric is not None:
+            if metric not in ('cosine', 'cos'):
+                raise NotImplementedError("Unknown metric {}".format(metric))
+            return self.neighbor_index().query(item, k=k)
+        rid = self.item2rowid[item]  # item should be in row items!
         idx = self._mxbehavior.most_similar(rid, k=k, descending=descending)
         # transform idx back to items
         similars = [self.row_items[i] for i in idx if self.row_items[i] != item]
         return similars
 
+    def neighbor_index(self, topk=None, blocksize=None):
+        """Get the cosine nearest neighbor index of the row items.
+        The index is built at the first call and cached, so it should be reset
+        (by `self._nnindex = None`) if the matrix is modified in place.
+
+        Parameters
+        ----------
+        topk : int, optional
+            If provided, precompute the `topk` neighbors of every row item.
+        blocksize : int, optional
+            Number of rows scored at once.
+
+        Returns
+        -------
+        :class:`~nephosem.NeighborIndex`
+        """
+        if self._nnindex is None:
+            self._nnindex = NeighborIndex(self, topk=topk, blocksize=blocksize)
+        elif topk and (self._nnindex.table is None or self._nnindex.table[0].shape[1] < topk):
+            self._nnindex.build_table(topk)
+        return self._nnindex
+
     def sample(self, percent=0.1, seed=-1, replace=False):
         """Sample the matrix based on row
 
@@ -1013,16 +1114,15 @@ class TypeTokenMatrix(BaseMatrix):
 
         """
         if axis == 0:
-            items = self.row_items
+            index = self._rowindex
         elif axis == 1:
-            items = self.col_items
+            index = self._colindex
         else:
             raise ValueError("Axis should be 0 or 1!")
 
         if item_list is not None:
-            # item -> id : current item to index mapping
-            item2id = {e: i for i, e in enumerate(items)}
-            idx_list = np.array([item2id[e] for e in item_list])
+            # current item to index mapping
+            idx_list = index.indices(item_list)
         else:
             raise ValueError("Please provide a valid item list!")
 
@@ -1030,9 +1130,9 @@ class TypeTokenMatrix(BaseMatrix):
         # matrix = self._reorder_matrix(matrix, idx_list, axis=axis)
         if axis == 0:
             row_items = item_list
-            col_items = self.col_items
+            col_items = self._colindex
         else:
-            row_items = self.row_items
+            row_items = self._rowindex
             col_items = item_list
         return TypeTokenMatrix(matrix, row_items, col_items, **self.meta_data)
 
@@ -1054,9 +1154,9 @@ class TypeTokenMatrix(BaseMatrix):
 
         """
         if axis == 0:
-            items = self.row_items
+            index = self._rowindex
         elif axis == 1:
-            items = self.col_items
+            index = self._colindex
         else:
             raise ValueError("Axis should be 0 or 1!")
 
@@ -1064,9 +1164,8 @@ class TypeTokenMatrix(BaseMatrix):
             if idx_list is not None:
                 raise ValueError("Please specify which one to use!")
             else:
-                # item -> id : current item to index mapping
-                item2id = {e: i for i, e in enumerate(items)}
-                idx_list = np.array([item2id[e] for e in item_list])
+                # current item to index mapping
+                idx_list = index.indices(item_list)
         elif idx_list is not None:
             raise NotImplementedError("'idx_list' parameter is not suggested now!")
             # item_list = np.array([items[i] for i in idx_list])
@@ -1077,9 +1176,9 @@ class TypeTokenMatrix(BaseMatrix):
         matrix = self._reorder_matrix(matrix, idx_list, axis=axis)
         if axis == 0:
             row_items = item_list
-            col_items = self.col_items
+            col_items = self._colindex
         else:
-            row_items = self.row_items
+            row_items = self._rowindex
             col_items = item_list
         return TypeTokenMatrix(matrix, row_items, col_items, **self.meta_data)
 
@@ -1207,24 +1306,53 @@ class TypeTokenMatrix(BaseMatrix):
             Axis of concatenation.
             If axis = 0, concatenate the targetmx as the new rows of self matrix.
             If axis = 1, concatenate the targetmx as the new columns of self matrix.
+            When the items of the other axis are different, two sparse matrices
+            are first aligned to the (sorted) union of these items.
         """
-        if axis == 0:
+        if axis not in (0, 1):
+            raise ValueError("axis should be 0 or 1!")
+        selfmx, othermx, items = self._align_for_concatenate(targetmx, axis=axis)
+        if selfmx is None:
             concmx = self._mxbehavior.concatenate(targetmx.matrix, axis=axis)
-            assert self.col_items == targetmx.col_items
+        else:
+            concmx = SparseMatrix(selfmx).concatenate(othermx, axis=axis)
+        if axis == 0:
             conc_row_items = self.row_items + targetmx.row_items
-            return TypeTokenMatrix(concmx, conc_row_items, self.col_items)
-        elif axis == 1:
-            concmx = self._mxbehavior.concatenate(targetmx.matrix, axis=axis)
-            assert self.row_items == targetmx.row_items
+            return TypeTokenMatrix(concmx, conc_row_items, items)
+        else:
             conc_col_items = self.col_items + targetmx.col_items
-            return TypeTokenMatrix(concmx, self.row_items, conc_col_items)
+            return TypeTokenMatrix(concmx, items, conc_col_items)
+
+    def _align_for_concatenate(self, targetmx, axis=0):
+        """Align self and the target matrix on the items of the axis which is not concatenated.
+
+        Returns
+        -------
+        tuple :
+            aligned matrix of self, aligned target matrix, items of the other axis.
+            The matrices are None when the items are already the same.
+        """
+        self_items = self.col_items if axis == 0 else self.row_items
+        other_items = targetmx.col_items if axis == 0 else targetmx.row_items
+        if self_items == other_items:
+            return None, None, self_items
+        if not (isinstance(self.matrix, sp.spmatrix) and isinstance(targetmx.matrix, sp.spmatrix)):
+            raise ValueError("Only sparse matrices with different {} items could be concatenated!"
+                             .format('column' if axis == 0 else 'row'))
+        items = mxutils.union_items([self_items, other_items])
+        if axis == 0:
+            selfmx = mxutils.align_spmatrix(self.matrix, self.row_items, self.col_items, new_col_items=items)
+            othermx = mxutils.align_spmatrix(targetmx.matrix, targetmx.row_items, targetmx.col_items,
+                                             new_col_items=items)
         else:
-            raise ValueError("axis should be 0 or 1!")
-        pass
+            selfmx = mxutils.align_spmatrix(self.matrix, self.row_items, self.col_items, new_row_items=items)
+            othermx = mxutils.align_spmatrix(targetmx.matrix, targetmx.row_items, targetmx.col_items,
+                                             new_row_items=items)
+        return selfmx, othermx, items
 
     def transpose(self):
         resmx = self._mxbehavior.transpose()
-        return TypeTokenMatrix(resmx, self.col_items, self.row_items, **self.meta_data)
+        return TypeTokenMatrix(resmx, self._colindex, self._rowindex, **self.meta_data)
 
     def equal(self, othermx):
         if self.row_items != othermx.row_items:
@@ -1244,15 +1372,15 @@ class TypeTokenMatrix(BaseMatrix):
         -------
 
         """
-        if item not in self.row_items:
+        if item not in self.item2rowid:
             raise KeyError("Item {} is not valid!".format(item))
-        idx = self.row_items.index(item)
+        idx = self.item2rowid[item]
         col_idx = self._mxbehavior.get_colloc_contexts(idx)
         contexts = [self.col_items[i] for i in col_idx]
         return contexts
 
     def todense(self):
-        return TypeTokenMatrix(self.matrix.toarray(), self.row_items, self.col_items, **self.meta_data)
+        return TypeTokenMatrix(self.matrix.toarray(), self._rowindex, self._colindex, **self.meta_data)
 
     def copy(self):
         return deepcopy(self)
@@ -1313,13 +1441,32 @@ class TypeTokenMatrix(BaseMatrix):
             mx = sp.csr_matrix(mx)
         return cls(mx, row_items, col_items)
 
-    def save(self, filename, encoding='utf-8', pack=True, verbose=True):
+    def save(self, filename, encoding='utf-8', pack=True, verbose=True, mmap=False):
+        """Save the matrix.
+
+        Parameters
+        ----------
+        filename : str
+            ".../xx.wcmx.freq.pac" (packed), ".../xx.wcmx.freq" (not packed)
+            or ".../xx.wcmx.freq.mmx" (memory-mappable container).
+        encoding : str
+            Default 'utf-8'.
+        pack : True or False
+            Package the meta data file and the matrix file into one (zip) '.pac' file.
+        verbose : bool
+        mmap : bool
+            Save the matrix into a memory-mappable '.mmx' container (`pack` is then ignored),
+            see `save_container()`.
+        """
+        basename, ext = os.path.splitext(filename)
+        if mmap or ext == MMX_EXT:
+            return self.save_container(filename, encoding=encoding, verbose=verbose)
+
         meta_data = dict()
         meta_data['row_items'] = self.row_items
         meta_data['col_items'] = self.col_items
         meta_data.update(self.meta_data)
 
-        basename, ext = os.path.splitext(filename)
         if pack:
             if ext != '.pac':
                 # filename: '/xxx/BrownNouns.wcmx.freq'
@@ -1366,15 +1513,18 @@ class TypeTokenMatrix(BaseMatrix):
                 print("Stored in files:\n  {}\n  {}".format(meta_fname, mx_fname))
 
     @classmethod
-    def load(cls, filename, encoding='utf-8', pack=True):
+    def load(cls, filename, encoding='utf-8', pack=True, mmap=False):
         """
         Parameters
         ----------
-        filename : ".../xx.wcmx.freq.pac"
+        filename : ".../xx.wcmx.freq.pac" or ".../xx.wcmx.freq.mmx"
         encoding : str
             Default 'utf-8'.
         pack : True or False
             Indicate the file is packaged or not
+        mmap : bool
+            Memory-map the arrays of a '.mmx' container (read-only) instead of reading them into RAM.
+            If the container '<filename>.mmx' exists, it is loaded even when `filename` has no extension.
 
         Returns
         -------
@@ -1382,8 +1532,14 @@ class TypeTokenMatrix(BaseMatrix):
 
         """
         basename, ext = os.path.splitext(filename)
+        if ext == MMX_EXT:
+            return cls.load_container(filename, encoding=encoding, mmap=mmap)
         if ext != '.pac':
             basename = filename
+            if os.path.isdir("{}{}".format(filename, MMX_EXT)):
+                return cls.load_container("{}{}".format(filename, MMX_EXT), encoding=encoding, mmap=mmap)
+        elif mmap:
+            logger.warning("Cannot memory-map a packed ('.pac') matrix, it is loaded into memory.")
         if pack:
             zip_fname = "{}.pac".format(basename)
             dest_dir = os.path.dirname(zip_fname)
@@ -1421,6 +1577,102 @@ class TypeTokenMatrix(BaseMatrix):
 
         return TypeTokenMatrix(matrix, meta_data['row_items'], meta_data['col_items'], deep=False)
 
+    def save_container(self, filename, encoding='utf-8', verbose=True):
+        """Save the matrix into an uncompressed, memory-mappable container.
+
+        The container is a directory ('.mmx') with:
+            - 'meta.json': meta data of the matrix (without the items)
+            - 'data.npy', 'indices.npy', 'indptr.npy' for a sparse (CSR) matrix,
+              or 'matrix.npy' for a dense matrix
+            - 'row_items.npy', 'col_items.npy': encoded items, concatenated (uint8)
+            - 'row_offsets.npy', 'col_offsets.npy': (byte) offsets of the items
+
+        Parameters
+        ----------
+        filename : str
+            ".../xx.wcmx.freq.mmx" or ".../xx.wcmx.freq" (then '.mmx' is appended)
+        encoding : str
+            Default 'utf-8'.
+        verbose : bool
+        """
+        if os.path.splitext(filename)[1] != MMX_EXT:
+            filename = "{}{}".format(filename, MMX_EXT)
+        if not os.path.exists(filename):
+            os.makedirs(filename)
+        if verbose:
+            logger.info("\nSaving matrix...")
+
+        meta_data = dict(self.meta_data)
+        meta_data['encoding'] = encoding
+        meta_data['shape'] = list(self.shape)
+        if isinstance(self.matrix, sp.spmatrix):
+            mx = self.matrix.tocsr()
+            meta_data['format'] = 'csr'
+            np.save(os.path.join(filename, 'data.npy'), mx.data)
+            np.save(os.path.join(filename, 'indices.npy'), mx.indices)
+            np.save(os.path.join(filename, 'indptr.npy'), mx.indptr)
+        elif isinstance(self.matrix, np.ndarray):
+            meta_data['format'] = 'dense'
+            meta_data['square'] = isinstance(self._mxbehavior, SquareMatrix)
+            np.save(os.path.join(filename, 'matrix.npy'), np.ascontiguousarray(self.matrix))
+        else:
+            raise ValueError("Not support this type of matrix!")
+
+        for axis, items in [('row', self.row_items), ('col', self.col_items)]:
+            blob, offsets = encode_items(items, encoding)
+            np.save(os.path.join(filename, '{}_items.npy'.format(axis)), blob)
+            np.save(os.path.join(filename, '{}_offsets.npy'.format(axis)), offsets)
+
+        with codecs.open(os.path.join(filename, 'meta.json'), 'w', encoding) as outf:
+            json.dump(meta_data, outf, ensure_ascii=False, indent=4)
+        if verbose:
+            print("Stored in directory:\n  {}".format(filename))
+
+    @classmethod
+    def load_container(cls, filename, encoding='utf-8', mmap=False):
+        """Load a matrix saved by `save_container()`.
+
+        Parameters
+        ----------
+        filename : ".../xx.wcmx.freq.mmx"
+        encoding : str
+            Default 'utf-8'. The encoding stored in the meta data has precedence.
+        mmap : bool
+            If True, the arrays are memory-mapped (read-only), so the matrix opens without reading
+            the arrays and the pages are shared between processes loading the same container.
+
+        Returns
+        -------
+        :class:`~nephosem.TypeTokenMatrix`
+        """
+        if not os.path.isdir(filename):
+            raise ValueError("No such matrix container: {}".format(filename))
+        with codecs.open(os.path.join(filename, 'meta.json'), 'r', encoding) as inf:
+            meta_data = json.load(inf)
+        encoding = meta_data.get('encoding', encoding)
+        mmap_mode = 'r' if mmap else None
+
+        def load_array(name):
+            return np.load(os.path.join(filename, name), mmap_mode=mmap_mode)
+
+        shape = tuple(meta_data['shape'])
+        if meta_data['format'] == 'csr':
+            matrix = sp.csr_matrix((load_array('data.npy'), load_array('indices.npy'), load_array('indptr.npy')),
+                                   shape=shape, copy=False)
+        elif meta_data['format'] == 'dense':
+            matrix = load_array('matrix.npy')
+        else:
+            raise ValueError("Unknown matrix format: {}".format(meta_data['format']))
+
+        row_items = decode_items(np.load(os.path.join(filename, 'row_items.npy')),
+                                 np.load(os.path.join(filename, 'row_offsets.npy')), encoding)
+        col_items = decode_items(np.load(os.path.join(filename, 'col_items.npy')),
+                                 np.load(os.path.join(filename, 'col_offsets.npy')), encoding)
+        # the symmetry of a dense matrix is stored, so it is not checked on the whole (memory-mapped) matrix
+        # older containers: a square matrix with the same row and column items
+        square = meta_data.get('square', shape[0] == shape[1] and row_items == col_items)
+        return cls(matrix, row_items, col_items, deep=False, square=square)
+
     def describe(self):
         """Generates descriptive information of the matrix
         TODO: improve
@@ -1461,7 +1713,7 @@ class TypeTokenMatrix(BaseMatrix):
         n_cols = min(n_cols, shape[1]) if n_cols else shape[1]
 
         # add column words
-        res = [[str(list(shape))] + self.colid2item[:n_cols]]
+        res = [[str(list(shape))] + list(self.colid2item[:n_cols])]
 
         if isinstance(mtx, sp.spmatrix):
             if not isinstance(mtx, sp.csr_matrix):
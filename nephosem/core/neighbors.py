@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Author: QLVL <qlvl@kuleuven.be>
+# Copyright (C) 2021 QLVL KULeuven
+#
+# This file is part of Nephosem.
+#
+# Nephosem is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Nephosem is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Nephosem. If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Nearest Neighbor Index Class
+
+Usage examples
+==============
+
+Build an index on the rows of an association (i.e. PPMI) matrix and query it:
+
+>>> from nephosem import NeighborIndex
+>>>
+>>> index = NeighborIndex(ppmiMTX)
+>>> index.query('girl/NN', k=10)
+>>> index.query_batch(['girl/NN', 'boy/NN'], k=10)
+
+"""
+
+import logging
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn import preprocessing
+
+__all__ = ['NeighborIndex']
+
+logger = logging.getLogger(__name__)
+
+
+class NeighborIndex(object):
+    """Exact cosine nearest neighbors of the rows (or columns) of an association matrix.
+
+    The vectors are normalized once. A query is scored against all vectors by a
+    (sparse) matrix-vector product, and the queries of a batch are scored by blocks of
+    `blocksize` rows. So the n x n similarity matrix is never built and the memory
+    stays linear in the size of the vocabulary (plus one dense block of scores).
+    An optional table of the `topk` neighbors of every item could be precomputed
+    by `build_table()`, the queries are then answered by a lookup.
+
+    Attributes
+    ----------
+    items : list of str
+    item2id : dict
+        Item -> index mapping.
+    table : tuple of numpy.ndarray or None
+        Indices (int32) and similarities (float32) of the sorted `topk` neighbors of every item.
+    """
+    blocksize = 1024  # number of queries scored at once
+
+    def __init__(self, measMTX, axis=0, topk=None, blocksize=None):
+        """
+        Parameters
+        ----------
+        measMTX : :class:`~nephosem.TypeTokenMatrix`
+            Association measure matrix.
+        axis : int
+            0 (row items) or 1 (column items).
+        topk : int, optional
+            If provided, precompute the table of the `topk` neighbors of every item.
+        blocksize : int, optional
+        """
+        # the item -> index mapping is shared with the matrix
+        if axis == 0:
+            mx, self.items, self.item2id = measMTX.matrix, measMTX.row_items, measMTX.item2rowid
+        elif axis == 1:
+            mx, self.items, self.item2id = measMTX.matrix.transpose(), measMTX.col_items, measMTX.item2colid
+        else:
+            raise ValueError("Axis should be 0 or 1!")
+        if blocksize:
+            self.blocksize = blocksize
+        if sp.issparse(mx):
+            self.vectors = preprocessing.normalize(mx.tocsr().astype(np.float64), norm='l2')
+            self._vectorsT = self.vectors.transpose().tocsr()
+        else:
+            self.vectors = preprocessing.normalize(np.asarray(mx, dtype=np.float64), norm='l2')
+            self._vectorsT = self.vectors.T
+        self.table = None
+        if topk:
+            self.build_table(topk)
+
+    def __len__(self):
+        return len(self.items)
+
+    def scores(self, ids):
+        """Cosine similarities of the items of the indices `ids` with all items.
+
+        Returns
+        -------
+        numpy.ndarray of shape (len(ids), n)
+        """
+        block = self.vectors[ids].dot(self._vectorsT)
+        return block.toarray() if sp.issparse(block) else np.asarray(block)
+
+    def _top_neighbors(self, ids, k):
+        """Indices and similarities of the sorted `k` neighbors of each item of `ids` (excluding itself)."""
+        ids = np.asarray(ids)
+        simmx = self.scores(ids)
+        simmx[np.arange(len(ids)), ids] = -np.inf  # exclude the item itself
+        k = min(k, len(self.items) - 1)
+        if k <= 0:
+            return np.zeros((len(ids), 0), dtype=np.int32), np.zeros((len(ids), 0), dtype=np.float32)
+        idx = np.argpartition(-simmx, k - 1, axis=1)[:, :k]
+        sims = np.take_along_axis(simmx, idx, axis=1)
+        order = np.argsort(-sims, axis=1, kind='stable')
+        return np.take_along_axis(idx, order, axis=1), np.take_along_axis(sims, order, axis=1)
+
+    def build_table(self, topk):
+        """Precompute the sorted `topk` neighbors (and similarities) of every item, by blocks of items."""
+        n = len(self.items)
+        k = max(min(topk, n - 1), 0)
+        topidx = np.zeros((n, k), dtype=np.int32)
+        topsim = np.zeros((n, k), dtype=np.float32)
+        for start in range(0, n, self.blocksize):
+            end = min(start + self.blocksize, n)
+            topidx[start:end], topsim[start:end] = self._top_neighbors(np.arange(start, end), k)
+        self.table = (topidx, topsim)
+        return self.table
+
+    def query(self, item, k=10, return_similarity=False):
+        """Get the `k` most similar items of an item (excluding itself), sorted by descending similarity.
+
+        Parameters
+        ----------
+        item : str
+        k : int
+        return_similarity : bool
+            If True, return (item, similarity) pairs.
+
+        Returns
+        -------
+        list
+        """
+        return self.query_batch([item], k=k, return_similarity=return_similarity)[0]
+
+    def query_batch(self, items, k=10, return_similarity=False):
+        """Get the `k` most similar items of each item of `items`, see `query()`.
+
+        Returns
+        -------
+        list of list
+        """
+        ids = np.array([self.item2id[e] for e in items], dtype=np.int64)
+        if self.table is not None and k <= self.table[0].shape[1]:
+            topidx, topsim = self.table[0][ids, :k], self.table[1][ids, :k]
+        else:
+            topidx, topsim = [], []
+            for start in range(0, len(ids), self.blocksize):
+                idx, sims = self._top_neighbors(ids[start:start + self.blocksize], k)
+                topidx.append(idx)
+                topsim.append(sims)
+            topidx = np.vstack(topidx) if topidx else np.zeros((0, 0), dtype=np.int32)
+            topsim = np.vstack(topsim) if topsim else np.zeros((0, 0), dtype=np.float32)
+
+        results = []
+        for idx, sims in zip(topidx, topsim):
+            if return_similarity:
+                results.append([(self.items[i], float(s)) for i, s in zip(idx, sims)])
+            else:
+                results.append([self.items[i] for i in idx])
+        return results
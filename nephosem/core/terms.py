@@ -28,6 +28,7 @@ import operator
 import random
 import logging
 
+from array import array
 from copy import deepcopy
 from collections import defaultdict, deque
 
@@ -35,7 +36,7 @@ from six import iteritems
 
 from nephosem import utils
 
-__all__ = ['Window', 'Getter', 'CorpusFormatter', 'ItemNode', 'TypeNode', 'TokenNode']
+__all__ = ['Window', 'Getter', 'CorpusFormatter', 'ItemNode', 'TypeNode', 'TokenNode', 'TokenStore']
 
 logger = logging.getLogger(__name__)
 
@@ -161,8 +162,8 @@ class TypeNode(ItemNode):
         word : str
         lemma : str
         pos : str
-        tokens : iterable of :class:`~nephosem.TokenNode`
-            A list of tokens.
+        tokens : iterable of :class:`~nephosem.TokenNode` or :class:`~nephosem.TokenStore`
+            A list of tokens, or a token store (which is then used, not copied).
         kwargs
         """
         if match and formatter:  # case 1
@@ -191,9 +192,25 @@ class TypeNode(ItemNode):
             raise ValueError("Please provide type format!")
 
         self.format = type_fmt
-        self.tokens = [] if not tokens else deepcopy(tokens)
+        self.tokens = tokens
         self.__dict__.update(**kwargs)
 
+    @property
+    def tokens(self):
+        """Tokens of the type, a :class:`TokenStore`.
+        Indexing or iterating over it creates :class:`TokenNode` views of the stored tokens.
+        """
+        return self.store
+
+    @tokens.setter
+    def tokens(self, tokens):
+        if isinstance(tokens, TokenStore):
+            self.store = tokens
+        else:
+            self.store = TokenStore()
+            for tok in (tokens or []):
+                self.store.append_node(tok)
+
     @property
     def type(self):
         comps = self.format.split(self.connector)
@@ -209,15 +226,11 @@ class TypeNode(ItemNode):
         return self.get_collocs()
 
     def append_token(self, token):
-        self.tokens.append(token)
+        self.store.append_node(token)
 
     def get_collocs(self):
-        """Get the collocates of all tokens"""
-        collocs = set()
-        for tok in self.tokens:
-            collocs.update(set(tok.lcollocs))
-            collocs.update(set(tok.rcollocs))
-        return collocs
+        """Get the collocates (ItemNode views of the distinct collocate items) of all tokens"""
+        return set(self.store.collocs())
 
     def save(self, filename, fmt='json', encoding='utf-8', verbose=True):
         if verbose:
@@ -253,12 +266,12 @@ class TypeNode(ItemNode):
         A new TypeNode object
         """
         if method == 'random':
-            sample_indices = set(random.sample(range(self.freq), n))
-            sample_tokens = [h for i, h in enumerate(self.tokens) if i in sample_indices]
+            sample_indices = sorted(random.sample(range(self.freq), n))
         else:  # RETRIEVAL_METHOD_FIRST assumed
-            sample_tokens = self.tokens[:n]
+            sample_indices = range(min(n, self.freq))
+        sample_tokens = self.store.select(sample_indices)
 
-        wn = TypeNode(type_str=self.type, type_fmt=self.type_fmt, tokens=sample_tokens)
+        wn = TypeNode(type_str=self.type, type_fmt=self.format, tokens=sample_tokens)
         return wn
 
     @classmethod
@@ -273,12 +286,12 @@ class TypeNode(ItemNode):
             return
         type_str = str(tns[0])
         type_fmt = tns[0].format
-        tokens = []
+        tokens = TokenStore()
         for tn in tns:
             if str(tn) != type_str or type_fmt != tn.format:
                 raise ValueError("TypeNode list has inconsistent type!\n"
                                  "{}".format(str(tn)))
-            tokens.extend(tn.tokens)
+            tokens.extend(tn.store)
 
         # TODO: maybe sort tokens
         return cls(type_str=type_str, type_fmt=type_fmt, tokens=tokens)
@@ -411,6 +424,172 @@ class TokenNode(ItemNode):
         return self.__str__()
 
 
+class TokenStore(object):
+    """Array-backed store of tokens (appearances of a type) and their collocates.
+
+    The (word, lemma, pos) items of the tokens and of their collocates are interned
+    in one item table, the file ids in another one. A token is then a few integers in parallel arrays:
+    its item id, file id and line id, and the slice of its collocate item ids
+    (left collocates first, then right collocates, in window order).
+    :class:`TokenNode` and :class:`ItemNode` objects are only created as views when accessed.
+
+    Attributes
+    ----------
+    items : list of tuple
+        (word, lemma, pos) items
+    fids : list of str
+        File ids
+    """
+
+    def __init__(self, token_fmt=None, colloc_fmt=None):
+        self.token_fmt = token_fmt
+        self.colloc_fmt = colloc_fmt
+        self.items = []
+        self._item2id = dict()
+        self.fids = []
+        self._fid2id = dict()
+        # arrays of the tokens
+        self.token_items = array('i')
+        self.token_fids = array('i')
+        self.token_lids = array('q')
+        self.token_nleft = array('i')  # number of left collocates
+        # collocates of the tokens, the collocates of token i are colloc_ids[colloc_ptr[i]:colloc_ptr[i+1]]
+        self.colloc_ptr = array('q', [0])
+        self.colloc_ids = array('i')
+
+    def __len__(self):
+        return len(self.token_items)
+
+    def item_id(self, item):
+        """Get the id of a (word, lemma, pos) item, adding it to the item table if it is new."""
+        idx = self._item2id.get(item)
+        if idx is None:
+            idx = self._item2id[item] = len(self.items)
+            self.items.append(item)
+        return idx
+
+    def fid_id(self, fid):
+        idx = self._fid2id.get(fid)
+        if idx is None:
+            idx = self._fid2id[fid] = len(self.fids)
+            self.fids.append(fid)
+        return idx
+
+    def append(self, item, fid, lid, litems, ritems):
+        """Append a token.
+
+        Parameters
+        ----------
+        item : tuple
+            (word, lemma, pos) of the token
+        fid : str
+        lid : int
+        litems : list of tuple
+            (word, lemma, pos) items of the left collocates
+        ritems : list of tuple
+            (word, lemma, pos) items of the right collocates
+        """
+        item_id = self.item_id
+        self.token_items.append(item_id(item))
+        self.token_fids.append(self.fid_id(fid))
+        self.token_lids.append(int(lid))
+        self.token_nleft.append(len(litems))
+        self.colloc_ids.extend([item_id(it) for it in litems])
+        self.colloc_ids.extend([item_id(it) for it in ritems])
+        self.colloc_ptr.append(len(self.colloc_ids))
+
+    def append_node(self, token):
+        """Append a :class:`TokenNode`."""
+        if self.token_fmt is None:
+            self.token_fmt = token.format
+        lcollocs, rcollocs = token.lcollocs or [], token.rcollocs or []
+        for colloc in lcollocs[:1] + rcollocs[:1]:
+            if self.colloc_fmt is None:
+                self.colloc_fmt = colloc.colloc_fmt
+        self.append((token.word, token.lemma, token.pos), token.fid, token.lid,
+                    [(c.word, c.lemma, c.pos) for c in lcollocs],
+                    [(c.word, c.lemma, c.pos) for c in rcollocs])
+
+    def extend(self, other):
+        """Append all tokens of another store."""
+        if self.token_fmt is None:
+            self.token_fmt, self.colloc_fmt = other.token_fmt, other.colloc_fmt
+        itemmap = array('i', [self.item_id(it) for it in other.items])
+        fidmap = array('i', [self.fid_id(fid) for fid in other.fids])
+        self.token_items.extend([itemmap[i] for i in other.token_items])
+        self.token_fids.extend([fidmap[i] for i in other.token_fids])
+        self.token_lids.extend(other.token_lids)
+        self.token_nleft.extend(other.token_nleft)
+        offset = self.colloc_ptr[-1]
+        self.colloc_ptr.extend([p + offset for p in other.colloc_ptr[1:]])
+        self.colloc_ids.extend([itemmap[i] for i in other.colloc_ids])
+
+    def select(self, indices):
+        """Get a new store of the tokens of the indices."""
+        new = TokenStore(token_fmt=self.token_fmt, colloc_fmt=self.colloc_fmt)
+        for i in indices:
+            start, end = self.colloc_ptr[i], self.colloc_ptr[i + 1]
+            nleft = self.token_nleft[i]
+            ids = self.colloc_ids[start:end]
+            new.append(self.items[self.token_items[i]], self.fids[self.token_fids[i]], self.token_lids[i],
+                       [self.items[j] for j in ids[:nleft]], [self.items[j] for j in ids[nleft:]])
+        return new
+
+    def token_str(self, i, token_fmt=None):
+        """Get the token string of the i-th token (i.e. 'word/pos/fid/lid')."""
+        word, lemma, pos = self.items[self.token_items[i]]
+        fields = {'word': word, 'lemma': lemma, 'pos': pos,
+                  'fid': self.fids[self.token_fids[i]], 'lid': str(self.token_lids[i])}
+        token_fmt = token_fmt if token_fmt else self.token_fmt
+        return TokenNode.connector.join(fields[c] for c in token_fmt.split(TokenNode.connector))
+
+    def item_strs(self, colloc_fmt=None):
+        """Get the collocate strings of all items of the item table (in the `colloc_fmt` format)."""
+        colloc_fmt = colloc_fmt if colloc_fmt else self.colloc_fmt
+        idx = {'word': 0, 'lemma': 1, 'pos': 2}
+        comps = [idx[c] for c in colloc_fmt.split(ItemNode.connector)]
+        return [ItemNode.connector.join(it[c] for c in comps) for it in self.items]
+
+    def iter_collocs(self, colloc_fmt=None):
+        """Iterate over the tokens without creating node objects.
+
+        Returns
+        -------
+        generator of (token string, list of collocate strings, number of left collocates)
+        """
+        colloc_strs = self.item_strs(colloc_fmt)
+        for i in range(len(self)):
+            start, end = self.colloc_ptr[i], self.colloc_ptr[i + 1]
+            yield self.token_str(i), [colloc_strs[j] for j in self.colloc_ids[start:end]], self.token_nleft[i]
+
+    def item_node(self, j):
+        """Get an :class:`ItemNode` view of the j-th item."""
+        word, lemma, pos = self.items[j]
+        return ItemNode(word=word, lemma=lemma, pos=pos, colloc_fmt=self.colloc_fmt)
+
+    def collocs(self):
+        """Get :class:`ItemNode` views of the distinct collocate items."""
+        return [self.item_node(j) for j in sorted(set(self.colloc_ids))]
+
+    def __getitem__(self, i):
+        """Get a :class:`TokenNode` view of the i-th token (or a list of views for a slice)."""
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        word, lemma, pos = self.items[self.token_items[i]]
+        start, end = self.colloc_ptr[i], self.colloc_ptr[i + 1]
+        nleft = self.token_nleft[i]
+        collocs = [self.item_node(j) for j in self.colloc_ids[start:end]]
+        return TokenNode(token_fmt=self.token_fmt, word=word, lemma=lemma, pos=pos,
+                         fid=self.fids[self.token_fids[i]], lid=self.token_lids[i],
+                         lcollocs=collocs[:nleft], rcollocs=collocs[nleft:])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 class Window(object):
     """
     Attributes
@@ -634,6 +813,12 @@ class CorpusFormatter(object):
         # specify which columns are node attributes or edge attributes
         self.node_attr = settings.get('node-attr', 'word,pos,lemma')
         self.edge_attr = settings.get('edge-attr', None)
+        # (column, group index) pairs of the node and edge attributes, in the order of the global columns
+        node_attr = self.node_attr.split(',')
+        edge_attr = self.edge_attr.split(',') if self.edge_attr else []
+        self.node_columns = [(col, col2id[col]) for col in columns if col in node_attr]
+        self.edge_columns = [(col, col2id[col]) for col in columns
+                             if col in edge_attr and col not in node_attr]
 
         self.settings = deepcopy(settings)  # store settings for possible uses
 
@@ -670,8 +855,11 @@ class CorpusFormatter(object):
         elif column == 'token':
             return self.get_token(match, fid, lid)
         else:
-            colidx = self.__dict__.get('_{}'.format(column), 0)
-            return match.group(colidx)
+            return match.group(self.column_index(column))
+
+    def column_index(self, column):
+        """Get the group index (in the line machine) of a column, 0 (the whole line) if it is not a column."""
+        return self.__dict__.get('_{}'.format(column), 0)
 
     def get_type(self, match):
         """Get type string from match object."""
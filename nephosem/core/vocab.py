@@ -36,12 +36,15 @@ Initialize a vocabulary with a Python dict e.g.
 
 import os
 import re
+import sys
 import operator
 import random
 import logging
+import numpy as np
 import pandas as pd
 from copy import deepcopy
 from collections import defaultdict
+from collections.abc import Mapping, MutableMapping
 from six import iteritems
 
 from nephosem import utils
@@ -52,6 +55,14 @@ logger = logging.getLogger(__name__)
 
 
 class Vocab(object):
+    """Vocabulary (frequency list) of items.
+
+    The items are stored once (interned) in a list, in insertion order,
+    their frequencies in a numpy array (int64, or float64 if non-integer frequencies are given),
+    and an item -> id hash index maps every item to its position.
+    The sorted views (alphabetic and frequency orders) are cached and invalidated when the vocab changes.
+    """
+    initsize = 1024  # initial capacity of the frequency array
 
     def __init__(self, data=None, encoding='utf-8'):
         """
@@ -64,63 +75,143 @@ class Vocab(object):
             encoding of corpus files, with default 'utf-8'
 
         """
-        self.freq_dict = defaultdict(int)
         self.raw_vocab = None  # not used currently
         self.FILTERPRESENT = False
         self.encoding = encoding  # TODO: do we need this encoding???
 
-        self.freq_dict = self._construct(data)
+        self._items = []  # item strings (interned), the id of an item is its position
+        self._item2id = dict()  # item -> id
+        self._freqs = np.zeros(0, dtype=np.int64)  # frequencies of ids (the capacity could be larger)
+        self._views = dict()  # cached sorted views (arrays of ids)
+        self._freqview = None  # mapping view of `freq_dict` (created at the first access)
+        self._construct(data)
         # if provided with non empty data or not None, set FILTERPRESENT to True
-        if len(self.freq_dict.keys()) > 0:
+        if len(self._items) > 0:
             self.FILTERPRESENT = True
 
+    @property
+    def freq_dict(self):
+        """A live mapping of item -> frequency (in insertion order), see :class:`FreqDictView`.
+        Setting a frequency in it sets the frequency in the vocab, like `vocab[item] = freq`.
+        A new (independent) dict is returned by `get_dict()`.
+        """
+        if self._freqview is None:
+            self._freqview = FreqDictView(self)
+        return self._freqview
+
+    @freq_dict.setter
+    def freq_dict(self, data):
+        if isinstance(data, Mapping) and not isinstance(data, dict):
+            data = dict(data)  # e.g. the view of a vocab (maybe this one)
+        self._items, self._item2id = [], dict()
+        self._freqs = np.zeros(0, dtype=np.int64)
+        self._views = dict()
+        self._construct(data)
+        self.FILTERPRESENT = len(self._items) > 0
+
+    @property
+    def freqs(self):
+        """Frequency array (view) of the items, ordered by their ids."""
+        return self._freqs[:len(self._items)]
+
+    @property
+    def item2id(self):
+        """Item -> id mapping. Do not modify it."""
+        return self._item2id
+
+    @property
+    def id2item(self):
+        """Id -> item list. Do not modify it."""
+        return self._items
+
+    def get_ids(self, items, default=-1):
+        """Get the ids of a list of items as an array, `default` for the items not in the vocab."""
+        get = self._item2id.get
+        return np.fromiter((get(e, default) for e in items), dtype=np.int64, count=len(items))
+
+    def _sorted_ids(self, sorting='freq', descending=True):
+        """Get the (cached) ids sorted by an order, see `get_item_list()`.
+        The frequency orders are sorted by alphabetic ascending order for equal frequencies.
+        """
+        key = (sorting, descending)
+        if key not in self._views:
+            if 'alpha' not in self._views:
+                items = self._items
+                self._views['alpha'] = np.array(sorted(range(len(items)), key=items.__getitem__), dtype=np.int64)
+            alpha = self._views['alpha']
+            if sorting == 'alpha':
+                ids = alpha[::-1] if descending else alpha
+            elif sorting == 'freq':
+                freqs = self.freqs[alpha]
+                ids = alpha[np.argsort(-freqs if descending else freqs, kind='stable')]
+            else:
+                raise ValueError("Insupportable sorting order!")
+            self._views[key] = ids
+        return self._views[key]
+
+    def _changed(self, newitem=False):
+        """Invalidate the cached sorted views."""
+        if newitem:
+            self._views = dict()
+        else:
+            self._views = {k: v for k, v in self._views.items() if k == 'alpha' or k[0] == 'alpha'}
+
     @property
     def dataframe(self):
         """Generate dataframe dynamically every time it is called.
         Sort items first by frequency (descending)
         and then by alphabetic ascending order.
         """
-        tuples = sorted(self.freq_dict.items(), key=operator.itemgetter(0))
-        tuples = sorted(tuples, key=operator.itemgetter(1), reverse=True)
-        dataframe = pd.DataFrame(tuples, columns=['item', 'freq'])
+        ids = self._sorted_ids('freq', descending=True)
+        dataframe = pd.DataFrame({'item': [self._items[i] for i in ids], 'freq': self.freqs[ids]},
+                                 columns=['item', 'freq'])
         return dataframe
 
     # ------- construction methods -------
     def _construct(self, data):
         """Construct a Vocab based on the passed data.
         Check the type of input data
-        if it is a Python dict: deepcopy a new dict by it
-        if it is a pandas.DataFrame: generate frequency dict by dataframe
+        if it is a Python dict: add its items and frequencies
+        if it is a pandas.DataFrame: add the 'item' and 'freq' columns
         """
         if data is None:
-            return dict()
-        func_dict = {
-            dict: deepcopy,
-            defaultdict: deepcopy,
-            pd.DataFrame: self._gen_freq_dict_by_dataframe,
-        }
-        dtype = type(data)
-
-        if dtype in func_dict:
-            func = func_dict[dtype]
-            freq_dict = func(data)  # use corresponding function to construct freq_dict
-            return freq_dict
+            return
+        if isinstance(data, dict):  # dict, defaultdict...
+            items, freqs = list(data.keys()), list(data.values())
+        elif isinstance(data, pd.DataFrame):
+            items, freqs = self._gen_items_by_dataframe(data)
         else:
             raise NotImplementedError("Error: the freq_dict parameter should be a dict or dict filename!")
+        self._set_arrays(items, freqs)
+
+    def _set_arrays(self, items, freqs):
+        """Set the items and their frequencies (the items should be unique)."""
+        self._items = [sys.intern(e) if isinstance(e, str) else e for e in items]
+        self._item2id = {e: i for i, e in enumerate(self._items)}
+        freqs = np.asarray(freqs)
+        dtype = np.float64 if freqs.dtype.kind == 'f' and len(freqs) > 0 else np.int64
+        self._freqs = np.array(freqs, dtype=dtype).reshape(-1)
+        self._views = dict()
+
+    @classmethod
+    def _from_ids(cls, vocab, ids):
+        """Create a new Vocab from the items of the ids of another vocab."""
+        new = cls(encoding=vocab.encoding)
+        new._set_arrays([vocab._items[i] for i in ids], vocab.freqs[ids])
+        new.FILTERPRESENT = len(new._items) > 0
+        return new
 
     @staticmethod
-    def _gen_freq_dict_by_dataframe(dataframe):
+    def _gen_items_by_dataframe(dataframe):
         """
         This private class method takes a pandas.DataFrame as an input parameter,
-        and generate a frequency dictionary (frequency list) based on it.
+        and returns the item list and the frequency list of it.
         """
-        items, freqs = dataframe['item'].tolist(), dataframe['freq'].tolist()
-        freq_dict = {k: v for k, v in zip(items, freqs)}
-        return freq_dict
+        return dataframe['item'].tolist(), dataframe['freq'].values
 
     # ------- magic methods -------
     def __contains__(self, item):
-        return item in self.freq_dict
+        return item in self._item2id
 
     def __getitem__(self, arg):
         """Implement this magic method for Vocab class.
@@ -145,7 +236,7 @@ class Vocab(object):
 
         """
         if utils.is_string(arg):  # 'arg' is a str: e.g. vocab['argument/NN0']
-            return self.freq_dict[arg]
+            return self._freqs[self._item2id[arg]].item()
         elif isinstance(arg, list):  # vocab[]
             d = dict()
             if len(arg) > 0:
@@ -168,13 +259,18 @@ class Vocab(object):
             return d
         elif isinstance(arg, slice):  # 'arg' is a slice object
             # the slicing operation works on a 'frequency descending' sorted order
-            df = self.dataframe[arg]
-            return self.__class__(df, self.encoding)
+            ids = self._sorted_ids('freq', descending=True)[arg]
+            return self._from_ids(self, ids)
         else:
             raise NotImplementedError("Error: unimplemented type!")
 
     def __setitem__(self, key, value):
-        self.freq_dict[key] = value
+        idx = self._item2id.get(key)
+        if idx is None:
+            idx = self._add_item(key)
+        else:
+            self._changed()
+        self._set_freq(idx, value)
 
     def __getattr__(self, item):
         # slightly better using:
@@ -182,82 +278,118 @@ class Vocab(object):
         # so vocab.freq returns itself
         if item == 'freq':
             return self
+        raise AttributeError("'{}' object has no attribute '{}'".format(self.__class__.__name__, item))
 
-    def __lt__(self, arg):
+    def _compare(self, arg, op):
         if isinstance(arg, int) or isinstance(arg, float):
-            res = [k for k, v in self.freq_dict.items() if v < arg]
-            return res
+            return [self._items[i] for i in np.flatnonzero(op(self.freqs, arg))]
         else:
             raise NotImplementedError("Error: unimplemented type!")
 
+    def __lt__(self, arg):
+        return self._compare(arg, operator.lt)
+
     def __le__(self, arg):
-        if isinstance(arg, int) or isinstance(arg, float):
-            return [k for k, v in self.freq_dict.items() if v <= arg]
-        else:
-            raise NotImplementedError("Error: unimplemented type!")
+        return self._compare(arg, operator.le)
 
     def __eq__(self, arg):
         if isinstance(arg, int) or isinstance(arg, float):
-            return [k for k, v in self.freq_dict.items() if v == arg]
+            return self._compare(arg, operator.eq)
 
     def __gt__(self, arg):
-        if isinstance(arg, int) or isinstance(arg, float):
-            return [k for k, v in self.freq_dict.items() if v > arg]
-        else:
-            raise NotImplementedError("Error: unimplemented type!")
+        return self._compare(arg, operator.gt)
 
     def __ge__(self, arg):
-        if isinstance(arg, int) or isinstance(arg, float):
-            return [k for k, v in self.freq_dict.items() if v >= arg]
-        else:
-            raise NotImplementedError("Error: unimplemented type!")
+        return self._compare(arg, operator.ge)
 
     def __len__(self):
-        return len(self.freq_dict.keys())
+        return len(self._items)
 
     def _select_by_items(self, items):
         """Select a sub vocab by a list of items."""
-        items_set = set(items)
-        d = {k: v for k, v in self.freq_dict.items() if k in items_set}
-        return self.__class__(d, self.encoding)
+        ids = self.get_ids(list(set(items)))
+        return self._from_ids(self, np.sort(ids[ids >= 0]))
 
     def _select_by_freqs(self, freqs):
         """Select a sub vocab by a set of frequencies."""
-        freqs_set = set(freqs)
-        d = {k: v for k, v in self.freq_dict.items() if v in freqs_set}
-        return self.__class__(d, self.encoding)
+        ids = np.flatnonzero(np.isin(self.freqs, list(set(freqs))))
+        return self._from_ids(self, ids)
 
     # ------- basic methods -------
     def keys(self):
-        return list(self.freq_dict.keys())
+        return list(self._items)
 
     def values(self):
-        return list(self.freq_dict.values())
+        return self.freqs.tolist()
 
     def items(self):
         """Same as Python dict.items()"""
-        return list(self.freq_dict.items())
+        return list(zip(self._items, self.freqs.tolist()))
 
     def get_dict(self):
         # for safety, return a new object
-        return deepcopy(self.freq_dict)
+        return dict(zip(self._items, self.freqs.tolist()))
 
     def isEmpty(self):
-        return True if self.freq_dict is None or len(self.freq_dict.keys()) == 0 else False
+        return len(self._items) == 0
 
     def setFILTER(self, value):
         self.FILTERPRESENT = value
 
+    def _add_item(self, key):
+        """Add a new item (with frequency 0) and return its id."""
+        idx = len(self._items)
+        if idx >= len(self._freqs):  # grow the capacity of the frequency array
+            freqs = np.zeros(max(self.initsize, 2 * len(self._freqs)), dtype=self._freqs.dtype)
+            freqs[:idx] = self._freqs[:idx]
+            self._freqs = freqs
+        else:
+            self._freqs[idx] = 0
+        key = sys.intern(key) if isinstance(key, str) else key
+        self._items.append(key)
+        self._item2id[key] = idx
+        self._changed(newitem=True)
+        return idx
+
+    def _set_freq(self, idx, value, inc=False):
+        if self._freqs.dtype.kind != 'f' and isinstance(value, (float, np.floating)) and value != int(value):
+            self._freqs = self._freqs.astype(np.float64)
+        if inc:
+            self._freqs[idx] += value
+        else:
+            self._freqs[idx] = value
+
+    def _remove_item(self, key):
+        """Remove an item (KeyError if it is not in the vocab), the ids of the following items are shifted."""
+        idx = self._item2id[key]
+        ids = np.delete(np.arange(len(self._items)), idx)
+        self._set_arrays([self._items[i] for i in ids], self.freqs[ids])
+        self.FILTERPRESENT = len(self._items) > 0
+
     def increment(self, key, inc=1):
         """Increment the value of a key by 'inc'."""
-        if key in self.freq_dict:
-            self.freq_dict[key] += inc
-        else:
-            self.freq_dict[key] = inc
+        idx = self._item2id.get(key)
+        if idx is None:
+            idx = self._add_item(key)
+        elif self._views:
+            self._changed()
+        self._set_freq(idx, inc, inc=True)
+
+    def update(self, freqs):
+        """Increment the values of the keys of a dict (e.g. a Counter) at once."""
+        for key in freqs:
+            if key not in self._item2id:
+                self._add_item(key)
+        if len(freqs) > 0:
+            values = np.array(list(freqs.values()))
+            if values.dtype.kind == 'f' and self._freqs.dtype.kind != 'f':
+                self._freqs = self._freqs.astype(np.float64)
+            np.add.at(self._freqs, self.get_ids(list(freqs.keys())), values)
+            self._changed()
 
     def get_item_list(self, sorting='alpha', descending=False):
         """Get a sorted list of items based on a sorting order.
-        Calls utils.sort_dict().
+        The sorted views are cached until the vocab changes.
 
         Parameters
         ----------
@@ -272,8 +404,8 @@ class Vocab(object):
         list :
             sorted list of items in the vocabulary
         """
-        sorted_items = utils.sort_dict(self.freq_dict, sorting=sorting, descending=descending)
-        return sorted_items
+        items = self._items
+        return [items[i] for i in self._sorted_ids(sorting=sorting, descending=descending)]
 
     def select_items(self, word):
         """This method takes a word (or lemma) as input
@@ -283,12 +415,9 @@ class Vocab(object):
         If item is 'lemma/pos', then 'lemma' string should be provided.
         If item is 'word/pos', then 'word' string should be provided.
         """
-        new_freq_dict = dict()
-        for item, freq in iteritems(self.freq_dict):
-            # if the provided string equals to the corresponding part of an item
-            if word == item.rsplit('/', 1)[0]:
-                new_freq_dict[item] = freq
-        return self.__class__(new_freq_dict, encoding=self.encoding)
+        # if the provided string equals to the corresponding part of an item
+        ids = [i for i, item in enumerate(self._items) if word == item.rsplit('/', 1)[0]]
+        return self._from_ids(self, np.array(ids, dtype=np.int64))
 
     def make_type_file(self, type_list, out_fname, encoding='utf-8'):
         """This method could be used in the token level workflow
@@ -302,21 +431,23 @@ class Vocab(object):
         """
         type_dict = dict()
         for type_str in type_list:
-            if type_str in self.freq_dict:
-                freq = self.freq_dict[type_str]
-            else:
-                freq = 0
-            type_dict[type_str] = freq
+            idx = self._item2id.get(type_str)
+            type_dict[type_str] = 0 if idx is None else self._freqs[idx].item()
         utils.save_dict_json(type_dict, out_fname, encoding)
 
     def subvocab(self, items):
         """Select a sub vocab by a list of items.
         If an item is not in the vocab, its frequency is zero.
         """
-        sub_vocab = dict()
-        for it in items:
-            sub_vocab[it] = self.freq_dict.get(it, 0)
-        return self.__class__(sub_vocab)
+        items = list(dict.fromkeys(items))  # unique items, keep the order
+        ids = self.get_ids(items)
+        found = ids >= 0
+        freqs = np.zeros(len(items), dtype=self._freqs.dtype)
+        freqs[found] = self.freqs[ids[found]]
+        sub_vocab = self.__class__()
+        sub_vocab._set_arrays(items, freqs)
+        sub_vocab.FILTERPRESENT = len(items) > 0
+        return sub_vocab
 
     # ------- filter methods -------
     @staticmethod
@@ -339,9 +470,14 @@ class Vocab(object):
         -------
         list
         """
-        df = self.dataframe
-        df = df[df.apply(lambda x: self.regex_item(x[column_name], pattern), axis=1)][column_name]
-        return list(df)
+        regex = re.compile(pattern)
+        ids = self._sorted_ids('freq', descending=True)
+        if column_name == 'item':
+            return [self._items[i] for i in ids if regex.match(self._items[i])]
+        elif column_name == 'freq':
+            return [f for f in self.freqs[ids].tolist() if regex.match(str(f))]
+        else:
+            raise KeyError(column_name)
 
     def sum(self):
         """Get total sum of all frequencies.
@@ -351,29 +487,26 @@ class Vocab(object):
 
     def sum_freq(self):
         """Get total sum of all frequencies."""
-        return sum(self.freq_dict.values())
+        return self.freqs.sum().item()
 
     def equal(self, vocab2):
         """Check whether two vocabularies are equal."""
-        freq_dict1 = self.freq_dict
-        freq_dict2 = vocab2.freq_dict
-        '''
-        if len(freq_dict1.keys()) != len(freq_dict2.keys()):
+        if len(self) != len(vocab2):
             return False
-        for k in freq_dict1.keys():
-            if freq_dict1[k] != freq_dict2[k]:
-                return False
-        return True
-        '''
-        return freq_dict1 == freq_dict2  # Python dict can directly do this
+        ids = vocab2.get_ids(self._items)
+        return bool(np.all(ids >= 0)) and np.array_equal(self.freqs, vocab2.freqs[ids])
 
     def copy(self):
         """Just to have a better name for deepcopy()."""
         return self.deepcopy()
 
     def deepcopy(self):
-        new_dict = deepcopy(self.freq_dict)
-        return Vocab(new_dict, encoding=self.encoding)
+        new = Vocab(encoding=self.encoding)
+        new._items = list(self._items)
+        new._item2id = dict(self._item2id)
+        new._freqs = self.freqs.copy()
+        new.FILTERPRESENT = len(new._items) > 0
+        return new
 
     # ------- file methods -------
     def save(self, filename, encoding=None, fmt='json', verbose=True):
@@ -398,7 +531,7 @@ class Vocab(object):
         encoding = self.encoding if not encoding else encoding
         if verbose:
             logger.info("Saving frequency list (vocabulary)... (in '{}')".format(encoding))
-        args = (self.freq_dict, filename,)
+        args = (self.get_dict(), filename,)
         kwargs = {'encoding': encoding}
         func_dict = {
             'json': utils.save_dict_json,
@@ -449,17 +582,17 @@ class Vocab(object):
     def describe(self):
         """Give a description of Vocab."""
         # add information to the result of self.dataframe.describe()
-        basic_des = "Total items: {}\nTotal freqs: {}".format(len(self.freq_dict.keys()), self.sum_freq())
+        basic_des = "Total items: {}\nTotal freqs: {}".format(len(self), self.sum_freq())
         description = str(self.dataframe.describe()).split('\n')[1:]
         description.insert(0, basic_des)
         return '\n'.join(description)
 
     def __repr__(self):
         # TODO: if in Python2, the 'str' type might decode item as ASCII code, then raises error
-        items = self.freq_dict.items()
+        items = self.items()
         if len(items) <= 7:
             return '[{}]'.format(','.join(map(str, items)))
-        items = sorted(items, key=operator.itemgetter(1), reverse=True)
+        items = [(self._items[i], self._freqs[i].item()) for i in self._sorted_ids('freq', descending=True)]
         return '[{} ... {}]'.format(','.join(map(str, items[:3])),
                                     ','.join(map(str, items[-3:])))
 
@@ -492,7 +625,7 @@ class Vocab(object):
 
         for sw in specif_words:
             wd = word2apps[sw]
-            val = self.freq_dict.get(sw, 0)
+            val = self[sw] if sw in self else 0
             if val == 0:
                 wd.selected = set()
                 wd.n_sel = 0
@@ -513,3 +646,34 @@ class Vocab(object):
             wd.n_found = 0
 
         return word2apps
+
+
+class FreqDictView(MutableMapping):
+    """Live item -> frequency mapping of a :class:`Vocab` (its `freq_dict`).
+    The lookups use the item -> id index and the frequency array of the vocab, without copying them,
+    and the changes (setting or deleting an item) are made in the vocab.
+    """
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def __getitem__(self, item):
+        vocab = self.vocab
+        return vocab._freqs[vocab._item2id[item]].item()
+
+    def __setitem__(self, item, value):
+        self.vocab[item] = value
+
+    def __delitem__(self, item):
+        self.vocab._remove_item(item)
+
+    def __contains__(self, item):
+        return item in self.vocab._item2id
+
+    def __iter__(self):
+        return iter(self.vocab._items)
+
+    def __len__(self):
+        return len(self.vocab._items)
+
+    def __repr__(self):
+        return repr(self.vocab.get_dict())
@@ -33,30 +33,38 @@ Initialize a vocabulary with a Python dict e.g.
 
 import codecs
 import datetime
+import hashlib
 import json
 import logging
 import math
 import operator
 import os
+import shutil
+import tempfile
 from collections import defaultdict
-from copy import deepcopy
 from multiprocessing import cpu_count, Pool
 
 import numpy as np
 import scipy.cluster.hierarchy as sch
-from scipy.spatial.distance import squareform
+import scipy.sparse as sp
 from sklearn.metrics.pairwise import cosine_similarity
 
 from nephosem import progbar
-from nephosem.core.matrix import TypeTokenMatrix
-from nephosem.specutils.mxcalc import calc_association, calc_distance
+from nephosem.core.matrix import TypeTokenMatrix, MMX_EXT
+from nephosem.specutils.mxcalc import calc_association, calc_distance, iter_cosine_blocks, BLOCKSIZE
+from nephosem.specutils import mxutils
 from nephosem.specutils.mxutils import centroid_of_cluster, sum_of_cluster
-from nephosem.utils import make_dir, clean_dir
+from nephosem.utils import make_dir
 
 __all__ = ['CBC']
 
 logger = logging.getLogger(__name__)
 
+# files of a run directory of `CBC.cluster()`
+PARAMS_FNAME = 'params.json'
+RECURSION_FNAME = 'recursion.{:04d}.npz'
+MATRIX_NAMES = ('freqmx', 'measmx', 'distmx')
+
 
 class CBC(object):
 
@@ -64,7 +72,7 @@ class CBC(object):
                  k=100, theta1=0.35, theta2=0.25,
                  prune_method='distance', t='median',
                  score_metric='without_size', highest_score=False,
-                 num_iter=1000, workers=-1):
+                 num_iter=1000, workers=-1, copy=True):
         """Cluster by Committee.
 
         Parameters
@@ -111,6 +119,9 @@ class CBC(object):
             Number of iterations, default 1,000.
             If the number of iterations is larger than `num_iter`, then the algorithm stops.
         workers
+        copy : bool, optional
+            Copy the matrices, default True.
+            (Matrices memory-mapped by `CBC.load()` are not copied.)
 
         Returns
         -------
@@ -131,9 +142,9 @@ class CBC(object):
             print("done.")
 
         self.elements = elements
-        self.freqmx = freqmx.copy()
-        self.measmx = measmx.copy()
-        self.distmx = distmx.copy()
+        self.freqmx = freqmx.copy() if copy else freqmx
+        self.measmx = measmx.copy() if copy else measmx
+        self.distmx = distmx.copy() if copy else distmx
 
         self.k = k
         self.theta1 = theta1
@@ -145,9 +156,45 @@ class CBC(object):
         self.num_iter = num_iter
         self.workers = workers if workers > 0 else cpu_count() - 1
 
-    def cluster(self, num_eles=-1, multicore=True):
+    @property
+    def params(self):
+        """Parameters of the clustering, which are saved in the run directory of `cluster()`."""
+        return {
+            'k': self.k, 'theta1': self.theta1, 'theta2': self.theta2,
+            'prune_method': self.prune_method, 't': self.t,
+            'score_metric': self.score_metric, 'highest_score': self.highest_score,
+        }
+
+    @classmethod
+    def load(cls, rundir, mmap=True):
+        """Load a CBC object from the run directory of `cluster()`,
+        i.e. to resume a run without recomputing the matrices.
+
+        Parameters
+        ----------
+        rundir : str
+        mmap : bool, optional
+            Memory-map the matrices (read-only), default True.
+
+        Returns
+        -------
+        :class:`~nephosem.CBC`
+        """
+        params = load_run_params(rundir)
+        matrices = {}
+        for name in MATRIX_NAMES:
+            fname = os.path.join(rundir, '{}{}'.format(name, MMX_EXT))
+            matrices[name] = TypeTokenMatrix.load_container(fname, mmap=mmap)
+        return cls(params.pop('elements'), copy=False, **matrices, **params['cbc'])
+
+    def cluster(self, num_eles=-1, multicore=True, rundir=None, resume=True):
         """Main method of Cluster by Committee.
 
+        The committees and residues of each recursion are saved in the run directory
+        (see `save_recursion()`), together with the parameters and the matrices of the run.
+        If `rundir` already has finished recursions (of the same elements, parameters and matrices,
+        see `matrix_fingerprint()`), the run continues after the last one.
+
         Parameters
         ----------
         num_eles : int, optional
@@ -156,6 +203,12 @@ class CBC(object):
         multicore : bool, optional
             Use multicore method or not.
             Default True.
+        rundir : str, optional
+            Run directory, default a new directory '~/.cbc/res.<timestamp>.xxxxxxxx'.
+            The matrices saved in the default directory are removed when the run has finished.
+        resume : bool, optional
+            Resume from the last finished recursion in `rundir`, default True.
+            If False, the previous recursions and matrices in `rundir` are replaced.
 
         Returns
         -------
@@ -175,48 +228,86 @@ class CBC(object):
         residues = self.elements[:num_eles] if num_eles > 0 else self.elements[:]
         Cs, Rs = [], []  # -> a list of committees and residues of each recursion
 
-        # create tmp folder for multicore methods
-        tmpdir = os.path.join(os.path.expanduser('~'), '.cbc')
-        make_dir(tmpdir)
-
-        i = 1
-        while i <= self.num_iter and len(residues) > 0:
+        tmprun = rundir is None
+        if tmprun:
+            tmpdir = os.path.join(os.path.expanduser('~'), '.cbc')
+            make_dir(tmpdir)
+            # the timestamp is only for readability, the folder is unique for each run
+            rundir = tempfile.mkdtemp(prefix='res.{}.'.format(datetime.datetime.now().strftime("%Y.%m.%d.%H.%M")),
+                                      dir=tmpdir)
+        make_dir(rundir)
+        params = {'elements': self.elements, 'num_eles': num_eles, 'cbc': self.params,
+                  'matrices': {name: matrix_fingerprint(getattr(self, name)) for name in MATRIX_NAMES}}
+        resumed = resume and os.path.exists(os.path.join(rundir, PARAMS_FNAME))
+        if resumed:
+            if load_run_params(rundir) != json.loads(json.dumps(params)):
+                raise ValueError("Cannot resume the run in '{}', it has other elements, parameters or matrices!"
+                                 .format(rundir))
+            Cs, Rs = load_recursions(rundir, self.elements)
+            logger.info("Resuming after {} finished recursions in '{}'".format(len(Cs), rundir))
+        else:
+            remove_recursions(rundir)
+            save_run_params(rundir, params)
+        # the (expensive) matrices are saved with the run, so a resumed run does not compute them again
+        # and the workers of step 1 share the memory-mappable distance matrix of the run directory
+        for name in MATRIX_NAMES:
+            fname = os.path.join(rundir, '{}{}'.format(name, MMX_EXT))
+            if resumed and os.path.isdir(fname):
+                continue  # the same matrix (see the fingerprints of the parameters)
+            # remove the container of a previous run (the matrix may be memory-mapped from it)
+            shutil.rmtree(fname, ignore_errors=True)
+            getattr(self, name).save_container(fname, verbose=False)
+        distmx_fname = os.path.join(rundir, 'distmx{}'.format(MMX_EXT))
+
+        # the last finished recursion may have been the last one
+        finished = is_last_recursion(([residues] + Rs)[-2], Rs[-1], Cs[-1]) if Rs else False
+        residues = Rs[-1] if Rs else residues
+        i = len(Cs) + 1
+        while not finished and i <= self.num_iter and len(residues) > 0:
             separator = '-' * 33
             logger.info("{}\nRECURSION {}: {} elements".format(separator, i, len(residues)))
             try:
-                curC, curR = major_steps(self, eles=residues, multicore=multicore)
-            except Exception as err:
-                logger.exception(err)
-                curC, curR = [], []
+                curC, curR = major_steps(self, eles=residues, multicore=multicore, distmx_fname=distmx_fname)
+            except Exception:
+                logger.error("Recursion {} failed, the previous recursions are saved in '{}'".format(i, rundir))
+                raise
 
             Cs.append(curC)
             Rs.append(curR)
+            save_recursion(rundir, i, curC, curR, self.elements)
 
-            # stop when there is only a few residues left
-            if len(curR) <= 2:
-                logger.info("Less than three residues left! Just return!")
-                return Cs, Rs
-            # if the residues got from this recursion are the same as elements of this recursion
-            # then no new committees found in this recursion
-            if len(curR) == len(residues):
-                logger.info("No new committee anymore!")
-                return Cs, Rs
+            finished = is_last_recursion(residues, curR, curC)
             residues = curR
-
             i += 1
 
-        restmpdir = os.path.join(tmpdir, 'res.{}'.format(datetime.datetime.now().strftime("%Y.%m.%d.%H.%M")))
-        make_dir(restmpdir)
-        try:
-            save_committees_json(restmpdir, Cs)
-            save_residues_json(restmpdir, Rs)
-        except Exception as err:
-            logger.exception(err)
+        save_committees_json(rundir, Cs)
+        save_residues_json(rundir, Rs)
+        if tmprun:
+            for name in MATRIX_NAMES:
+                shutil.rmtree(os.path.join(rundir, '{}{}'.format(name, MMX_EXT)), ignore_errors=True)
 
         return Cs, Rs
 
 
-def major_steps(cbc, eles=None, multicore=True):
+def is_last_recursion(eles, residues, comms):
+    """Check whether the clustering stops after a recursion of `eles` which found `comms` and left `residues`."""
+    # no committee found (e.g. only singletons in step 1), the next recursion would be the same
+    if len(comms) == 0:
+        logger.info("No committee found in this recursion!")
+        return True
+    # stop when there is only a few residues left
+    if len(residues) <= 2:
+        logger.info("Less than three residues left! Just return!")
+        return True
+    # if the residues got from this recursion are the same as elements of this recursion
+    # then no new committees found in this recursion
+    if len(residues) == len(eles):
+        logger.info("No new committee anymore!")
+        return True
+    return False
+
+
+def major_steps(cbc, eles=None, multicore=True, distmx_fname=None):
     """Major steps of modification of phase II of Cluster by Committee.
     Step 1: cluster top-k similar elements of each target element.
     Step 2: clean clusters and merge similar ones.
@@ -230,6 +321,8 @@ def major_steps(cbc, eles=None, multicore=True):
         A list of elements to be clustered.
         In later recursions, `eles` are residues.
     multicore
+    distmx_fname : str, optional
+        Container of the distance matrix shared by the workers of all recursions (see `cbc_step1_multicore()`).
 
     Returns
     -------
@@ -238,31 +331,36 @@ def major_steps(cbc, eles=None, multicore=True):
     """
     if eles is None:  # if not passed, use
         eles = cbc.elements
-    # in later recursions use submatrix of residues to speed up
-    # and we have to, because the similar elements of a residue are fetched from all residues
-    freqmx = cbc.freqmx.submatrix(row=eles) if cbc.elements != eles else cbc.freqmx
-    measmx = cbc.measmx.submatrix(row=eles) if cbc.elements != eles else cbc.measmx
-    distmx = cbc.distmx.submatrix(row=eles, col=eles) if cbc.elements != eles else cbc.distmx
+    # the residues are only indices into the matrices of the whole run:
+    # the similar elements of a residue are fetched from the columns of the residues in step 1,
+    # and the committee vectors are summed over the rows of the residues in step 2
+    # so no (dense) submatrix is copied in any recursion
+    rowids = cbc.freqmx.row_index.indices(eles)
+    freqmx = cbc.freqmx.matrix
+    # the only copy: the sparse rows of the residues, used in step 2 and step 3
+    measmx = cbc.measmx.matrix[cbc.measmx.row_index.indices(eles)]
 
     # step 1
     logger.info("\nstep 1 ...")
     num_workers = cpu_count() - 1
     args = (eles,)
     kwargs = {
-        'distmx': distmx, 'k': cbc.k,
+        'distmx': cbc.distmx, 'k': cbc.k,
         'prune_method': cbc.prune_method, 't': cbc.t,
         'score_metric': cbc.score_metric,
+        'candidates': eles if cbc.elements != eles else None,
     }
     if multicore and len(eles) > num_workers:
         # use multicore version when the number of elements is large ( > number of cpu cores)
-        L = cbc_step1_multicore(*args, **kwargs)
+        L = cbc_step1_multicore(*args, distmx_fname=distmx_fname, **kwargs)
     else:
         L = cbc_step1_single(*args, **kwargs)
     logger.info("get {} clusters".format(len(L)))
 
     # step 2
     logger.info("\nstep 2 ...")
-    curC, commx = cbc_step2(L, elements=eles, freqmx=freqmx.matrix.toarray(), ppmimx=measmx.matrix.toarray(), theta=cbc.theta1)
+    commvecs = CommitteeVectors(freqmx, rows=rowids)
+    curC, commx = cbc_step2(L, elements=eles, ppmimx=measmx, theta=cbc.theta1, commvecs=commvecs)
     if len(curC) == 0:
         return [], eles
     logger.info("after reducing, remain {} clusters".format(len(curC)))
@@ -275,8 +373,7 @@ def major_steps(cbc, eles=None, multicore=True):
     logger.info("step 3 ...")
     # Only in first recursion, the elements are the elements to be clustered
     # in later recursions, the elements are residues of last recursion
-    ppmimx = measmx.matrix.toarray()
-    R, comms = cbc_step3(eles, measmx=ppmimx, comms=curC, commx=commx, theta=cbc.theta2)
+    R, comms = cbc_step3(eles, measmx=measmx, comms=curC, commx=commx, theta=cbc.theta2)
     logger.info("number of residues: {}".format(len(R)))
 
     # NOTE: the returned current Cluster should be items not ids
@@ -289,106 +386,90 @@ def major_steps(cbc, eles=None, multicore=True):
 
 def cbc_step1_multicore(elements, distmx=None, k=100,
                         prune_method='distance', t='median',
-                        score_metric='without_size', highest_score=False):
+                        score_metric='without_size', highest_score=False,
+                        candidates=None, distmx_fname=None):
+    """Multicore version of `cbc_step1_single()`.
+    The distance matrix is saved once into a memory-mappable container (see
+    :meth:`~nephosem.TypeTokenMatrix.save_container`) inside a temporary folder of this run:
+        ~/.cbc/step1.xxxxxxxx/distmx.mmx
+    Every worker process opens it read-only by memory mapping (see `_attach_distmx()`),
+    so the pages of the matrix are shared by all workers instead of being copied into each of them.
+    The clusters found by the workers are returned through the pool, and the folder is removed at the end.
+
+    If `distmx_fname` is given, it is the container of `distmx` which has already been saved
+    (i.e. once for all recursions of :meth:`CBC.cluster`), and it is used as is.
     """
-    ~/.cbc/.10933/
-                 /L/  : folder for temporary L(s)
-                 /distmx.meta
-                 /distmx.npy
-    """
-    homedir = os.path.expanduser('~')
-    tmpdir = os.path.join(homedir, '.cbc', '{}'.format(datetime.datetime.now().strftime("%Y.%m.%d.%H.%M")))
-    make_dir(tmpdir)
-    clean_dir(tmpdir)
-    L_tmpdir = os.path.join(tmpdir, 'L')
-    make_dir(L_tmpdir)
-    clean_dir(L_tmpdir)
-    distmx_fname = os.path.join(tmpdir, 'distmx')
-    distmx.save(distmx_fname, pack=False)
-
-    num_cores = cpu_count() - 1
-    num_eles = len(elements)
-    data_group = [[] for _ in range(num_cores)]
-    for i in range(num_eles):
-        idx = i % num_cores
-        data_group[idx].append(elements[i])
-
-    pool = Pool(processes=num_cores)
-    for i in range(num_cores):
-        args = (data_group[i], tmpdir,)
+    cbcdir = os.path.join(os.path.expanduser('~'), '.cbc')
+    make_dir(cbcdir)
+    tmpdir = tempfile.mkdtemp(prefix='step1.', dir=cbcdir)  # unique for each run
+    try:
+        if distmx_fname is None:
+            distmx_fname = os.path.join(tmpdir, 'distmx{}'.format(MMX_EXT))
+            distmx.save_container(distmx_fname, verbose=False)
+
+        num_cores = max(cpu_count() - 1, 1)
+        num_eles = len(elements)
+        data_group = [[] for _ in range(num_cores)]
+        for i in range(num_eles):
+            idx = i % num_cores
+            data_group[idx].append(elements[i])
+
+        pool = Pool(processes=num_cores, initializer=_attach_distmx, initargs=(distmx_fname,))
         kwargs = {
             'k': k,
             'prune_method': prune_method, 't': t,
             'score_metric': score_metric, 'highest_score': highest_score,
+            'candidates': candidates,
         }
-        try:
-            pool.apply_async(cbc_step1_call, args=args, kwds=kwargs)
-        except Exception as err:
-            logger.exception("Error:", err)
-    pool.close()
-    pool.join()
-
-    # merge results
-    L = []
-    for fname in os.listdir(L_tmpdir):
-        fname = os.path.join(L_tmpdir, fname)
-        # load json results of sub-processes L(s)
-        with codecs.open(fname, 'r') as inf:
-            procL = json.load(inf)
-        L.extend(procL)
-        os.remove(fname)
-    try:
-        os.remove(distmx_fname + '.meta')
-        os.remove(distmx_fname + '.npy')
-        os.rmdir(L_tmpdir)
-        os.rmdir(tmpdir)
-    except Exception as err:
-        logger.exception("clean tmp folder error: {}".format(err))
+        results = [pool.apply_async(cbc_step1_call, args=(data_group[i],), kwds=kwargs)
+                   for i in range(num_cores)]
+        pool.close()
+
+        # merge results
+        L = []
+        for res in results:
+            try:
+                L.extend(res.get())
+            except Exception as err:
+                logger.exception("Error: {}".format(err))
+        pool.join()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
     return L
 
 
-def cbc_step1_call(elements, tmpdir_proc, k=100,
+_step1_distmx = None  # distance matrix of the worker processes of `cbc_step1_multicore()`
+
+
+def _attach_distmx(fname):
+    """Initializer of the worker processes of `cbc_step1_multicore()`:
+    open the (memory-mapped) distance matrix container once per process.
+    """
+    global _step1_distmx
+    _step1_distmx = TypeTokenMatrix.load_container(fname, mmap=True)
+
+
+def cbc_step1_call(elements, k=100,
                    prune_method='distance', t='median',
-                   score_metric='without_size', highest_score=False):
+                   score_metric='without_size', highest_score=False, candidates=None):
+    """Worker function of `cbc_step1_multicore()`, clustering the elements
+    with the distance matrix attached by `_attach_distmx()`.
+    """
     pid = os.getpid()
-    # print(pid, len(elements), tmpdir_proc, k, prune_method, t, score_metric, highest_score)
-    # load distance matrix inside tmp directory
-    tmp_distmx_fname = os.path.join(tmpdir_proc, 'distmx')
-    try:
-        distmx = TypeTokenMatrix.load(tmp_distmx_fname, pack=False)
-    except Exception as err:
-        logger.exception("Matrix load error: ".format(err))
+    distmx = _step1_distmx
+    if distmx is None:
+        logger.error("No distance matrix attached to subprocess {}!".format(pid))
         return []
     logger.info("Starting subprocess {}...".format(pid))
 
-    L = []
     if k < 1:
-        k = int(k * distmx.shape[0])
-
-    for e in progbar(elements):
-        try:
-            args = (e,)
-            kwargs = {
-                'distmx': distmx, 'k': k,
-                'prune_method': prune_method, 't': t,
-                'score_metric': score_metric, 'highest_score': highest_score,
-            }
-            clusters = cluster_similar_elements(*args, **kwargs)
-            # print(clusters)
-        except Exception as err:
-            clusters = []
-            logger.exception("Cannot find highest scoring cluster for element: {}\nError: {}".format(e, err))
-        L.extend(clusters)
-
-    tmp_proc_fname = os.path.join(tmpdir_proc, 'L', '{}'.format(pid))
-    with codecs.open(tmp_proc_fname, 'w') as outf:
-        json.dump(L, outf, ensure_ascii=False, indent=4)
-
-    return L
+        k = int(k * (distmx.shape[0] if candidates is None else len(candidates)))
+    return _step1_clusters(elements, distmx, k=k, prune_method=prune_method, t=t,
+                           score_metric=score_metric, highest_score=highest_score, candidates=candidates)
 
 
 def cbc_step1_single(elements, distmx=None, k=100, prune_method='distance', t='median',
-                     score_metric='without_size', highest_score=False, score_func=None):
+                     score_metric='without_size', highest_score=False, score_func=None, candidates=None):
     """Get a list of highest-scoring clusters for each element.
     For each element e, cluster the top similar elements of e from S using average-lin clustering.
     For each discovered cluster c, compute the |c| x avgsim(c) score.
@@ -423,30 +504,45 @@ def cbc_step1_single(elements, distmx=None, k=100, prune_method='distance', t='m
     score_func : function
         A function to perform on a cluster of elements.
         Basically two parameters are considered: average similarity of the cluster and the size of it.
+    candidates : list of str, optional
+        Elements among which the similar elements are searched, i.e. the residues in later recursions.
+        Default all rows of `distmx`.
 
     """
-    L = []
     if k < 1:
-        k = int(k * distmx.shape[0])
-
-    for e in progbar(elements):
-        try:
-            args = (e,)
-            kwargs = {
-                'distmx': distmx, 'k': k,
-                'prune_method': prune_method, 't': t,
-                'score_metric': score_metric, 'highest_score': highest_score, 'score_func': score_func,
-            }
-            clusters = cluster_similar_elements(*args, **kwargs)
-        except Exception as err:
-            clusters = []
-            logger.exception("Cannot find highest scoring cluster for elements: {}\nError: {}".format(e, err))
-        L.extend(clusters)
+        k = int(k * (distmx.shape[0] if candidates is None else len(candidates)))
+    return _step1_clusters(elements, distmx, k=k, prune_method=prune_method, t=t,
+                           score_metric=score_metric, highest_score=highest_score, score_func=score_func,
+                           candidates=candidates)
 
+
+def _step1_clusters(elements, distmx, candidates=None, **kwargs):
+    """Cluster the similar elements of each element by `cluster_neighborhoods()`
+    and transform the indices of the clusters into items.
+
+    Returns
+    -------
+    L : list
+        [ (score, cluster (list of items)) ... ]
+    """
+    item2rowid = distmx.item2rowid
+    rowids = []
+    for e in elements:
+        if e in item2rowid:
+            rowids.append(item2rowid[e])
+        else:
+            logger.error("Cannot find element {} in the distance matrix!".format(e))
+    cols = None if candidates is None else distmx.row_index.indices(candidates)
+
+    row_items = distmx.row_items
+    L = []
+    clusters_iter = cluster_neighborhoods(rowids, distmx.matrix, cols=cols, **kwargs)
+    for _rid, clusters in progbar(clusters_iter, total=len(rowids)):
+        L.extend((s, [row_items[i] for i in c]) for s, c in clusters)
     return L
 
 
-def cbc_step2(L, elements=None, freqmx=None, ppmimx=None, theta=0.35):
+def cbc_step2(L, elements=None, freqmx=None, ppmimx=None, theta=0.35, commvecs=None, blocksize=BLOCKSIZE):
     """Cluster by Committee Step 2.
      - clean clusters (see `clean_clusters()`)
      - MERGE committees that are similar enough (theta1)
@@ -467,18 +563,22 @@ def cbc_step2(L, elements=None, freqmx=None, ppmimx=None, theta=0.35):
         [ (val, cluster) ... ], cluster is a list/set of ids.
     elements : iterable of str
         A list of element strings.
-    freqmx : numpy.ndarray
+    freqmx : numpy.ndarray or scipy.sparse.csr_matrix
         Raw co-occurrence frequency matrix.
-        Notes : passing scipy.spmatrix would raise error.
-    ppmimx : numpy.ndarray
+    ppmimx : numpy.ndarray or scipy.sparse.csr_matrix
         Association measure (ppmi) matrix.
     theta : float, optional
         theta1 parameter in the whole CBC algorithm.
+    commvecs : :class:`CommitteeVectors`, optional
+        Committee vectors of the elements, used instead of `freqmx`.
+    blocksize : int, optional
+        Number of rows of the similarity blocks computed at once (see `most_similar()`).
 
     Returns
     -------
     (mergecomms, mgsglcommx) : tuple
-        A tuple of merged (with singletons) committees (element strings) and committee matrix.
+        A tuple of merged (with singletons) committees (element strings)
+        and committee matrix (scipy.sparse.csr_matrix).
     """
     if not L or len(L) <= 0:
         return L
@@ -486,110 +586,158 @@ def cbc_step2(L, elements=None, freqmx=None, ppmimx=None, theta=0.35):
     # clean clusters
     committees, singletons = clean_clusters(L)
 
+    # the vectors of committees that are not changed by merging are only calculated once
+    if commvecs is None:
+        commvecs = CommitteeVectors(freqmx)
+    # no cluster of more than one element, so no committee in this recursion
+    if len(committees) == 0:
+        logger.info("no committee found")
+        return [], calc_committee_vectors([], commvecs=commvecs)
+
     # transform cluster elements from str to int
+    # the committees are sorted index arrays from now on
     e2id = {e: i for i, e in enumerate(elements)}
-    idxcomms = [sorted([e2id[e] for e in clust]) for s, clust in committees]
+    idxcomms = [np.unique([e2id[e] for e in clust]) for s, clust in committees]
 
     # calculate committee matrix
-    # estimated time cost: 90s (10000 X 10000 matrix)
     logger.info("calculating committee matrix...")
-    commx = calc_committee_vectors(idxcomms, freqmx=freqmx)
+    commx = calc_committee_vectors(idxcomms, commvecs=commvecs)
     logger.info("done...")
 
     # merge two similar committees
-    # calculate similarity matrix of the committee matrix
-    # estimated time cost : 90s (10000 X 10000 matrix)
-    simmx = cosine_similarity(commx)
-    mgcomms = get_merged_committee(simmx, theta=theta)
+    # the similarities between committees are calculated by blocks of rows of the committee matrix
+    mgcomms = get_merged_committee(commx=commx, theta=theta, blocksize=blocksize)
     # merge committees
-    mergecomms = []
-    for i, j in mgcomms:
-        lcomm = set(idxcomms[i])
-        rcomm = set(idxcomms[j]) if j >= 0 else set()
-        mergecomms.append(sorted(lcomm | rcomm))
-    # mergecomms = [sorted(set(idxcomms[i]) | set(idxcomms[j])) for i, j in mgcomms]
+    mergecomms = [np.union1d(idxcomms[i], idxcomms[j]) if j >= 0 else idxcomms[i] for i, j in mgcomms]
     logger.info("num of merged committees: {}".format(len(mergecomms)))
 
     # re-calculate committee matrix
     logger.info("calculating committee matrix...")
-    mgcommx = calc_committee_vectors(mergecomms, freqmx=freqmx)
+    mgcommx = calc_committee_vectors(mergecomms, commvecs=commvecs)
     logger.info("done...")
 
     if len(singletons) > 0:
-        # calculate similarity matrix between singletons and committees
-        sglidx = sorted([e2id[e] for e in singletons])
-        sglmx = ppmimx[sglidx]
-        # pair-wise similarity between singletons and committees
+        # calculate similarity between singletons and committees
+        sglidx = np.unique([e2id[e] for e in singletons])
         logger.info("calculating cosine similarity between singletons and committees..")
-        sglsimmx = cosine_similarity(sglmx, mgcommx)
+        maxidx, maxsim = most_similar(ppmimx[sglidx], mgcommx, blocksize=blocksize)
         logger.info("done...")
 
         # merge singleton with most-similar committee
         logger.info("merging singletons with committees...")
-        maxidx = np.argmax(sglsimmx, axis=1)
-        for i in range(len(sglidx)):
-            sid = sglidx[i]
-            cid = maxidx[i]
-            if sglsimmx[i, cid] >= theta:
-                mergecomms[cid].append(sid)
+        merged = maxsim >= theta
+        for cid, sids in group_by_committee(sglidx[merged], maxidx[merged], len(mergecomms)):
+            mergecomms[cid] = np.union1d(mergecomms[cid], sids)
         logger.info("done...")
 
-    mergecomms = [sorted(clust) for clust in mergecomms]
     # re-calculate committee matrix
     logger.info("calculating committee matrix...")
-    mgsglcommx = calc_committee_vectors(mergecomms, freqmx=freqmx)
+    mgsglcommx = calc_committee_vectors(mergecomms, commvecs=commvecs)
     logger.info("done...")
     mergecomms = [[elements[i] for i in clust] for clust in mergecomms]
     return mergecomms, mgsglcommx
 
 
-def get_merged_committee(simmx, theta=0.35):
+def get_merged_committee(simmx=None, theta=0.35, commx=None, blocksize=BLOCKSIZE):
     """Find committee index pairs that could be merged, based on committee matrix.
+    Each committee (that has not been merged yet) is merged with its most similar later committee
+    that has not been merged yet, if their similarity >= theta.
 
     Parameters
     ----------
-    simmx : numpy.ndarray
+    simmx : numpy.ndarray, optional
         Committee similarity matrix
     theta : float
         Threshold for comparing similarity
+    commx : numpy.ndarray or scipy.sparse.csr_matrix, optional
+        Committee matrix, used when `simmx` is not given.
+        The similarities are then calculated by blocks of `blocksize` rows (see `iter_cosine_blocks()`).
+    blocksize : int, optional
 
     Returns
     -------
     mergecomms : iterable of tuples
         A list of merged committee index pairs.
     """
-    mergecomms = []  # -> a list of two committee indices that are merged
-    merged = set()  # -> record merged committee indices
+    if simmx is not None:
+        n = simmx.shape[0]
+        blocks = ((start, np.asarray(simmx[start:start + blocksize])) for start in range(0, n, blocksize))
+    else:
+        n = commx.shape[0]
+        blocks = iter_cosine_blocks(commx, commx, blocksize=blocksize)
 
-    # calculate sorted indices of similarity matrix
-    sortsimmx = np.argsort(simmx)
+    mergecomms = []  # -> a list of two committee indices that are merged
+    merged = np.zeros(n, dtype=bool)  # -> record merged committee indices
     # merge two most-similar committees that are similar enough (theta1)
     # Notes : just once as the committee size is small
-    for i in range(simmx.shape[0]):
-        # if committee i has been merged previously, skip it
-        if i in merged:
-            continue
-        # get the most similar committee of current one
-        sortidx = sortsimmx[i]
-        # iterate over the indices from the largest one
-        idx = -1
-        for j in range(-2, -(sortidx.shape[0]), -1):
-            tmpidx = sortidx[j]
-            if tmpidx > i and tmpidx not in merged:
-                # if committee has not been processed
-                # and committee has not been merged
-                idx = tmpidx
-                break
-        # if the similarity >= theta1, merge them
-        if idx < 0 or simmx[i, idx] < theta:  # not found
-            mergecomms.append((i, -1))
-            continue
-        merged.add(idx)  # record 'most-similar' committee index
-        mergecomms.append((i, idx))  # merge committees 'i' and 'most-similar'
+    # the rows depend on the committees merged in previous rows, so they are processed in order
+    for start, block in blocks:
+        for r in range(block.shape[0]):
+            i = start + r
+            # if committee i has been merged previously, skip it
+            if merged[i]:
+                continue
+            # similarities with the later committees that have not been merged
+            sims = np.where(merged[i + 1:], -np.inf, block[r, i + 1:])
+            idx = int(np.argmax(sims)) if sims.size > 0 else -1
+            # if the similarity >= theta1, merge them
+            if idx < 0 or not sims[idx] >= theta:  # not found
+                mergecomms.append((i, -1))
+                continue
+            idx += i + 1
+            merged[idx] = True  # record 'most-similar' committee index
+            mergecomms.append((i, idx))  # merge committees 'i' and 'most-similar'
 
     return mergecomms
 
 
+def most_similar(measmx, commx, blocksize=BLOCKSIZE):
+    """Find the most (cosine) similar committee of each element.
+    The similarities are calculated by blocks of `blocksize` rows (elements), see `iter_cosine_blocks()`,
+    so the whole similarity matrix between elements and committees is never built.
+
+    Parameters
+    ----------
+    measmx : numpy.ndarray or scipy.sparse.csr_matrix
+        Association measure matrix of elements
+    commx : numpy.ndarray or scipy.sparse.csr_matrix
+        Committee matrix
+    blocksize : int, optional
+
+    Returns
+    -------
+    (maxidx, maxsim) : tuple of numpy.ndarray
+        Index of the most similar committee of each element and the similarity with it
+        (-1 and -inf when there is no committee).
+    """
+    n = measmx.shape[0]
+    maxidx = np.full(n, -1, dtype=np.int64)
+    maxsim = np.full(n, -np.inf)
+    if commx.shape[0] == 0:
+        return maxidx, maxsim
+    for start, block in iter_cosine_blocks(measmx, commx, blocksize=blocksize):
+        end = start + block.shape[0]
+        maxidx[start:end] = np.argmax(block, axis=1)
+        maxsim[start:end] = block[np.arange(block.shape[0]), maxidx[start:end]]
+    return maxidx, maxsim
+
+
+def group_by_committee(eles, commids, num_comms):
+    """Group elements (indices) by the committees they are assigned to.
+
+    Yields
+    ------
+    (cid, eles) : tuple
+        A committee index and the elements assigned to it (in their original order).
+    """
+    commids = np.asarray(commids, dtype=np.int64)
+    order = np.argsort(commids, kind='stable')
+    bounds = np.searchsorted(commids[order], np.arange(num_comms + 1))
+    for cid in range(num_comms):
+        if bounds[cid + 1] > bounds[cid]:
+            yield cid, np.asarray(eles)[order[bounds[cid]:bounds[cid + 1]]]
+
+
 def clean_clusters(L):
     """Clean clusters.
      - Sort L based on the first value (score of cluster) descending order.
@@ -701,7 +849,7 @@ def inverted_index(L):
     return invidx
 
 
-def calc_committee_vectors(committees, freqmx=None):
+def calc_committee_vectors(committees, freqmx=None, commvecs=None):
     """Calculate committee vectors based on raw co-occurrence frequency matrix.
     For each committee, calculate the centroid vector of the committee (cluster),
     based on the frequency vectors of the elements in committee.
@@ -712,30 +860,76 @@ def calc_committee_vectors(committees, freqmx=None):
     Parameters
     committee : iterable
         A list of committees (cluster list)
-    freqmx : numpy.ndarray
+    freqmx : numpy.ndarray or scipy.sparse.csr_matrix
         Raw co-occurrence frequency matrix.
-        Notes : passing scipy.spmatrix would raise error
+    commvecs : :class:`CommitteeVectors`, optional
+        Use (and fill) the cache of this object instead of `freqmx`.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Committee matrix, one (ppmi) row per committee.
     """
-    sum_all_vec = np.sum(freqmx, axis=0)  # row sum
-    size = len(committees)
-    commx = np.zeros((size, freqmx.shape[1]))  # -> committee matrix
+    if commvecs is None:
+        commvecs = CommitteeVectors(freqmx)
+    # the committee vectors are only nonzero where a committee has frequencies,
+    # so the committee matrix is sparse
+    indptr, indices, data = [0], [], []
+    for clust in progbar(committees):
+        cols, vals = commvecs[clust]
+        indices.append(cols)
+        data.append(vals)
+        indptr.append(indptr[-1] + len(cols))
+
+    shape = (len(committees), commvecs.shape[1])
+    if len(committees) == 0:
+        return sp.csr_matrix(shape)
+    return sp.csr_matrix((np.concatenate(data), np.concatenate(indices), np.array(indptr)), shape=shape)
+
+
+class CommitteeVectors(object):
+    """Committee (ppmi) vectors of the elements of a frequency matrix, see `calc_committee_vectors()`.
+
+    The rows of the elements are selected by indices, so the frequency matrix is neither copied
+    nor densified, and the vector of a committee is cached, as most of the committees of step 2
+    are not changed by merging.
 
-    # this part is time consuming
-    # for i, (maxv, clust) in progbar(enumerate(committees)):
-    for i, clust in progbar(enumerate(committees)):
-        if not isinstance(clust, list):
-            clust = sorted(clust)
-        # compute centroid vector
-        centroid_vec = centroid_of_cluster(freqmx, cluster=clust)
-        # sum the cluster vectors
-        sum_clust_vec = sum_of_cluster(freqmx, cluster=clust)
-        # collapse (sum) the rest vectors into one
-        sum_rest_vec = sum_all_vec - sum_clust_vec
-        # calculate (positive) pmi vector for cluster
-        ppmi_vec = calc_meas_vec(centroid_vec, sum_rest_vec)
-        commx[i] = ppmi_vec
+    Parameters
+    ----------
+    freqmx : numpy.ndarray or scipy.sparse.csr_matrix
+        Raw co-occurrence frequency matrix.
+    rows : numpy.ndarray, optional
+        Row indices of the elements (e.g. the residues of a recursion) in `freqmx`.
+        The committees are indices into `rows`. Default all rows of `freqmx`.
+    """
 
-    return commx
+    def __init__(self, freqmx, rows=None):
+        self.freqmx = freqmx
+        self.rows = np.arange(freqmx.shape[0]) if rows is None else np.asarray(rows, dtype=np.int64)
+        self.shape = (len(self.rows), freqmx.shape[1])
+        self.sum_all_vec = self.sum_of_rows(self.rows)  # row sum
+        self._cache = {}
+
+    def sum_of_rows(self, rows):
+        """Sum vector of the (global) rows of the frequency matrix."""
+        return np.asarray(self.freqmx[rows].sum(axis=0), dtype=np.float64).ravel()
+
+    def __getitem__(self, clust):
+        """Nonzero columns and values of the vector of a committee (element indices)."""
+        clust = np.unique(np.fromiter(clust, dtype=np.int64))
+        key = clust.tobytes()
+        if key not in self._cache:
+            # sum the cluster vectors
+            sum_clust_vec = self.sum_of_rows(self.rows[clust])
+            # compute centroid vector
+            centroid_vec = sum_clust_vec / len(clust)
+            # collapse (sum) the rest vectors into one
+            sum_rest_vec = self.sum_all_vec - sum_clust_vec
+            # calculate (positive) pmi vector for cluster
+            ppmi_vec = calc_meas_vec(centroid_vec, sum_rest_vec)
+            cols = np.flatnonzero(ppmi_vec)
+            self._cache[key] = (cols, ppmi_vec[cols])
+        return self._cache[key]
 
 
 def cbc_step3_old(L, freqmx=None, theta=0.35):
@@ -795,7 +989,7 @@ def cbc_step3_old(L, freqmx=None, theta=0.35):
     return C, commx
 
 
-def cbc_step3(elements, measmx=None, comms=None, commx=None, theta=0.25):
+def cbc_step3(elements, measmx=None, comms=None, commx=None, theta=0.25, blocksize=BLOCKSIZE):
     """Cluster by Committee Step 5.
     Use association measure vector to represent elements.
     For each element e, if e's similarity to every committee in C is below threshold theta (theta2),
@@ -807,40 +1001,37 @@ def cbc_step3(elements, measmx=None, comms=None, commx=None, theta=0.25):
     ----------
     elements : iterable (of str)
         A list of elements.
-    measmx : numpy.ndarray
+    measmx : numpy.ndarray or scipy.sparse.csr_matrix
         Association measure matrix of elements
     comms : iterable (of lists of str)
         Committee sets of elements
-    commx : numpy.ndarray
+    commx : numpy.ndarray or scipy.sparse.csr_matrix
         Committee matrix
     theta : float
         Default 0.25
+    blocksize : int, optional
+        Number of rows of the similarity blocks computed at once (see `most_similar()`).
 
     Returns
     -------
     (R, comms) : tuple
         A list of residues and a list of committees.
     """
-    R = []
-    comms = deepcopy(comms)
+    comms = [list(comm) for comm in comms]
     # calculate similarity between each element (represented by association measure vector)
-    # and each committee
+    # and its most similar committee
     logger.info("calculating similarity between elements and committees...")
-    simmx = cosine_similarity(measmx, commx)
-    maxidx = np.argmax(simmx, axis=1)  # max value index of each row
-
-    for i in progbar(range(simmx.shape[0])):
-        isresidue = True
-        for j in range(simmx.shape[1]):
-            if simmx[i, j] >= theta:  # if there is a similarity >= theta, it is not a residue
-                isresidue = False
-                break
-        e = elements[i]
-        if isresidue:
-            R.append(e)
-        else:
-            if e not in comms[maxidx[i]]:
-                comms[maxidx[i]].append(e)
+    maxidx, maxsim = most_similar(measmx, commx, blocksize=blocksize)
+
+    # if there is a similarity >= theta (i.e. the maximum one), it is not a residue
+    isresidue = ~(maxsim >= theta)
+    R = [elements[i] for i in np.flatnonzero(isresidue)]
+    # else, add it to the most similar committee (if it is not in the committee yet)
+    e2id = {e: i for i, e in enumerate(elements)}
+    assigned = np.flatnonzero(~isresidue)
+    for cid, eids in group_by_committee(assigned, maxidx[assigned], len(comms)):
+        commids = np.array([e2id[e] for e in comms[cid] if e in e2id], dtype=np.int64)
+        comms[cid].extend(elements[i] for i in np.setdiff1d(eids, commids, assume_unique=True))
     return R, comms
 
 
@@ -882,28 +1073,132 @@ def cluster_similar_elements(e, distmx=None, k=100,
         Notes : if ``highest`` is True, return only the cluster with highest score,
                 else, return all clusters.
     """
-    # get a sub matrix of k most similar elements
-    sim_eles = distmx.most_similar(e, k=k)
-    subdistmx = distmx.submatrix(row=sim_eles, col=sim_eles)
-    cdsubdistmx = squareform(subdistmx.matrix)  # -> condensed distance matrix
-
-    # hierarchically cluster the distance matrix and return all clusters of the last n levels
-    clusters = hierarchical_cluster(cdsubdistmx, prune_method=prune_method, t=t)
-    if len(clusters) == 0:
-        return []
+    distarr = distmx.matrix
+    rid = distmx.item2rowid[e]
+    # indices of the k most similar elements (see `TypeTokenMatrix.most_similar()`)
+    nbrs = mxutils.get_smallest_k(distarr[rid], k + 1)
+    clusters = _cluster_neighbors(rid, nbrs, distarr, prune_method=prune_method, t=t,
+                                  score_metric=score_metric, highest_score=highest_score, score_func=score_func)
+    return [(s, [distmx.row_items[i] for i in c]) for s, c in clusters]
+
+
+def cluster_neighborhoods(rowids, distarr, k=100,
+                          prune_method='distance', t='median',
+                          score_metric='without_size', highest_score=False, score_func=None,
+                          cols=None, batchsize=256):
+    """Batched kernel of step 1: cluster the k most similar elements of each row in `rowids`.
+    It gives the same clusters as `cluster_similar_elements()`, but works on integer indices only:
+    the neighbors of a batch of rows are selected at once, the distances among the neighbors of a row
+    are gathered from the distance array into a reused condensed buffer (see `_cluster_neighbors()`),
+    and the clusters are remapped to global indices through the neighbor index array.
 
-    # get highest score cluster among all clusters
-    subsimmx = 1.0 - cdsubdistmx  # transform to a similarity arrays
-    clusters_with_score = score_cluster(clusters, subsimmx, metric=score_metric, highest=highest_score, score_func=score_func)
+    Parameters
+    ----------
+    rowids : iterable of int
+        Row indices of the elements.
+    distarr : numpy.ndarray
+        Square distance array (i.e. `matrix` of a distance matrix), could be memory-mapped.
+    k : int
+        Number of most similar elements to cluster.
+    prune_method : str
+    t : int or float or str
+    score_metric : str
+    highest_score : bool
+    score_func : function
+        See `cluster_similar_elements()`.
+    cols : numpy.ndarray, optional
+        Indices of the candidate neighbors (i.e. the residues in later recursions), default all rows.
+        The neighbors are the same as in the square submatrix of these indices, but it is not copied.
+    batchsize : int
+        Number of rows whose neighbors are selected at once.
+
+    Yields
+    ------
+    (rowid, clusters) : tuple
+        clusters -> [ (score, list of row indices) ... ]
+        If the row cannot be clustered, the error is logged and the clusters are empty.
+    """
+    cols = np.arange(distarr.shape[0]) if cols is None else np.asarray(cols, dtype=np.int64)
+    n = len(cols)
+    allcols = n == distarr.shape[0] and np.array_equal(cols, np.arange(n))
+    rowids = np.asarray(rowids, dtype=np.int64)
+    buffers = {}
+    for start in range(0, len(rowids), batchsize):
+        batch = rowids[start:start + batchsize]
+        if k + 1 >= n:
+            nbrs = np.broadcast_to(cols, (len(batch), n))
+        else:
+            rows = np.asarray(distarr[batch]) if allcols else distarr[batch][:, cols]
+            nbrs = cols[np.argpartition(rows, k + 1, axis=1)[:, :k + 1]]
+        for rid, ids in zip(batch, nbrs):
+            try:
+                clusters = _cluster_neighbors(rid, ids, distarr, buffers=buffers, prune_method=prune_method, t=t,
+                                              score_metric=score_metric, highest_score=highest_score,
+                                              score_func=score_func)
+            except Exception as err:
+                clusters = []
+                logger.exception("Cannot find highest scoring cluster for row: {}\nError: {}".format(rid, err))
+            yield rid, clusters
+
+
+def _cluster_neighbors(rid, nbrs, distarr, buffers=None, prune_method='distance', t='median',
+                       score_metric='without_size', highest_score=False, score_func=None):
+    """Cluster the neighbors of a row (except for the row itself).
+
+    Parameters
+    ----------
+    rid : int
+    nbrs : numpy.ndarray
+        Row indices of the neighbors.
+    distarr : numpy.ndarray
+    buffers : dict, optional
+        Condensed buffers and their upper triangle indices by number of neighbors, reused between calls.
 
-    # item ids are all local ids in submatrix, so remap them to the large matrix
-    glbclusts = []
-    for s, c in clusters_with_score:
-        glbclust = sub2glb(c, subdistmx.row_items, distmx.row_items)
-        glbclust = [distmx.row_items[i] for i in glbclust]
-        glbclusts.append((s, glbclust))
+    Returns
+    -------
+    clusters : iterable
+        [ (score, list of row indices) ... ]
+    """
+    nbrs = nbrs[nbrs != rid]
+    size = len(nbrs)
+    buffers = {} if buffers is None else buffers
+    if size not in buffers:
+        buffers[size] = (np.empty(size * (size - 1) // 2, dtype=distarr.dtype), np.triu_indices(size, 1))
+    cdsubdistmx, (iu0, iu1) = buffers[size]  # -> condensed distance matrix of the neighbors
+    if distarr.flags.c_contiguous:
+        np.take(distarr.reshape(-1), nbrs[iu0] * distarr.shape[1] + nbrs[iu1], out=cdsubdistmx)
+    else:
+        cdsubdistmx[:] = distarr[nbrs[iu0], nbrs[iu1]]
+
+    # hierarchically cluster the distance matrix (see `hierarchical_cluster()`)
+    Z = sch.linkage(cdsubdistmx, method='average')
+    threshold = cut_threshold(Z, t=t, criterion=prune_method)
+    if threshold is None:
+        return []
+    clusts = cut_tree(Z, threshold)
+    # average similarities of all clusters at once (see `cluster_avgsim()`):
+    # sum the similarities of the pairs inside each cluster
+    _, first, inv, sizes = np.unique(clusts, return_index=True, return_inverse=True, return_counts=True)
+    subsimmx = 1.0 - cdsubdistmx  # transform to a similarity arrays
+    inside = inv[iu0] == inv[iu1]
+    sums = np.bincount(inv[iu0][inside], weights=subsimmx[inside], minlength=len(sizes))
+    numpairs = sizes * (sizes - 1) // 2
+    avgsims = np.divide(sums, numpairs, out=np.ones(len(sizes)), where=numpairs > 0).tolist()
+
+    # cluster index -> (global) indices of the elements, in the order of their first appearance
+    # the local ids of the neighbors are remapped to the whole array by the neighbor index array
+    glbids = nbrs[np.argsort(inv, kind='stable')].tolist()
+    ends = np.cumsum(sizes).tolist()
+    sizes = sizes.tolist()
+    clusters = defaultdict(list)
+    clustsims = {}
+    for c in np.argsort(first, kind='stable').tolist():
+        clusters[c] = glbids[ends[c] - sizes[c]:ends[c]]
+        clustsims[c] = avgsims[c]
 
-    return glbclusts
+    # get highest score cluster among all clusters
+    return score_cluster(clusters, subsimmx, metric=score_metric, highest=highest_score,
+                         score_func=score_func, clustsims=clustsims)
 
 
 def sub2glb(cluster, subitems, glbitems):
@@ -915,15 +1210,15 @@ def sub2glb(cluster, subitems, glbitems):
         A list of element indices as a cluster
     subitems : iterable
         Submatrix row items
-    glbitems : iterable
-        Global matrix row items
+    glbitems : iterable or dict
+        Global matrix row items, or their item -> index mapping (i.e. `item2rowid` of the global matrix)
 
     Returns
     -------
     global cluster : a list of element indices
     """
     cluster_items = [subitems[i] for i in cluster]  # sub-indices -> items
-    glbitem2id = {e: i for i, e in enumerate(glbitems)}
+    glbitem2id = glbitems if isinstance(glbitems, dict) else {e: i for i, e in enumerate(glbitems)}
     glb_cluster = [glbitem2id[it] for it in cluster_items]  # -> global indices of items
     return glb_cluster
 
@@ -997,6 +1292,35 @@ def flat_cluster(Z, t='median', criterion='distance', depth=2):
     """
     # hierarchical clustering based on distmx
     clusters = []
+    threshold = cut_threshold(Z, t=t, criterion=criterion)
+    if threshold is not None:
+        clusters = sch.fcluster(Z, threshold, criterion='distance')
+    '''
+    clusters = dict()
+    for i in range(1, len(Z)+1):
+        fcids = sch.fcluster(Z, i, criterion='maxclust')
+        level_clusters = reverse(fcids, i)
+        clusters.update(level_clusters)
+    '''
+    return clusters
+
+
+def cut_threshold(Z, t='median', criterion='distance'):
+    """Get the distance at which the hierarchical clustering tree is cut by `flat_cluster()`.
+
+    Parameters
+    ----------
+    Z : numpy.ndarray
+        The hierarchical clustering encoded as a linkage matrix.
+    t : float or int or str
+    criterion : str
+        See `flat_cluster()`.
+
+    Returns
+    -------
+    threshold : float or None if the criterion is not supported.
+    """
+    threshold = None
     if criterion == 'minsize':
         # Bottom-up the cluster tree, when there is a cluster who has more than k elements,
         # stop and draw a horizontal line to cut the higher merges.
@@ -1005,10 +1329,9 @@ def flat_cluster(Z, t='median', criterion='distance', depth=2):
             if count >= t:
                 threshold = dist
                 break
-        clusters = sch.fcluster(Z, threshold, criterion='distance')
     elif criterion == 'distance':
         if isinstance(t, str):
-            mergedist = np.array([d for _1, _2, d, _4 in Z])  # a list of merge distances
+            mergedist = Z[:, 2]  # merge distances
             if t == 'mean':
                 threshold = np.mean(mergedist)
             elif t == 'median':
@@ -1020,20 +1343,48 @@ def flat_cluster(Z, t='median', criterion='distance', depth=2):
                 raise NotImplementedError("Not implemented this threshold type!")
         else:
             threshold = t
-        clusters = sch.fcluster(Z, threshold, criterion='distance')
-    else:
-        pass
-    '''
-    clusters = dict()
-    for i in range(1, len(Z)+1):
-        fcids = sch.fcluster(Z, i, criterion='maxclust')
-        level_clusters = reverse(fcids, i)
-        clusters.update(level_clusters)
-    '''
-    return clusters
+    return threshold
 
 
-def score_cluster(clusters, simmx, metric='with_size', highest=False, score_func=None):
+def cut_tree(Z, threshold):
+    """Flat clusters of a linkage matrix cut at a distance,
+    i.e. the same partition as `scipy.cluster.hierarchy.fcluster(Z, threshold, criterion='distance')`
+    but without validating the linkage matrix. The cluster numbers may differ.
+
+    Parameters
+    ----------
+    Z : numpy.ndarray
+        The hierarchical clustering encoded as a linkage matrix.
+    threshold : float
+
+    Returns
+    -------
+    flat cluster : numpy.ndarray
+        An array of length n. T[i] is the flat cluster number to which original observation i belongs.
+    """
+    n = len(Z) + 1
+    children = Z[:, :2].astype(np.int64).tolist()
+    # max merge distance inside each subtree (as `scipy.cluster.hierarchy.maxdists()`)
+    maxdist = [-np.inf] * n
+    for (left, right), dist in zip(children, Z[:, 2].tolist()):
+        maxdist.append(max(dist, maxdist[left], maxdist[right]))
+    # top-down: a node forms a cluster when its subtree is below the threshold, but not its parent
+    clusts = [-1] * (2 * n - 1)
+    numclust = 0
+    if maxdist[-1] <= threshold:
+        clusts[-1] = numclust
+        numclust += 1
+    for node in range(2 * n - 2, n - 1, -1):
+        for child in children[node - n]:
+            if clusts[node] >= 0:
+                clusts[child] = clusts[node]
+            elif maxdist[child] <= threshold:
+                clusts[child] = numclust
+                numclust += 1
+    return np.array(clusts[:n], dtype=np.int64)
+
+
+def score_cluster(clusters, simmx, metric='with_size', highest=False, score_func=None, clustsims=None):
     """Return the cluster (representing by all element ids) which has the maximum score.
 
     Parameters
@@ -1056,10 +1407,13 @@ def score_cluster(clusters, simmx, metric='with_size', highest=False, score_func
                 return math.sqrt(size) * avgsim
 
             The effect of this function is the same as metric='with_size_sqrt'.
+    clustsims : dict, optional
+        Average similarities of the clusters, if they are already computed (see `cluster_avgsim()`).
 
     """
     cluster_scores = {}
-    clustsims = cluster_avgsim(clusters, simmx)
+    if clustsims is None:
+        clustsims = cluster_avgsim(clusters, simmx)
     maxc, maxs = -1, 0.0
     for cid, ids in clusters.items():
         if len(ids) == 1:  # skip single element
@@ -1166,16 +1520,12 @@ def calc_meas_vec(target_vec, rest_vec, meas='ppmi'):
     col_sum_vec = np.sum([target_vec, rest_vec], axis=0) / tot_sum
     norm_target_vec = target_vec / tot_sum
 
-    size = target_vec.shape[0]
     meas_vec = np.zeros(target_vec.shape[0])
-    for i in range(size):
-        if norm_target_vec[i] == 0:
-            x = 0.0
-        else:
-            x = norm_target_vec[i] / (row_sum * col_sum_vec[i])
-        pmi = math.log(x if x != 0.0 else 1.0)
-        if meas == 'ppmi':
-            meas_vec[i] = 0.0 if pmi < 0.0 else pmi
+    nonzero = np.flatnonzero(norm_target_vec)
+    x = norm_target_vec[nonzero] / (row_sum * col_sum_vec[nonzero])
+    pmi = np.log(np.where(x != 0.0, x, 1.0))
+    if meas == 'ppmi':
+        meas_vec[nonzero] = np.maximum(pmi, 0.0)
 
     return meas_vec
 
@@ -1202,6 +1552,88 @@ def reverse(fcids, lid):
     return clusters
 
 
+def save_run_params(rundir, params):
+    """Save the elements and parameters of a run (see `CBC.cluster()`)."""
+    with codecs.open(os.path.join(rundir, PARAMS_FNAME), 'w', encoding='utf-8') as fout:
+        json.dump(params, fout, ensure_ascii=False)
+
+
+def load_run_params(rundir):
+    """Load the elements and parameters of a run (see `CBC.cluster()`)."""
+    fname = os.path.join(rundir, PARAMS_FNAME)
+    if not os.path.exists(fname):
+        raise ValueError("No CBC run in '{}'!".format(rundir))
+    with codecs.open(fname, 'r', encoding='utf-8') as fin:
+        return json.load(fin)
+
+
+def matrix_fingerprint(mtx):
+    """Shape, items and checksum of a matrix, saved with the parameters of a run
+    to check that a resumed run has the same matrices.
+
+    Parameters
+    ----------
+    mtx : :class:`~nephosem.TypeTokenMatrix`
+
+    Returns
+    -------
+    dict
+    """
+    items = hashlib.sha1()
+    for its in (mtx.row_items, mtx.col_items):
+        items.update('\n'.join(its).encode('utf-8'))
+        items.update(b'\0')
+    checksum = hashlib.sha1()
+    if isinstance(mtx.matrix, sp.spmatrix):
+        csr = mtx.matrix.tocsr()
+        arrays = [csr.data, csr.indices, csr.indptr]
+    else:
+        arrays = [mtx.matrix]
+    for arr in arrays:
+        checksum.update(str(arr.dtype).encode('utf-8'))
+        checksum.update(np.ascontiguousarray(arr))
+    return {'shape': list(mtx.shape), 'items': items.hexdigest(), 'checksum': checksum.hexdigest()}
+
+
+def save_recursion(rundir, i, comms, residues, elements):
+    """Save the committees and residues of recursion `i` as element indices
+    in a compressed numpy file 'recursion.<i>.npz'.
+    The committees are concatenated, with the offsets of each committee in 'comm_offsets'.
+    """
+    e2id = {e: idx for idx, e in enumerate(elements)}
+    offsets = np.cumsum([0] + [len(comm) for comm in comms])
+    np.savez_compressed(os.path.join(rundir, RECURSION_FNAME.format(i)),
+                        comms=np.array([e2id[e] for comm in comms for e in comm], dtype=np.int64),
+                        comm_offsets=offsets.astype(np.int64),
+                        residues=np.array([e2id[e] for e in residues], dtype=np.int64))
+
+
+def load_recursions(rundir, elements):
+    """Load the committees and residues of all finished recursions, saved by `save_recursion()`.
+
+    Returns
+    -------
+    (Cs, Rs) : tuple
+    """
+    Cs, Rs = [], []
+    i = 1
+    while os.path.exists(os.path.join(rundir, RECURSION_FNAME.format(i))):
+        with np.load(os.path.join(rundir, RECURSION_FNAME.format(i))) as npz:
+            comms, offsets = npz['comms'], npz['comm_offsets']
+            Cs.append([[elements[e] for e in comms[offsets[j]:offsets[j + 1]]] for j in range(len(offsets) - 1)])
+            Rs.append([elements[e] for e in npz['residues']])
+        i += 1
+    return Cs, Rs
+
+
+def remove_recursions(rundir):
+    """Remove the saved recursions of a previous run."""
+    i = 1
+    while os.path.exists(os.path.join(rundir, RECURSION_FNAME.format(i))):
+        os.remove(os.path.join(rundir, RECURSION_FNAME.format(i)))
+        i += 1
+
+
 def save_committees_json(tmpdir, comms):
     C_fname = os.path.join(tmpdir, 'Cs')
     with codecs.open(C_fname, 'w') as fout:
@@ -21,9 +21,12 @@ import logging
 import multiprocessing as mp
 import os
 import threading
-from copy import deepcopy
+from copy import copy, deepcopy
 from collections import defaultdict
 
+import numpy as np
+import scipy.sparse as sp
+
 try:
     from queue import Queue
 except ImportError:
@@ -32,8 +35,9 @@ except ImportError:
 from nephosem import progbar, trange
 from nephosem.core.vocab import Vocab
 from nephosem.core.matrix import TypeTokenMatrix
-from nephosem.core.handler import BaseHandler
+from nephosem.core.handler import BaseHandler, job_filename, read_lines
 from nephosem.core.graph import SentenceGraph, MacroGraph
+from nephosem.specutils.deputils import target_anchors
 from nephosem.specutils import mxutils
 
 logger = logging.getLogger(__name__)
@@ -43,8 +47,26 @@ homedir = os.path.expanduser('~')
 class DepRelHandler(BaseHandler):
     """Handler Class for processing dependency relations"""
 
-    def __init__(self, settings, workers=0, targets=None, mode='type', features=None, **kwargs):
-        super(DepRelHandler, self).__init__(settings, workers=workers)
+    mergesize = 50000000  # max number of values waiting to be summed when merging the count shards
+
+    def __init__(self, settings, workers=0, targets=None, mode='type', features=None, keep_matches=False, **kwargs):
+        """
+        Parameters
+        ----------
+        settings : dict
+        workers : int
+        targets : list of str or :class:`~nephosem.core.vocab.Vocab`, optional
+            If provided, only the matches of these targets are counted.
+        mode : str
+            'type' or 'token'
+        keep_matches : bool
+            The matches are counted as (target, feature) pairs by the workers,
+            and only the counts are sent back (see :class:`DepRelCounter`).
+            If True, the matched nodes and edges are also kept in the attributes `matched_nodes`
+            and `matched_edges` of the macros, i.e. for inspecting the matches of tokens.
+            Default is False, because keeping all matches of a large corpus costs much memory.
+        """
+        super(DepRelHandler, self).__init__(settings, workers=workers, **kwargs)
         # you could make the program check only the targets and/or features you provide
         if targets is not None:
             if isinstance(targets, list):
@@ -56,6 +78,7 @@ class DepRelHandler(BaseHandler):
         else:
             self.targets = Vocab()
         self.mode = mode
+        self.keep_matches = keep_matches
         # normally, we don't set features previously
         self.macros = []
 
@@ -118,7 +141,13 @@ class DepRelHandler(BaseHandler):
 
         Returns
         -------
-        features : iterable of :class:`~nephosem.core.graph.TemplateGraph`
+        :class:`~nephosem.core.matrix.TypeTokenMatrix`
+            Frequency matrix of the targets (rows) and features (columns).
+
+        Raises
+        ------
+        ValueError
+            If no macro is matched in the corpus.
 
         Examples
         --------
@@ -138,14 +167,14 @@ class DepRelHandler(BaseHandler):
         """
         fnames = self.prepare_fnames(fnames)
         logger.info("Building dependency features...")
-        _res = self.process(fnames)
-
-        logger.info("Building matrix...")
-        self.freqMTX = self.build_matrix_by_matches()
+        freqMTX = self.process(fnames)
+        if freqMTX is None:
+            raise ValueError("No match of the macros is found in the corpus!")
+        self.freqMTX = freqMTX
         return self.freqMTX
 
     def build_matrix_by_matches(self):
-        """Build a frequency matrix by the matches."""
+        """Build a frequency matrix by the matches kept in the macros (see `keep_matches`)."""
         freq_dict = defaultdict(lambda: defaultdict(int))
         targets, contexts = set(), set()
         for macro in self.macros:
@@ -183,17 +212,18 @@ class DepRelHandler(BaseHandler):
             if job is None:
                 break
 
-            tally = self._do_process_job(job)
+            shard, macros = self._do_process_job(job)
             # Vocab object cannot be pickled, so we have to delete it from macro attributes
-            for macro in tally:
-                del macro.target_filter
-            res_queue.put(tally)
+            if macros is not None:
+                for macro in macros:
+                    del macro.target_filter
+            res_queue.put((shard, macros))
 
         logger.debug("worker exiting")
 
     def _do_process_job(self, fname, **kwargs):
         """Match every sentence in the file by calling `update_dep_rel()` function
-        and return the list of matched features.
+        and count the matched (target, feature) pairs.
 
         Parameters
         ----------
@@ -202,18 +232,23 @@ class DepRelHandler(BaseHandler):
 
         Returns
         -------
-        features : iterable
-            The matched features from sentences in the `fname` file.
+        tuple :
+            The count shard of the file (see `DepRelCounter.to_shard()`),
+            and the macros with the matches of the file if `keep_matches` is True, else None.
         """
-        macros = deepcopy(self.macros)
-        # when you provide targets to filter, add it to every macro
-        # speed up by matching target-feature pattern
-        # replace the target regular expression of patterns with the targets
-        if self.targets is not None:
-            for macro in macros:
-                macro.target_filter = self.targets.deepcopy()
-        self.update_dep_rel(fname, macros)
-        return macros
+        # the macros are not changed by matching (except for their matches),
+        # so shallow copies with empty match lists are enough
+        macros = []
+        for macro in self.macros:
+            macro = copy(macro)
+            macro.matched_nodes, macro.matched_edges = [], []
+            # when you provide targets to filter, add it to every macro
+            # it is only used for lookups, so it is shared
+            macro.target_filter = self.targets if len(self.targets) > 0 else None
+            macros.append(macro)
+        counter = DepRelCounter()
+        self.update_dep_rel(fname, macros, counter=counter)
+        return counter.to_shard(), (macros if self.keep_matches else None)
 
     def update_dep_rel(self, fname, macros, **kwargs):
         if self.mode == 'type':
@@ -223,7 +258,7 @@ class DepRelHandler(BaseHandler):
         else:
             raise ValueError("Not support this mode!")
 
-    def update_dep_rel_type(self, fname, macros, **kwargs):
+    def update_dep_rel_type(self, fname, macros, counter=None, **kwargs):
         """This is the real method that is used for processing!!!
         Procedures:
         1. read sentences from the corpus file
@@ -236,15 +271,10 @@ class DepRelHandler(BaseHandler):
         sentences = read_sentence(fname, formatter=self.formatter, encoding=self.input_encoding)
         for s in sentences:
             ss = SentenceGraph(sentence=s, formatter=self.formatter)
-            if ss.istree:
-                for macro in macros:
-                    ss.match_pattern(macro)
-            else:
-                rangetoks = [vid.get('lid') for v, vid in ss.nodes if vid.get('lid')]
-                logger.warning('Sentence in indices {} to {} of {} is not a tree.'.format(min(rangetoks), max(rangetoks), ss.fid))
+            self.match_sentence(ss, macros, counter=counter)
         return
 
-    def update_dep_rel_token(self, fname, macros, **kwargs):
+    def update_dep_rel_token(self, fname, macros, counter=None, **kwargs):
         """This is the real method that is used for processing!!!
         Procedures:
         1. read sentences from the corpus file
@@ -253,27 +283,142 @@ class DepRelHandler(BaseHandler):
             2.2 so the matching should be a target-feature matching
             2.3 this is a way of speeding up the process when the targets are provided
         """
-        basename = os.path.basename(fname).rsplit('.', 1)[0]  # for filename in token
+        basename = os.path.basename(job_filename(fname)).rsplit('.', 1)[0]  # for filename in token
         # read each sentence from the corpus file
         sentences = read_sentence(fname, formatter=self.formatter, encoding=self.input_encoding)
         for s in sentences:
             ss = SentenceGraph(sentence=s, formatter=self.formatter, fname=basename, mode=self.mode)
-            if ss.istree:
-                for macro in macros:
-                    ss.match_pattern(macro)
-            else:
-                rangetoks = [vid.get('lid') for v, vid in ss.nodes if vid.get('lid')]
-                logger.warning('Sentence in indices {} to {} of {} is not a tree.'.format(min(rangetoks), max(rangetoks), ss.fid))
+            self.match_sentence(ss, macros, counter=counter)
         return
 
+    def match_sentence(self, ss, macros, counter=None):
+        """Match a sentence with every macro.
+        When targets are provided, the sentence nodes of the target types are looked up first:
+        a sentence without any of them is skipped, otherwise the matching of a macro
+        starts from these nodes (see :func:`~nephosem.specutils.deputils.target_anchors`).
+
+        Parameters
+        ----------
+        ss : :class:`~nephosem.core.graph.SentenceGraph`
+        macros : iterable of :class:`~nephosem.core.graph.MacroGraph`
+        counter : :class:`DepRelCounter`, optional
+            If provided, the new matches are counted, and they are removed from the macros
+            unless `keep_matches` is True.
+        """
+        if not ss.istree:
+            rangetoks = [vid.get('lid') for v, vid in ss.nodes if vid.get('lid')]
+            logger.warning('Sentence in indices {} to {} of {} is not a tree.'.format(min(rangetoks), max(rangetoks), ss.fid))
+            return
+        if len(self.targets) > 0:
+            # macros with the same target attributes share the lookup
+            found = dict()
+            anchors = []
+            for macro in macros:
+                key = (macro.connector,) + tuple(macro.target_node_attrs)
+                if key not in found:
+                    found[key] = target_anchors(ss, macro, self.targets)
+                anchors.append(found[key])
+            if not any(anchors):
+                return
+        else:
+            anchors = [None] * len(macros)
+        for macro, anchs in zip(macros, anchors):
+            if anchs is None or len(anchs) > 0:
+                start = len(macro.matched_nodes)
+                ss.match_pattern(macro, anchors=anchs)
+                if counter is not None:
+                    counter.update(macro, start=start, mode=self.mode)
+                    if not self.keep_matches:
+                        del macro.matched_nodes[start:]
+                        del macro.matched_edges[start:]
+
     def _process_results(self, res_queue, n=0):
-        """Get all results (matched features) from result queue and merge them."""
+        """Get all results (count shards) from result queue and merge them into a frequency matrix.
+        If `keep_matches` is True, the matches of the files are also added to the macros.
+
+        Returns
+        -------
+        :class:`~nephosem.core.matrix.TypeTokenMatrix` or None if nothing is matched.
+        """
+        shards = []
         for _ in trange(n):
-            res = res_queue.get()
-            for i in range(len(res)):
-                feat = res[i]
-                self.macros[i].matched_nodes.extend(feat.matched_nodes)
-                self.macros[i].matched_edges.extend(feat.matched_edges)
+            shard, macros = res_queue.get()
+            if shard is not None:
+                shards.append(shard)
+            if macros is not None:
+                for i in range(len(macros)):
+                    feat = macros[i]
+                    self.macros[i].matched_nodes.extend(feat.matched_nodes)
+                    self.macros[i].matched_edges.extend(feat.matched_edges)
+        if len(shards) == 0:
+            return None
+
+        logger.info("Building matrix...")
+        spmx, targets, contexts = mxutils.merge_spmatrices(
+            [spmx for spmx, _, _ in shards], [trgts for _, trgts, _ in shards],
+            [feats for _, _, feats in shards], maxnnz=self.mergesize)
+        return TypeTokenMatrix(spmx, targets, contexts)
+
+
+class DepRelCounter(object):
+    """Sparse counter of the (target, feature) pairs of dependency matches.
+
+    The target and feature strings are mapped to integer ids in the order of their first appearance,
+    and the counts are kept in a dict of (target id, feature id) pairs.
+    So a worker only needs to send back a small count shard instead of all matches.
+
+    Attributes
+    ----------
+    target_items : list of str
+    feature_items : list of str
+    counts : dict
+        (target id, feature id) -> frequency
+    """
+
+    def __init__(self):
+        self.target_items = []
+        self.item2tid = {}
+        self.feature_items = []
+        self.item2fid = {}
+        self.counts = defaultdict(int)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, target, feature, n=1):
+        """Count a (target, feature) pair."""
+        tid = self.item2tid.get(target)
+        if tid is None:
+            tid = self.item2tid[target] = len(self.target_items)
+            self.target_items.append(target)
+        fid = self.item2fid.get(feature)
+        if fid is None:
+            fid = self.item2fid[feature] = len(self.feature_items)
+            self.feature_items.append(feature)
+        self.counts[(tid, fid)] += n
+
+    def update(self, macro, start=0, mode='type'):
+        """Count the matches of a macro from the index `start`."""
+        for i in range(start, len(macro.matched_nodes)):
+            self.add(macro.target(index=i, mode=mode), macro.feature(index=i))
+
+    def to_shard(self):
+        """Transform the counts into a sparse matrix.
+
+        Returns
+        -------
+        tuple or None if nothing has been counted :
+            (:class:`~scipy.sparse.csr_matrix`, target_items, feature_items)
+        """
+        if len(self.counts) == 0:
+            return None
+        n = len(self.counts)
+        row = np.fromiter((tid for tid, _ in self.counts), dtype=np.int64, count=n)
+        col = np.fromiter((fid for _, fid in self.counts), dtype=np.int64, count=n)
+        data = np.fromiter(self.counts.values(), dtype=np.int64, count=n)
+        shape = (len(self.target_items), len(self.feature_items))
+        spmx = sp.csr_matrix((data, (row, col)), shape=shape)
+        return spmx, self.target_items, self.feature_items
 
 
 def read_sentence(filename, formatter=None, encoding='utf-8'):
@@ -281,7 +426,7 @@ def read_sentence(filename, formatter=None, encoding='utf-8'):
 
     Parameters
     ----------
-    filename : str
+    filename : str or :class:`~nephosem.core.handler.FileShard`
     formatter : nephosem.CorpusFormatter
     encoding : str
         default 'utf-8'
@@ -290,18 +435,15 @@ def read_sentence(filename, formatter=None, encoding='utf-8'):
     -------
     generator of sentences (tuple(int, string))
     """
-    with codecs.open(filename, 'r', encoding=encoding) as fin:
-        sentence = []
-        lid = 0
-        for line in fin:
-            lid += 1
-            line = line.strip()
-            match = formatter.match_line(line)  # a valid line
-            if match:
-                sentence.append((lid, line))  # add line index
-            # if line.startswith(end_bound):  # end of a sentence
-            if formatter.separator_line_machine(line):
-                yield sentence
-                sentence = []
-        if len(sentence) > 0:  # if file does not end with a '</s' line
+    sentence = []
+    for lid, line in read_lines(filename, encoding=encoding):
+        line = line.strip()
+        match = formatter.match_line(line)  # a valid line
+        if match:
+            sentence.append((lid, line))  # add line index
+        # if line.startswith(end_bound):  # end of a sentence
+        if formatter.separator_line_machine(line):
             yield sentence
+            sentence = []
+    if len(sentence) > 0:  # if file does not end with a '</s' line
+        yield sentence
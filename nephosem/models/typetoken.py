@@ -44,12 +44,14 @@ Initialize a model with e.g.
 from __future__ import division
 
 import codecs
+import json
 import logging
 import os
 from collections import defaultdict
 from copy import deepcopy
 
 import numpy as np
+import scipy.sparse as sp
 import time
 
 try:
@@ -59,12 +61,11 @@ except ImportError:
 
 import nephosem
 from nephosem import trange
-from nephosem.core.terms import CorpusFormatter, TypeNode, ItemNode, TokenNode
+from nephosem.core.terms import CorpusFormatter, TypeNode, ItemNode, TokenNode, TokenStore
 from nephosem.core.vocab import Vocab
 from nephosem.core.matrix import TypeTokenMatrix
-from nephosem.core.handler import BaseHandler
+from nephosem.core.handler import BaseHandler, read_lines
 from nephosem.specutils import mxcalc, mxutils
-from nephosem.utils import count_values
 
 __all__ = ['ItemFreqHandler', 'ColFreqHandler', 'TokenHandler', 'TypeToken']
 
@@ -141,7 +142,7 @@ class ItemFreqHandler(BaseHandler):
         vocab = Vocab()
         # update_item_freq(vocab, fname, self.settings)
         self.update_one_file(fname, vocab)
-        return vocab.freq_dict
+        return vocab.get_dict()
 
     def update_one_file(self, filename, data, **kwargs):
         """Process lines in file (filename), and add frequencies to vocab.
@@ -155,15 +156,16 @@ class ItemFreqHandler(BaseHandler):
             The corpus file name to process
         """
         # return super(ItemFreqHandler, self).update_one_file(filename, data)
-        with codecs.open(filename, 'r', self.input_encoding) as fin:
-            for line in fin:
-                line = line.strip()  # in case there is a '\n'
-                match = self.formatter.match_line(line)
-                if match is None:
-                    continue
-                # when the current line is a normal (matche) line, draw the type string from the match object
-                item_str = self.formatter.get_type(match)
-                data.increment(item_str, 1)  # update the vocab
+        counts = defaultdict(int)  # count in a plain dict, then update the vocab at once
+        for _, line in read_lines(filename, self.input_encoding):
+            line = line.strip()  # in case there is a '\n'
+            match = self.formatter.match_line(line)
+            if match is None:
+                continue
+            # when the current line is a normal (matche) line, draw the type string from the match object
+            item_str = self.formatter.get_type(match)
+            counts[item_str] += 1
+        data.update(counts)  # update the vocab
 
     def _process_results(self, res_queue, n=0):
         """Get all results (frequency dicts) from result queue,
@@ -183,10 +185,49 @@ class ItemFreqHandler(BaseHandler):
 
 class ColFreqHandler(BaseHandler):
     tmpindicator = 'col.freq'
-    chunksize = 1000000
-
-    def __init__(self, settings, workers=0, row_vocab=None, col_vocab=None, **kwargs):
+    chunksize = 1000000  # max number of values (nnz) of the matrix kept by a worker
+    chunkbytes = None  # optional memory budget (in bytes) of the matrix kept by a worker
+    engines = ('dict', 'array')
+    nnzbytes = {'dict': 100, 'array': 24}  # approximate memory cost of one value by engine
+    linebytes = 16  # approximate minimal size (in bytes) of a corpus line holding a token
+    mergesize = 50000000  # max number of values waiting to be summed when merging the tmp matrices
+    mergebytes = None  # optional memory budget (in bytes) of the values waiting to be summed
+
+    def __init__(self, settings, workers=0, row_vocab=None, col_vocab=None, engine='dict', **kwargs):
+        """
+        Parameters
+        ----------
+        settings : dict
+        workers : int
+        row_vocab : :class:`~nephosem.Vocab`
+        col_vocab : :class:`~nephosem.Vocab`
+        engine : str
+            'dict' (default) counts co-occurrences in a nested dict of item strings.
+            'array' maps every corpus line to integer row/column ids once and counts
+            (row id, column id) pairs in NumPy buffers (see :class:`ColFreqCounter`).
+            Both engines produce the same matrix.
+        chunksize : int, optional
+            When the matrix kept by a worker has more values (nnz) than this number,
+            it is saved into a tmp file and the worker starts a new one.
+            Default is `ColFreqHandler.chunksize`. None or 0 means no limit.
+        chunkbytes : int, optional
+            Memory budget (in bytes) of the matrix kept by a worker,
+            it is transformed into a number of values by the cost of one value of the engine.
+            As the matrix is only checked between two jobs, the files are then split into shards
+            (see `job_shardsize`) unless `shardsize` is given.
+            Default is no budget.
+        mergesize : int, optional
+            When merging the tmp matrices of the workers, the values of the loaded matrices
+            are summed into the result when they exceed this number.
+            Default is `ColFreqHandler.mergesize`. None or 0 means all matrices are summed at once.
+        mergebytes : int, optional
+            Memory budget (in bytes) of the values waiting to be summed when merging.
+            Default is no budget.
+        """
         super(ColFreqHandler, self).__init__(settings, workers=workers, **kwargs)
+        if engine not in self.engines:
+            raise ValueError("Unsupported counting engine: {}".format(engine))
+        self.engine = engine
         # if the column vocab is given, then set self.nocolvocab to True
         self.row_vocab = row_vocab if row_vocab else Vocab()
         self.col_vocab = col_vocab if col_vocab else Vocab()
@@ -195,6 +236,37 @@ class ColFreqHandler(BaseHandler):
     def nocolvocab(self):
         return True if len(self.col_vocab) == 0 else False
 
+    @property
+    def merge_limit(self):
+        """The number of loaded values above which they are summed into the merged matrix."""
+        limit = self.mergesize if self.mergesize else None
+        if self.mergebytes:
+            # (row, col, value) triplet and its sorted copy
+            nbytes = self.mergebytes // 32
+            limit = min(limit, nbytes) if limit else nbytes
+        return limit
+
+    @property
+    def chunk_limit(self):
+        """The number of values of the matrix of a worker above which it is saved into a tmp file."""
+        limit = self.chunksize if self.chunksize else np.inf
+        if self.chunkbytes:
+            limit = min(limit, self.chunkbytes // self.nnzbytes[self.engine])
+        return limit
+
+    @property
+    def job_shardsize(self):
+        """The size (in bytes) of the file shards.
+        When a memory budget (`chunkbytes`) is given without `shardsize`, the files are split into
+        shards adding at most `chunk_limit` values to the matrix of a worker: every line
+        (of at least `linebytes` bytes) adds at most 'left-span' + 'right-span' values.
+        So the matrix of a worker never exceeds about twice the budget.
+        """
+        if self.shardsize or not self.chunkbytes:
+            return self.shardsize
+        span = max(self.settings['left-span'] + self.settings['right-span'], 1)
+        return max(int(self.chunk_limit // span) * self.linebytes, self.linebytes)
+
     def build_col_freq(self, fnames=None, row_vocab=None, col_vocab=None):
         """The function will treat all different word types as possible target or context words.
 
@@ -229,20 +301,19 @@ class ColFreqHandler(BaseHandler):
         """The worker loop method when the column vocab is provided.
         First we create an empty matrix dict for representing the co-occurrence matrix.
         Then we get one filename from the job_queue and process it by `_do_process_job()`.
-        Every time we processed a file, we put an indicator -1 into the res_queue.
-        After processed many files, when the number of values (co-occurrence pairs) reaches a pre-set number chunksize,
+        The number of values (co-occurrence pairs) of the matrix dict is tallied while it is updated.
+        After processing a file, when this number exceeds the limit `chunk_limit`,
         the matrix (transformed from the matrix dict and the provided row and col items) would be saved into a tmp file.
         We put this tmp filename into the res_queue.
         Every time we save the matrix, we reset it into empty.
         """
         # 1. prepare variables
-        i = 0  # the indicator of the job/res queue
-        chunk = 0  # the number of values of the co-occurrence matrix (of these file chunks)
+        i = 0  # the index of the tmp files of this worker
+        limit = self.chunk_limit
         row_items = self.row_vocab.get_item_list()  # item list of the row vocab
         col_items = self.col_vocab.get_item_list()  # item list of the col vocab
-        mtx_dict = defaultdict(lambda: defaultdict(int))  # nested dict for the co-occurrence matrix
+        mtx_dict = self.new_mtx_dict()  # nested dict for the co-occurrence matrix
 
-        first = True  # used for skipping the first result when showing the progress bar
         while True:
             # 2. this part is the same as the framework `Paralleler._worker_loop()`
             job = job_queue.get()
@@ -251,87 +322,52 @@ class ColFreqHandler(BaseHandler):
             self._do_process_job(job, mtx_dict=mtx_dict)
 
             # 3. for different tasks, one could add extra data processing part
-            chunk = count_values(mtx_dict)
-#             if chunk > self.chunksize:
-#                 # transform the matrix dict to a TypeTokenMatrix object
-#                 submtx = self.dict2matrix(mtx_dict, row_items, col_items)
-#                 # save the matrix object of current chunk to a temporary file
-#                 tmp_fname = "{}/sub.{}".format(self.subtmpdir, i)
-#                 submtx.save(tmp_fname, pack=False, verbose=False)
-#                 logger.debug("Saved the tmp matrix into {} at {}".format(tmp_fname, time.ctime()))
-#                 # put the temporary file name to result queue
-#                 res_queue.put(tmp_fname)
-#                 print(tmp_fname)
-
-#                 # reset parameters
-#                 mtx_dict = defaultdict(lambda: defaultdict(int))
-#                 i += 1; chunk = 0
-#             elif first:
-#                 # do not put the first indicator to the result queue
-#                 first = False
-#             else:
-#                 # put -1 to the result queue as the indicator for the progress bar
-#                 res_queue.put(-1)
+            if self.nnz > limit:
+                # transform the matrix dict to a TypeTokenMatrix object and save it
+                self._save_chunk(self.dict2matrix(mtx_dict, row_items, col_items), i, res_queue)
+                # reset the matrix dict
+                mtx_dict = self.new_mtx_dict()
+                i += 1
 
         # for the last chunk
-        if chunk > 0:
-            submtx = self.dict2matrix(mtx_dict, row_items, col_items)
-            tmp_fname = "{}/sub.{}".format(self.subtmpdir, i)
-            submtx.save(tmp_fname, pack=False, verbose=False)
-            logger.debug("Saved the tmp matrix into {} at {}".format(tmp_fname, time.ctime()))
-            res_queue.put(tmp_fname)
-            del mtx_dict
-            i += 1; chunk = 0
-        else:
-            # as we skip the first one, so for the last chunk, we send an extra indicator
+        if self.nnz > 0:
+            self._save_chunk(self.dict2matrix(mtx_dict, row_items, col_items), i, res_queue)
+        elif i == 0:
+            # nothing has been counted by this worker, send an indicator
             res_queue.put(-1)
+        del mtx_dict
 
     def _worker_loop_without_colvocab(self, job_queue, res_queue):
-        """The worker loop method when the column vocab is not provided."""
-        i = 0; chunk = 0
+        """The worker loop method when the column vocab is not provided.
+        The column items of each saved matrix are the collocates of its chunk (`chunk_col_vocab`).
+        """
+        i = 0
+        limit = self.chunk_limit
         row_items = self.row_vocab.get_item_list()
-        col_items = None  # generate later by the chunk_col_vocab
         self.chunk_col_vocab = Vocab()  # emtpy vocab for current chunk
-        mtx_dict = defaultdict(lambda: defaultdict(int))
+        mtx_dict = self.new_mtx_dict()
 
-#         first = True
         while True:
             job = job_queue.get()
             if job is None:
                 break
             self._do_process_job(job, mtx_dict=mtx_dict)
 
-            chunk = count_values(mtx_dict)
-            logger.debug("Size of chunk at process {} is {} at {}".format(self.pid, chunk, time.ctime()))
-#             if chunk > self.chunksize:
-#                 col_items = self.chunk_col_vocab.get_item_list()  # column item list of current chunk
-#                 submtx = self.dict2matrix(mtx_dict, row_items, col_items)
-#                 tmp_fname = "{}/sub.{}".format(self.subtmpdir, i)
-#                 submtx.save(tmp_fname, pack=False, verbose=False)
-#                 logger.debug("Saved the tmp matrix into {} at {}".format(tmp_fname, time.ctime()))
-#                 res_queue.put(tmp_fname)
-
-#                 mtx_dict = defaultdict(lambda: defaultdict(int))
-#                 self.chunk_col_vocab = Vocab()
-#                 i += 1; chunk = 0
-#             elif first:
-#                 first = False
-#             else:
-#                 res_queue.put(-1)
-
-        if chunk > 0:
+            logger.debug("Size of chunk at process {} is {} at {}".format(self.pid, self.nnz, time.ctime()))
+            if self.nnz > limit:
+                col_items = self.chunk_col_vocab.get_item_list()  # column item list of current chunk
+                self._save_chunk(self.dict2matrix(mtx_dict, row_items, col_items), i, res_queue)
+                mtx_dict = self.new_mtx_dict()
+                self.chunk_col_vocab = Vocab()
+                i += 1
+
+        if self.nnz > 0:
             col_items = self.chunk_col_vocab.get_item_list()
-            submtx = self.dict2matrix(mtx_dict, row_items, col_items)
-            tmp_fname = "{}/sub.{}".format(self.subtmpdir, i)
-            submtx.save(tmp_fname, pack=False, verbose=False)
-            logger.debug("Saved the tmp matrix into {} at {}".format(tmp_fname, time.ctime()))
-            res_queue.put(tmp_fname)
-            
-            del mtx_dict
-            self.chunk_col_vocab = Vocab()
-            i += 1; chunk = 0
-#         else:
-#             res_queue.put(-1)
+            self._save_chunk(self.dict2matrix(mtx_dict, row_items, col_items), i, res_queue)
+        elif i == 0:
+            res_queue.put(-1)
+        del mtx_dict
+        self.chunk_col_vocab = Vocab()
 
     def _worker_loop(self, job_queue, res_queue):
         """Worker loop function which gets one by one job from the job queue.
@@ -342,14 +378,72 @@ class ColFreqHandler(BaseHandler):
         job_queue : Queue
             A queue of job objects for worker function.
         """
+        if self.engine == 'array':
+            self._worker_loop_array(job_queue, res_queue)
         # if the column vocab is not provided
-        if self.nocolvocab:
+        elif self.nocolvocab:
             self._worker_loop_without_colvocab(job_queue, res_queue)
         else:
             self._worker_loop_with_colvocab(job_queue, res_queue)
         logger.debug("worker exiting")
 
-    def _do_process_job(self, fname, mtx_dict=None):
+    def _worker_loop_array(self, job_queue, res_queue):
+        """The worker loop method of the 'array' engine.
+        All files of this worker are counted by one :class:`ColFreqCounter`,
+        which is transformed into a matrix and saved into a tmp file at the end.
+        """
+        i = 0
+        limit = self.chunk_limit
+        counter = self.make_counter()
+        while True:
+            job = job_queue.get()
+            if job is None:
+                break
+            self._do_process_job(job, counter=counter)
+            if counter.nnz > limit:
+                self._save_chunk(counter.to_matrix(), i, res_queue)
+                counter.reset()
+                i += 1
+
+        submtx = counter.to_matrix()
+        if submtx is not None:
+            self._save_chunk(submtx, i, res_queue)
+        elif i == 0:
+            res_queue.put(-1)
+
+    def _save_chunk(self, submtx, i, res_queue):
+        """Save the matrix of a chunk into the i-th tmp file of this worker
+        and put the tmp filename into the res_queue.
+        """
+        tmp_fname = "{}/sub.{}".format(self.subtmpdir, i)
+        submtx.save(tmp_fname, pack=False, verbose=False)
+        logger.debug("Saved the tmp matrix into {} at {}".format(tmp_fname, time.ctime()))
+        res_queue.put(tmp_fname)
+
+    def new_mtx_dict(self):
+        """Create an empty nested dict for the co-occurrence matrix.
+        The number of its values is tallied in `self.nnz` when new (row, column) pairs are added,
+        so that it does not have to be counted again after every file.
+        """
+        self.nnz = 0
+
+        def new_value():
+            self.nnz += 1
+            return 0
+
+        return defaultdict(lambda: defaultdict(new_value))
+
+    def make_counter(self):
+        """Create an empty :class:`ColFreqCounter` based on the row and column vocabularies."""
+        row_items = self.row_vocab.get_item_list()
+        col_items = None if self.nocolvocab else self.col_vocab.get_item_list()
+        return ColFreqCounter(row_items, col_items=col_items,
+                              lspan=self.settings['left-span'], rspan=self.settings['right-span'])
+
+    def _do_process_job(self, fname, mtx_dict=None, counter=None):
+        if counter is not None:
+            self.update_one_file_array(fname, counter)
+            return
         col_vocab = self.col_vocab if not self.nocolvocab else self.chunk_col_vocab
         matrix = (mtx_dict, self.row_vocab, col_vocab)
         # update_col_freq(fname, matrix=matrix, settings=self.settings)
@@ -358,6 +452,29 @@ class ColFreqHandler(BaseHandler):
     def update_one_file(self, filename, data, **kwargs):
         return super(ColFreqHandler, self).update_one_file(filename, data)
 
+    def update_one_file_array(self, filename, counter):
+        """Process lines in file (filename) with the 'array' engine.
+        Every matched line is transformed into a (row id, column id) pair only once,
+        the windows are processed later by the counter in batches.
+
+        Parameters
+        ----------
+        filename : str
+            The corpus file name to process
+        counter : :class:`ColFreqCounter`
+        """
+        formatter = self.formatter
+        for _, line in read_lines(filename, self.input_encoding):
+            line = line.strip()
+            match = formatter.match_line(line)
+            if match is None:
+                if formatter.separator_line_machine(line):
+                    counter.end_block()
+            else:
+                counter.append(formatter.get_type(match), formatter.get_colloc(match))
+        counter.end_block()
+        counter.flush()
+
     def update_one_match(self, matrix, win, lid=0, **kwargs):
         """Update co-occurrence frequency matrix with current window.
 
@@ -446,31 +563,55 @@ class ColFreqHandler(BaseHandler):
             self.update_one_match(matrix, win)
 
     def _process_results(self, res_queue, n=0, **kwargs):
-        resmtx = None  # final matrix
-        # get results from queue
-        #while not res_queue.empty():
-        for _ in trange(res_queue.qsize()): # for the process bar, although it grows very quick and then sooo sloooow
+        """Merge the tmp matrices (shards) saved by the workers.
+        First the item lists of all shards are read from their meta files
+        and united into global row and column item lists.
+        Then the shards are loaded one by one, their indices are remapped to the global indices,
+        and their values are summed in batches of at most `merge_limit` values.
+        """
+        fnames = []
+        for _ in range(res_queue.qsize()):
             res = res_queue.get()
             # when data in res_queue is a tmp file name
             if isinstance(res, str):
-                mtx = TypeTokenMatrix.load(res, pack=False)
-                logger.debug("Retrieved file from {} at {}".format(res, time.ctime()))
-                if not resmtx:
-                    resmtx = mtx
-                else:
-                    resmtx = mxutils.merge_two_matrices(resmtx, mtx)
-                # remove temporary files (*.meta, *.npz)
-                try:
-                    os.remove('{}.{}'.format(res, 'meta'))
-                    os.remove('{}.{}'.format(res, 'npz'))
-                    parentdir = os.path.dirname(res)
-                    if len(os.listdir(parentdir)) == 0:
-                        os.rmdir(parentdir)
-                except Exception as err:
-                    logger.exception("Cannot remove *.meta or *.npz tmp files.\n{}".format(err))
+                fnames.append(res)
             # else: the indicator -1, do nothing
+        if len(fnames) == 0:
+            return None
+
+        shard_items = [self._read_shard_items(fname) for fname in fnames]
+
+        def load_shards():
+            for i in trange(len(fnames)):
+                mtx = TypeTokenMatrix.load(fnames[i], pack=False)
+                logger.debug("Retrieved file from {} at {}".format(fnames[i], time.ctime()))
+                yield mtx.matrix
+                del mtx
+                self._remove_shard(fnames[i])
 
-        return resmtx
+        spmx, row_items, col_items = mxutils.merge_spmatrices(
+            load_shards(), [items[0] for items in shard_items], [items[1] for items in shard_items],
+            maxnnz=self.merge_limit)
+        return TypeTokenMatrix(spmx, row_items, col_items, deep=False)
+
+    @staticmethod
+    def _read_shard_items(fname, encoding='utf-8'):
+        """Read the row items and column items of a tmp matrix from its meta file."""
+        with codecs.open('{}.meta'.format(fname), 'r', encoding) as inf:
+            meta_data = json.load(inf)
+        return meta_data['row_items'], meta_data['col_items']
+
+    @staticmethod
+    def _remove_shard(fname):
+        """Remove the temporary files (*.meta, *.npz) of a tmp matrix."""
+        try:
+            os.remove('{}.{}'.format(fname, 'meta'))
+            os.remove('{}.{}'.format(fname, 'npz'))
+            parentdir = os.path.dirname(fname)
+            if len(os.listdir(parentdir)) == 0:
+                os.rmdir(parentdir)
+        except Exception as err:
+            logger.exception("Cannot remove *.meta or *.npz tmp files.\n{}".format(err))
 
     @staticmethod
     def dict2matrix(mtx_dict, row_items, col_items, classname=TypeTokenMatrix):
@@ -478,6 +619,207 @@ class ColFreqHandler(BaseHandler):
         return classname(spmtx, row_items, col_items)
 
 
+class ColFreqCounter(object):
+    """Co-occurrence counter working on integer ids (the 'array' engine of `ColFreqHandler`).
+
+    Every corpus line is mapped to a row id and a column id only once, via lookup tables
+    built from the row and column item lists (-1 for items that are not in the lists).
+    The ids of the lines are collected per block (the lines between two separator lines)
+    and the windows are processed in batches of lines by NumPy operations:
+    for each offset in the left and right spans, the (row id, column id) pairs are selected
+    at once for all lines of the batch. The pairs are written into preallocated buffers,
+    which are summed into a sparse count matrix when they are full.
+
+    The counter follows the window semantics of `ColFreqHandler.update_one_match()`
+    and `ColFreqHandler.process_right_window()`, including the case of a block shorter than
+    or equal to the right span, whose last line is not processed as a node.
+    So the resulting matrix is the same as the one of the 'dict' engine.
+
+    Attributes
+    ----------
+    row_items : list of str
+        Alphabetically sorted row items.
+    col_items : list of str
+        If the column items are given, alphabetically sorted column items.
+        Else, column items in the order of their first appearance.
+    """
+    batchsize = 1000000  # number of lines processed by one batch
+    buffersize = 4194304  # size of the (row id, column id) pair buffers
+
+    def __init__(self, row_items, col_items=None, lspan=10, rspan=10):
+        """
+        Parameters
+        ----------
+        row_items : list of str
+        col_items : list of str, optional
+            If not provided, all collocates are counted and the column items
+            are collected while processing the corpus.
+        lspan : int
+        rspan : int
+        """
+        self.row_items = row_items
+        self.item2rowid = {e: i for i, e in enumerate(row_items)}
+        self.nocolitems = col_items is None
+        self.col_items = [] if self.nocolitems else col_items
+        self.item2colid = {e: i for i, e in enumerate(self.col_items)}
+        self.lspan, self.rspan = lspan, rspan
+
+        # ids of the lines of the current batch
+        self._rows, self._cols = [], []
+        self._blocks = []  # lengths of the finished blocks of the current batch
+        self._blen = 0  # length of the open block
+        self._skip = 0  # number of leading lines of the batch which have been processed as nodes
+        self._cont = False  # whether the first block of the batch continues a flushed block
+
+        self._rowbuf = np.empty(self.buffersize, dtype=np.int32)
+        self._colbuf = np.empty(self.buffersize, dtype=np.int32)
+        self._nbuf = 0
+        self._counts = None  # scipy.sparse.csr_matrix of the counted pairs
+
+    @property
+    def shape(self):
+        return len(self.row_items), len(self.col_items)
+
+    @property
+    def nnz(self):
+        """Number of counted values (an upper bound, the pairs in the buffers may be duplicated)."""
+        return (self._counts.nnz if self._counts is not None else 0) + self._nbuf
+
+    def reset(self):
+        """Empty the counts, i.e. after they have been saved by `to_matrix()`.
+        The item lists and the lines waiting in the current batch are kept.
+        """
+        self._counts = None
+        self._nbuf = 0
+
+    def append(self, type_, colloc):
+        """Append one corpus line by its type string and collocate string."""
+        cid = self.item2colid.get(colloc, -1)
+        if cid < 0 and self.nocolitems:
+            cid = len(self.col_items)
+            self.item2colid[colloc] = cid
+            self.col_items.append(colloc)
+        self._rows.append(self.item2rowid.get(type_, -1))
+        self._cols.append(cid)
+        self._blen += 1
+        if len(self._rows) >= self.batchsize:
+            self.flush()
+
+    def end_block(self):
+        """Close the current block (when reaching a separator line or the end of a file)."""
+        if self._blen > 0:
+            self._blocks.append(self._blen)
+            self._blen = 0
+
+    def flush(self):
+        """Process the lines of the current batch.
+        If a block is still open, its last lines are kept for the next batch,
+        because their windows are not complete yet.
+        """
+        n = len(self._rows)
+        if n == 0:
+            return
+        lspan, rspan = self.lspan, self.rspan
+        rows = np.array(self._rows, dtype=np.int32)
+        cols = np.array(self._cols, dtype=np.int32)
+        lengths = self._blocks + ([self._blen] if self._blen > 0 else [])
+        lengths = np.array(lengths, dtype=np.int64)
+
+        blk = np.repeat(np.arange(len(lengths)), lengths)  # block index of each line
+        blen = np.repeat(lengths, lengths)  # block length of each line
+        pos = np.arange(n) - np.repeat(np.cumsum(lengths) - lengths, lengths)  # position in block
+        # lines which are processed as nodes
+        nodes = rows >= 0
+        short = (blen <= rspan) & (pos == blen - 1)
+        if self._cont:
+            short[:lengths[0]] = False
+        nodes &= ~short
+        nodes[:self._skip] = False
+        if self._blen > 0:
+            # the last lines of the open block wait for their right windows
+            nodes[n - min(rspan, self._blen):] = False
+
+        for d in range(1, lspan + 1):
+            if d >= n:
+                break
+            mask = nodes[d:] & (blk[d:] == blk[:-d]) & (cols[:-d] >= 0)
+            self._emit(rows[d:][mask], cols[:-d][mask])
+        for d in range(1, rspan + 1):
+            if d >= n:
+                break
+            mask = nodes[:-d] & (blk[:-d] == blk[d:]) & (cols[d:] >= 0)
+            self._emit(rows[:-d][mask], cols[d:][mask])
+
+        # reset the batch
+        if self._blen > 0:
+            keep = min(lspan + rspan, self._blen)
+            self._skip = keep - min(rspan, self._blen)
+            # a block not longer than the right span has no processed nodes yet
+            self._cont = (self._cont and len(self._blocks) == 0) or self._blen > rspan
+            self._rows, self._cols = self._rows[n - keep:], self._cols[n - keep:]
+            self._blen = keep
+        else:
+            self._skip = 0
+            self._cont = False
+            self._rows, self._cols = [], []
+        self._blocks = []
+
+    def _emit(self, rows, cols):
+        """Write (row id, column id) pairs into the buffers."""
+        start = 0
+        while start < len(rows):
+            if self._nbuf == self.buffersize:
+                self._compact()
+            size = min(len(rows) - start, self.buffersize - self._nbuf)
+            self._rowbuf[self._nbuf:self._nbuf + size] = rows[start:start + size]
+            self._colbuf[self._nbuf:self._nbuf + size] = cols[start:start + size]
+            self._nbuf += size
+            start += size
+
+    def _compact(self):
+        """Sum the pairs in the buffers into the count matrix and empty the buffers."""
+        if self._nbuf == 0:
+            return
+        n = self._nbuf
+        data = np.ones(n, dtype=np.int64)
+        counts = sp.csr_matrix((data, (self._rowbuf[:n], self._colbuf[:n])), shape=self.shape)
+        if self._counts is None:
+            self._counts = counts
+        else:
+            # new column items may have been appended
+            self._counts.resize(self.shape)
+            self._counts = self._counts + counts
+        self._nbuf = 0
+
+    def to_matrix(self, classname=TypeTokenMatrix):
+        """Transform the counts into a matrix with alphabetically sorted row and column items.
+        If no collocate was given, only the counted collocates are kept as columns.
+
+        Returns
+        -------
+        :class:`~nephosem.TypeTokenMatrix` or None if nothing has been counted.
+        """
+        self.flush()
+        self._compact()
+        if self._counts is None or self._counts.nnz == 0:
+            return None
+        coomx = self._counts.tocoo()
+        row, col = coomx.row.astype(np.int64), coomx.col.astype(np.int64)
+        data = coomx.data.astype(np.int64)
+        if self.nocolitems:
+            used = np.unique(col)
+            used_items = [self.col_items[i] for i in used]
+            order = sorted(range(len(used_items)), key=used_items.__getitem__)
+            col_items = [used_items[i] for i in order]
+            newidx = np.zeros(len(self.col_items), dtype=np.int64)
+            newidx[used[order]] = np.arange(len(order))
+            col = newidx[col]
+        else:
+            col_items = self.col_items
+        spmtx = sp.csr_matrix((data, (row, col)), shape=(len(self.row_items), len(col_items)))
+        return classname(spmtx, self.row_items, col_items, deep=False)
+
+
 class TokenHandler(BaseHandler):
     """Handler Class for retrieving tokens"""
     tmpindicator = 'tok.app'
@@ -506,8 +848,11 @@ class TokenHandler(BaseHandler):
         self.nocolvocab = True if len(self.col_vocab) == 0 else False
 
         self.formatter = CorpusFormatter(self.settings)
-        self.type2toks = {w: TypeNode(type_str=w, type_fmt=self.formatter.type_format)
+        self.type2toks = {w: TypeNode(type_str=w, type_fmt=self.formatter.type_format,
+                                      tokens=TokenStore(token_fmt=self.formatter.token_format,
+                                                        colloc_fmt=self.formatter.colloc_format))
                           for w in queries.keys()}
+        self._items = dict()  # corpus line -> ((word, lemma, pos), colloc string)
 
     def retrieve_tokens(self, fnames=None):
         """Scan/Retrieve tokens from corpus files.
@@ -604,16 +949,28 @@ class TokenHandler(BaseHandler):
         # add collocates to the TypeNode object
         tpnode = type2toks[type_]
         # each colloc in window (left and right) is a tuple of (match, lid)
-        left_win = [ItemNode(match=colloc[0], formatter=self.formatter, fid=fid, lid=colloc[1])
-                    for colloc in list(win.left) if colloc is not None]
-        right_win = [ItemNode(match=colloc[0], formatter=self.formatter, fid=fid, lid=colloc[1])
-                     for colloc in list(win.right) if colloc is not None]
+        # the tokens are appended to the (array-backed) token store of the type node,
+        # no ItemNode or TokenNode objects are created here
+        left_win = [self._get_item(colloc[0]) for colloc in win.left if colloc is not None]
+        right_win = [self._get_item(colloc[0]) for colloc in win.right if colloc is not None]
         if not self.nocolvocab:
-            left_win = [x for x in left_win if x.to_colloc() in self.col_vocab]
-            right_win = [x for x in right_win if x.to_colloc() in self.col_vocab]
-        token = TokenNode(fid=fid, lid=lid, match=match, formatter=self.formatter,
-                          lcollocs=left_win, rcollocs=right_win)
-        tpnode.append_token(token)
+            left_win = [x for x in left_win if x[1] in self.col_vocab]
+            right_win = [x for x in right_win if x[1] in self.col_vocab]
+        tpnode.store.append(self._get_item(match)[0], fid, lid,
+                            [x[0] for x in left_win], [x[0] for x in right_win])
+
+    def _get_item(self, match):
+        """Get the (word, lemma, pos) item and the collocate string of a corpus line (cached by line)."""
+        line = match.string
+        res = self._items.get(line)
+        if res is None:
+            if len(self._items) >= self.chunksize:
+                self._items.clear()
+            get = self.formatter.get
+            res = ((get(match, 'word'), get(match, 'lemma'), get(match, 'pos')),
+                   self.formatter.get_colloc(match))
+            self._items[line] = res
+        return res
 
     def process_right_window(self, type2toks, win, fid='fname', **kwargs):
         """When we meet the end of an article / block,
@@ -644,7 +1001,9 @@ class TokenHandler(BaseHandler):
         type2toks = defaultdict(list)
         logger.info("Merging results")
 
-        for _ in trange(n):
+        # every worker puts its `type2toks` dict, even when it has got no job,
+        # so there could be more results than jobs (n)
+        for _ in trange(res_queue.qsize()):
             res = res_queue.get()
             # when data in res_queue is a `type2toks` dict
             if isinstance(res, dict):
@@ -1192,20 +1551,18 @@ def read_token_colloc(type_node, colloc_vocab=None, settings=None):
     lspan, rspan = settings['left-span'], settings['right-span']
     colloc_fmt = settings.get('colloc', 'lemma/pos')
     matrix = defaultdict(lambda: defaultdict(int))
-    for tok in type_node.tokens:
-        tok_str = str(tok)
-        for i in range(min(lspan, tok.lspan)):
+    for tok_str, collocs, nleft in type_node.store.iter_collocs(colloc_fmt=colloc_fmt):
+        row = matrix[tok_str]
+        for i in range(min(lspan, nleft)):
             position = -(i + 1)
-            colloc = tok.lcollocs[position]  # -> ItemNode
-            colloc_str = colloc.to_colloc(colloc_fmt=colloc_fmt)
+            colloc_str = collocs[nleft + position]
             if not colloc_vocab or colloc_str in colloc_vocab:
-                matrix[tok_str][colloc_str] = position
-        for i in range(min(rspan, tok.rspan)):
+                row[colloc_str] = position
+        for i in range(min(rspan, len(collocs) - nleft)):
             position = i + 1
-            colloc = tok.rcollocs[i]
-            colloc_str = colloc.to_colloc(colloc_fmt=colloc_fmt)
+            colloc_str = collocs[nleft + i]
             if not colloc_vocab or colloc_str in colloc_vocab:
-                matrix[tok_str][colloc_str] = position
+                row[colloc_str] = position
     return matrix
 
 
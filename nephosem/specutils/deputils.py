@@ -32,7 +32,8 @@ import networkx as nx
 from networkx.drawing.nx_agraph import write_dot, graphviz_layout
 import matplotlib.pyplot as plt
 
-__all__ = ['parse_pattern', 'get_root', 'get_depth', 'tree_match',
+__all__ = ['parse_pattern', 'get_root', 'get_depth', 'tree_match', 'target_anchors',
+           'SentenceTree', 'PatternMatcher',
            'draw_tree', 'draw_labels', 'draw_match']
 
 logger = logging.getLogger(__name__)
@@ -158,36 +159,377 @@ def get_depth_of_node(gx, v):
     return depth
 
 
-def tree_match(sentence, macro):
+class RegexTest(object):
+    """A compiled regular expression with a memo of its results on attribute values.
+    The same regex string is shared (with its memo) by all compiled patterns, see `regex_test()`.
+    """
+    maxsize = 1000000  # maximum number of memorized values
+
+    def __init__(self, regex):
+        self.regex = regex
+        self.compiled = re.compile(regex)
+        self.memo = dict()
+
+    def __call__(self, value):
+        res = self.memo.get(value)
+        if res is None:
+            if len(self.memo) >= self.maxsize:
+                self.memo.clear()
+            res = self.memo[value] = self.compiled.match(value) is not None
+        return res
+
+    def __reduce__(self):
+        # do not pickle the memo, get the shared test of the regex when unpickling
+        return regex_test, (self.regex,)
+
+
+_regex_tests = dict()
+
+
+def regex_test(regex):
+    """Get the shared :class:`RegexTest` of a regex string."""
+    test = _regex_tests.get(regex)
+    if test is None:
+        test = _regex_tests[regex] = RegexTest(regex)
+    return test
+
+
+def match_attrs(tests, attrs):
+    """Check the attribute dict (of a sentence node or edge) against the (attribute, test) pairs.
+    Like `PatternGraph.match_node()`, empty tests or an empty attribute dict never match.
+    """
+    if not tests or not attrs:
+        return False
+    for attr, test in tests:
+        if not test(attrs[attr]):
+            return False
+    return True
+
+
+class SentenceTree(object):
+    """Lightweight array representation of a sentence (dependency) graph for matching.
+
+    The nodes are numbered by position (0..n-1), the successors (dependents) of node `i`
+    are `children[childptr[i]:childptr[i+1]]` and the attributes of the edge to `children[k]`
+    are `edge_attrs[k]`.
+
+    Attributes
+    ----------
+    ids : list
+        Sentence node ids (i.e. the ID column) of the positions.
+    pos : dict
+        Sentence node id -> position mapping.
+    node_attrs : list of dict
+    parents : list of int
+        Position of the head of each node, -1 if it has no head (i.e. the root).
+    """
+
+    def __init__(self, ids, node_attrs, childptr, children, edge_attrs):
+        self.ids = ids
+        self.pos = {v: i for i, v in enumerate(ids)}
+        self.node_attrs = node_attrs
+        self.childptr = childptr
+        self.children = children
+        self.edge_attrs = edge_attrs
+        self.parents = [-1] * len(ids)
+        self.multihead = False  # whether a node has more than one head
+        for v in range(len(ids)):
+            for k in range(childptr[v], childptr[v + 1]):
+                if self.parents[children[k]] != -1:
+                    self.multihead = True
+                self.parents[children[k]] = v
+        self._istree = None
+        self._candidates = dict()
+
+    @classmethod
+    def from_edges(cls, nodes, edges):
+        """Build a sentence tree from node and edge attribute dicts.
+        Like adding them to a `networkx.DiGraph`, a head which is not in `nodes` (i.e. the root 0)
+        is added as a node without attributes and the successors keep the order of the edges.
+
+        Parameters
+        ----------
+        nodes : dict
+            Node id -> attribute dict.
+        edges : dict
+            (head id, dependent id) -> attribute dict.
+        """
+        ids, node_attrs = list(nodes.keys()), list(nodes.values())
+        pos = {v: i for i, v in enumerate(ids)}
+        succs = [[] for _ in ids]
+        for (head, dep), attrs in edges.items():
+            for v in (head, dep):
+                if v not in pos:
+                    pos[v] = len(ids)
+                    ids.append(v)
+                    node_attrs.append(dict())
+                    succs.append([])
+            succs[pos[head]].append((pos[dep], attrs))
+        childptr, children, edge_attrs = [0], [], []
+        for sucs in succs:
+            for dep, attrs in sucs:
+                children.append(dep)
+                edge_attrs.append(attrs)
+            childptr.append(len(children))
+        return cls(ids, node_attrs, childptr, children, edge_attrs)
+
+    @classmethod
+    def from_graph(cls, gx):
+        """Build a sentence tree from a `networkx.DiGraph` (keeping its node and successor order)."""
+        ids = list(gx.nodes)
+        pos = {v: i for i, v in enumerate(ids)}
+        node_attrs = [gx.nodes[v] for v in ids]
+        childptr, children, edge_attrs = [0], [], []
+        for v in ids:
+            for succ in gx.successors(v):
+                children.append(pos[succ])
+                edge_attrs.append(gx.edges[v, succ])
+            childptr.append(len(children))
+        return cls(ids, node_attrs, childptr, children, edge_attrs)
+
+    def successors(self, i):
+        """Positions of the successors of the node at position `i`."""
+        return self.children[self.childptr[i]:self.childptr[i + 1]]
+
+    def edge(self, i, j):
+        """Index (in `children`) of the edge between the positions `i` and `j`, -1 if there is none."""
+        for k in range(self.childptr[i], self.childptr[i + 1]):
+            if self.children[k] == j:
+                return k
+        return -1
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def istree(self):
+        """Whether the (undirected) graph is a tree, like `networkx.is_tree()`: n - 1 edges and connected."""
+        if self._istree is None:
+            n = len(self.ids)
+            if n == 0 or len(self.children) != n - 1:
+                self._istree = False
+            else:
+                # union-find
+                root = list(range(n))
+
+                def find(i):
+                    while root[i] != i:
+                        root[i] = root[root[i]]
+                        i = root[i]
+                    return i
+
+                ncomps = n
+                for v in range(n):
+                    for k in range(self.childptr[v], self.childptr[v + 1]):
+                        rv, rc = find(v), find(self.children[k])
+                        if rv != rc:
+                            root[rv] = rc
+                            ncomps -= 1
+                self._istree = ncomps == 1
+        return self._istree
+
+    def candidates(self, key, tests):
+        """Positions of the nodes which pass the tests, cached by `key` for this sentence
+        (so patterns with the same root tests share the lookup).
+        """
+        cands = self._candidates.get(key)
+        if cands is None:
+            cands = self._candidates[key] = [i for i, attrs in enumerate(self.node_attrs)
+                                             if match_attrs(tests, attrs)]
+        return cands
+
+    def target_positions(self, attrs, targets, connector='/'):
+        """Positions of the nodes whose type (the values of the `attrs` attributes joined by `connector`)
+        is in `targets`.
+        """
+        positions = []
+        for i, nattrs in enumerate(self.node_attrs):
+            try:
+                type_ = connector.join([nattrs[attr] for attr in attrs])
+            except KeyError:
+                continue
+            if type_ in targets:
+                positions.append(i)
+        return positions
+
+
+class PatternMatcher(object):
+    """Matching plan compiled from a pattern (tree) graph.
+
+    The pattern nodes are ordered breadth-first from the root, which is the order in which
+    the level-matching algorithm (`subtree_match()`) expands them. Each pattern node is then
+    matched against the successors of the sentence node of its pattern parent, by a depth-first
+    search over this order. The regular expressions of nodes and edges are compiled (and their
+    results memorized, see :class:`RegexTest`) once.
+    So the matches are the same as those of `subtree_match()` and come in the same order.
+
+    Attributes
+    ----------
+    nodes : list of int
+        Pattern node indices in breadth-first order.
+    parents : list of int
+        Position (in `nodes`) of the pattern parent of each node, -1 for the root.
+    """
+
+    def __init__(self, gx):
+        """
+        Parameters
+        ----------
+        gx : networkx.DiGraph
+            Graph of a pattern (tree).
+        """
+        root = get_root(gx)
+        self.nodes, self.parents = [root], [-1]
+        i = 0
+        while i < len(self.nodes):
+            for succ in gx.successors(self.nodes[i]):
+                self.nodes.append(succ)
+                self.parents.append(i)
+            i += 1
+        self.index = {v: k for k, v in enumerate(self.nodes)}
+        # number of steps from the root
+        self.depths = [0] * len(self.nodes)
+        for k in range(1, len(self.nodes)):
+            self.depths[k] = self.depths[self.parents[k]] + 1
+        # positions of the earlier nodes having the same pattern parent
+        self.siblings = [[j for j in range(k) if self.parents[j] == self.parents[k]] if k > 0 else []
+                         for k in range(len(self.nodes))]
+        self.node_tests = [tuple((attr, regex_test(regex)) for attr, regex in gx.nodes[v].items())
+                           for v in self.nodes]
+        self.edge_tests = [()] + [tuple((attr, regex_test(regex))
+                                        for attr, regex in gx.edges[self.nodes[self.parents[k]], self.nodes[k]].items()
+                                        if attr != 'id')  # skip the default attribute `id`
+                                  for k in range(1, len(self.nodes))]
+        self.root_key = tuple(sorted((attr, test.regex) for attr, test in self.node_tests[0]))
+        pos = {v: k for k, v in enumerate(self.nodes)}
+        # pattern edges (in the order of the graph) with the position of their tail nodes
+        self.edges = [(head, tail, pos[tail]) for head, tail in gx.edges]
+
+    def __deepcopy__(self, memo):
+        # the plan does not change after compiling, so it is shared by copies of the pattern
+        return self
+
+    def match(self, tree, target=None, anchors=None):
+        """Find all matches of the pattern in a sentence tree.
+
+        When the `anchors` are given, only the matches which map the `target` pattern node
+        to one of them are searched: the pattern root can then only be matched by the ancestor
+        (at the depth of the target node) of an anchor, and the target node by the anchor itself.
+
+        Parameters
+        ----------
+        tree : :class:`SentenceTree`
+        target : int, optional
+            Pattern node index of the target.
+        anchors : iterable of int, optional
+            Positions of the sentence nodes the target node could be matched to.
+
+        Returns
+        -------
+        list of tuple
+            Each match is a tuple of (sentence node position, edge entry) pairs, aligned with `nodes`.
+            The edge entry (index in `tree.children`) of the root is -1.
+        """
+        matches = []
+        n = len(self.nodes)
+        assigned = [None] * n
+        kt, allowed = -1, None
+
+        def expand(k):
+            if k == n:
+                matches.append(tuple(assigned))
+                return
+            parent = assigned[self.parents[k]][0]
+            ntests, etests = self.node_tests[k], self.edge_tests[k]
+            taken = [assigned[j][0] for j in self.siblings[k]]
+            for e in range(tree.childptr[parent], tree.childptr[parent + 1]):
+                child = tree.children[e]
+                if child in taken or (k == kt and child not in allowed):
+                    continue
+                if match_attrs(ntests, tree.node_attrs[child]) and match_attrs(etests, tree.edge_attrs[e]):
+                    assigned[k] = (child, e)
+                    expand(k + 1)
+            assigned[k] = None
+
+        if anchors is None or tree.multihead or target not in self.index:
+            roots = [(v, None) for v in tree.candidates(self.root_key, self.node_tests[0])]
+        else:
+            kt = self.index[target]
+            # the root of a match is the ancestor of the target node at the depth of the target
+            root2anchors = dict()
+            for a in anchors:
+                r = a
+                for _ in range(self.depths[kt]):
+                    r = tree.parents[r]
+                    if r < 0:
+                        break
+                if r >= 0:
+                    root2anchors.setdefault(r, set()).add(a)
+            roots = [(r, root2anchors[r]) for r in sorted(root2anchors)
+                     if match_attrs(self.node_tests[0], tree.node_attrs[r])]
+
+        for v, allowed in roots:
+            assigned[0] = (v, -1)
+            expand(1)
+        return matches
+
+
+def sentence_tree(sentence):
+    """Get the (cached) :class:`SentenceTree` of a sentence graph."""
+    tree = getattr(sentence, 'tree', None)
+    if tree is None:
+        tree = sentence.tree = SentenceTree.from_graph(sentence.graph)
+    return tree
+
+
+def target_anchors(sentence, macro, targets):
+    """Get the positions of the sentence nodes whose type is one of the targets (see `add_mapping()`).
+
+    Parameters
+    ----------
+    sentence : :class:`~qlvl.core.graph.SentenceGraph`
+    macro : :class:`~qlvl.core.graph.MacroGraph`
+    targets : :class:`~nephosem.core.vocab.Vocab` or set
+
+    Returns
+    -------
+    list of int
+    """
+    attrs = [attr for attr in macro.target_node_attrs if attr not in ['FID', 'LID', 'fid', 'lid']]
+    return sentence_tree(sentence).target_positions(attrs, targets, connector=macro.connector)
+
+
+def tree_match(sentence, macro, anchors=None):
     """Match the sentence with the subgraph pattern.
     Abstract of the matching:
         * find root node of the pattern
         * iterate over each sentence node that matches the pattern root
         * recursively match the sentence with the pattern from each matched node
 
+    The matching runs the compiled plan of the pattern (see :class:`PatternMatcher`)
+    on the array representation of the sentence (see :class:`SentenceTree`).
+
     Parameters
     ----------
     sentence : :class:`~qlvl.core.graph.SentenceGraph`
     macro : :class:`~qlvl.core.graph.MacroGraph`
+    anchors : iterable of int, optional
+        Positions of the sentence nodes to match the target node of the macro to, see `target_anchors()`.
+        When given, the matching starts from these nodes.
     """
+    tree = sentence_tree(sentence)
     # check whether the sentence (dependency tree) is a valid tree
-    try:
-        assert sentence.istree
-    except Exception as err:
-        logger.error(err, str(sentence.fid))
+    if not tree.istree:
+        logger.error("Sentence of {} is not a tree.".format(sentence.fid))
         return False
 
     num_curr_matches = len(macro.matched_nodes)
-    # find feature root
-    froot = get_root(macro.graph)
-
-    # iterate over each sentence node that matches the root of the feature
-    for v, vitem in sentence.nodes:
-        if not macro.match_node(vitem, idx=froot):
-            continue
-        mapping = {froot: v}  # mapping of the first level
-        # recursively match the sentence with the feature from this node
-        subtree_match(sentence=sentence, macro=macro, lmatches=deque([[mapping]]))
+    matcher = macro.compile()
+    for match in matcher.match(tree, target=macro.target_idx, anchors=anchors):
+        nodemapping = {fn: tree.ids[sn] for fn, (sn, _e) in zip(matcher.nodes, match)}
+        matched_nodes = {fn: tree.node_attrs[sn] for fn, (sn, _e) in zip(matcher.nodes, match)}
+        matched_edges = {(head, tail): tree.edge_attrs[match[k][1]] for head, tail, k in matcher.edges}
+        add_mapping(sentence, nodemapping, macro, matched_nodes=matched_nodes, matched_edges=matched_edges)
 
     return not num_curr_matches == len(macro.matched_nodes)
 
@@ -244,27 +586,36 @@ def add_match(sentence, lmatches, macro):
         nodemapping = dict()
         for m in lmatch:
             nodemapping.update(m)
-        # remap feature node to sentence node label (type)
+        add_mapping(sentence, nodemapping, macro)
+
+
+def add_mapping(sentence, nodemapping, macro, matched_nodes=None, matched_edges=None):
+    """Add the match of a node mapping (pattern node idx -> sentence node idx) to the macro.
+    The matched node and edge attribute dicts are looked up in the sentence if they are not given.
+    """
+    # remap feature node to sentence node label (type)
+    if matched_nodes is None:
         matched_nodes = {fn: sentence.nodes[sn] for fn, sn in nodemapping.items()}
-        # if the target filter is given, check whether the matched target node appear in the target filter
-        if macro.target_filter is not None:
-            target_node_dict = matched_nodes[macro.target_idx]
-            # example of target_node_dict: {'FORM': 'Het', 'LEMMA': 'het', 'POS': 'det'}
-            vals = [target_node_dict[attr] for attr, _idx in macro.target_node_attrs.items() if attr not in ['FID', 'LID', 'fid', 'lid']]
-            target_type = macro.connector.join(vals)
-            # if the matched target type does not appear in the given target filter
-            # do not add this match to the macro (for speeding up processing and save memory space)
-            if target_type not in macro.target_filter:
-                continue
-        if sentence.mode == 'token':
-            for nid, attrs in matched_nodes.items():
-                attrs['FID'] = sentence.fid
-                attrs['fid'] = sentence.fid
-        # remap feature edge (tuple of node idx) to sentence edge label (dependency relation)
+    # if the target filter is given, check whether the matched target node appear in the target filter
+    if macro.target_filter is not None:
+        target_node_dict = matched_nodes[macro.target_idx]
+        # example of target_node_dict: {'FORM': 'Het', 'LEMMA': 'het', 'POS': 'det'}
+        vals = [target_node_dict[attr] for attr, _idx in macro.target_node_attrs.items() if attr not in ['FID', 'LID', 'fid', 'lid']]
+        target_type = macro.connector.join(vals)
+        # if the matched target type does not appear in the given target filter
+        # do not add this match to the macro (for speeding up processing and save memory space)
+        if target_type not in macro.target_filter:
+            return
+    if sentence.mode == 'token':
+        for nid, attrs in matched_nodes.items():
+            attrs['FID'] = sentence.fid
+            attrs['fid'] = sentence.fid
+    # remap feature edge (tuple of node idx) to sentence edge label (dependency relation)
+    if matched_edges is None:
         matched_edges = {(head, tail): sentence.edges[(nodemapping[head], nodemapping[tail])]
                          for head, tail in macro.edges}
-        # append matched nodes and edges to the feature
-        macro.add_match(matched_nodes, matched_edges)
+    # append matched nodes and edges to the feature
+    macro.add_match(matched_nodes, matched_edges)
 
 
 def match_level(sentence, pattern, prevmap):
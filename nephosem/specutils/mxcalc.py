@@ -21,11 +21,11 @@
 import logging
 import math
 import operator
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import scipy.sparse as sp
 from sklearn.metrics import pairwise_distances
-from sklearn.metrics.pairwise import cosine_similarity
 from sklearn import preprocessing # addition by Stefano (2021.02.18)
 
 from nephosem import progbar
@@ -36,47 +36,45 @@ __all__ = ['compute_association', 'compute_ppmi', 'compute_distance', 'compute_c
 
 logger = logging.getLogger(__name__)
 
+CHUNKSIZE = 10000000  # max number of nonzero values processed at once by the association measures
+BLOCKSIZE = 1024  # number of rows computed at once by the distance and similarity measures
+
 
 @timeit
-def compute_ppmi(freqMTX, nfreq=None, cfreq=None, positive=True):
+def compute_ppmi(freqMTX, nfreq=None, cfreq=None, positive=True, chunksize=CHUNKSIZE):
     """This method is faster than `compute_association()`.
     Set positive to False to get pmi values.
+    The values are computed by chunks of at most `chunksize` nonzero values.
     """
-    tot_sum = float(nfreq.sum())
     freqmx = freqMTX.matrix
+    tot_sum = float(nfreq.sum()) if nfreq is not None else float(freqmx.sum())
     # select frequencies of row items / column items of freqMTX
     # from nfreq and cfreq
     if nfreq is None:
         # sum of each rows of freqmx (size = row-size)
         row_sum_vec = np.squeeze(np.asarray(freqmx.sum(axis=1))).astype(np.float64)
     else:
-        row_sum_vec = np.array([nfreq[e] for e in freqMTX.row_items])
+        row_sum_vec = np.array([nfreq[e] for e in freqMTX.row_items], dtype=np.float64)
     if cfreq is None:
         # sum of each columns of freqmx (size = column-size)
         col_sum_vec = np.squeeze(np.asarray(freqmx.sum(axis=0))).astype(np.float64)
     else:
-        col_sum_vec = np.array([cfreq[e] for e in freqMTX.col_items])
-
-    freqmx = freqmx.tocoo()
-    row = freqmx.row  # indices of row
-    col = freqmx.col  # indices of column
-    data = freqmx.data
-    # o11 / e11 -> o11 / ((R1 * C1) / N) -> o11 * N / (R1 * C1)
-    data = data * tot_sum  # -> o11
+        col_sum_vec = np.array([cfreq[e] for e in freqMTX.col_items], dtype=np.float64)
 
+    freqmx = freqmx.tocsr()
     ppmi = np.zeros(freqmx.nnz, dtype=np.float32)
-    for i in progbar(range(freqmx.nnz)):
-        rowid, colid = row[i], col[i]
-        e11 = row_sum_vec[rowid] * col_sum_vec[colid]
-        x = (data[i] / e11) if e11 > 0 else 0
-        pmi = math.log(x if x != 0 else 1.0)
-        if positive:
-            ppmi[i] = 0.0 if pmi < 0 else pmi
-        else:
-            ppmi[i] = pmi
-
-    ppmimx = sp.csr_matrix((ppmi, (row, col)), shape=freqmx.shape)
-    args = (ppmimx, freqMTX.row_items, freqMTX.col_items)
+    for start, end, rowids in iter_nnz_chunks(freqmx, chunksize=chunksize):
+        colids = freqmx.indices[start:end]
+        # o11 / e11 -> o11 / ((R1 * C1) / N) -> o11 * N / (R1 * C1)
+        data = freqmx.data[start:end] * tot_sum  # -> o11
+        e11 = row_sum_vec[rowids] * col_sum_vec[colids]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = np.where(e11 > 0, data / e11, 0.0)
+            pmi = np.log(np.where(x != 0, x, 1.0))
+        ppmi[start:end] = np.where(pmi < 0, 0.0, pmi) if positive else pmi
+
+    ppmimx = sp.csr_matrix((ppmi, freqmx.indices.copy(), freqmx.indptr.copy()), shape=freqmx.shape)
+    args = (ppmimx, freqMTX.row_index, freqMTX.col_index)
     kwargs = {
         'category': 'association', 'meas': 'ppmi',
     }
@@ -84,7 +82,7 @@ def compute_ppmi(freqMTX, nfreq=None, cfreq=None, positive=True):
 
 
 @timeit
-def compute_association(freqMTX, nfreq, cfreq, N=None, meas='ppmi'):
+def compute_association(freqMTX, nfreq, cfreq, N=None, meas='ppmi', chunksize=CHUNKSIZE):
     """Compute association measures matrix.
     
     The matrix provided can be a submatrix with selected rows and/or columns, but `nfreq`
@@ -105,7 +103,9 @@ def compute_association(freqMTX, nfreq, cfreq, N=None, meas='ppmi'):
         Sum of the reference frequency matrix.
     meas : str
         Implemented association measures: 'pmi', 'ppmi', 'llik' (log likelihood),
-        'chisq', 'zscore', 'dice'.
+        'chisq', 'zscore', 'dice', 'deltap', 'deltapColl', 'logratio'.
+    chunksize : int
+        Max number of nonzero values computed at once.
 
     Returns
     -------
@@ -115,16 +115,18 @@ def compute_association(freqMTX, nfreq, cfreq, N=None, meas='ppmi'):
     nfreq = np.array([nfreq[e] for e in freqMTX.row_items])
     cfreq = np.array([cfreq[e] for e in freqMTX.col_items])
 
-    measmx = calc_association(freqMTX.matrix, nfreq=nfreq, cfreq=cfreq, N=N, meas=meas)
-    args = (measmx, freqMTX.row_items, freqMTX.col_items)
+    measmx = calc_association(freqMTX.matrix, nfreq=nfreq, cfreq=cfreq, N=N, meas=meas, chunksize=chunksize)
+    args = (measmx, freqMTX.row_index, freqMTX.col_index)
     kwargs = {
         'category': 'association', 'meas': meas,
     }
     return freqMTX.__class__(*args, **kwargs)
 
 
-def calc_association(freqmx, nfreq=None, cfreq=None, N=None, meas='ppmi'):
+def calc_association(freqmx, nfreq=None, cfreq=None, N=None, meas='ppmi', chunksize=CHUNKSIZE):
     """Compute association measures matrix.
+    The measure is computed on whole arrays of nonzero values (see `vec_func_dict`),
+    by chunks of at most `chunksize` values, the marginal frequencies being gathered by the indices.
 
     Parameters
     ----------
@@ -135,10 +137,12 @@ def calc_association(freqmx, nfreq=None, cfreq=None, N=None, meas='ppmi'):
     cfreq : list or numpy.ndarray
         Collocate frequency (sum).
     N : int or float
-        Total frequency.
+        Total frequency. If not provided, the largest sum of the row or column marginal frequencies.
     meas : str
         Implemented association measures: 'pmi', 'ppmi', 'llik' (log likelihood),
-        'chisq', 'zscore', 'dice'.
+        'chisq', 'zscore', 'dice', 'deltap', 'deltapColl', 'logratio'.
+    chunksize : int
+        Max number of nonzero values computed at once.
 
     Returns
     -------
@@ -164,43 +168,54 @@ def calc_association(freqmx, nfreq=None, cfreq=None, N=None, meas='ppmi'):
     else:
         col_sum_vec = np.array(cfreq) if isinstance(cfreq, list) else cfreq
 
-    # tot_sum = float(row_sum_vec.sum())
-    tot_sum = N  # total frequency, row_sum_vec.sum() should be equal to col_sum_vec.sum()
-    freqmx = freqmx.tocoo()  # transform to COOrdinate format, for easier usage
-    row = freqmx.row  # -> stores row indices of values in csr_matrix
-    col = freqmx.col  # -> stores column indices of values in csr_matrix
-    data = freqmx.data  # -> stores values in csr_matrix
+    # total frequency, row_sum_vec.sum() should be equal to col_sum_vec.sum()
+    tot_sum = N if N else float(max(np.sum(row_sum_vec), np.sum(col_sum_vec)))
+    row_sum_vec = np.asarray(row_sum_vec, dtype=np.float64)
+    col_sum_vec = np.asarray(col_sum_vec, dtype=np.float64)
+    freqmx = freqmx.tocsr()  # -> data, indices (of columns) and indptr (of rows)
 
-    func_dict = {
-        'pmi': calc_pmi,
-        'ppmi': calc_ppmi,
-        'lik': calc_lik,
-        'llik': calc_lik,
-        'chisq': calc_chisq,
-        'zscore': calc_zscore,
-        'dice': calc_dice,
-        'deltap': calc_deltap,
-        'deltapColl': calc_deltap_coll,
-        'logratio': calc_log_ratio,
-    }
-    if meas not in func_dict:
+    if meas not in vec_func_dict:
         raise NotImplementedError("Unsupported association measure: {}".format(meas))
 
-    afunc = func_dict[meas]
-    measmx = np.zeros(len(data), dtype=np.float32)
-    for i in progbar(range(freqmx.nnz)):
-        rowid, colid = row[i], col[i]  # row and column indices of a value
+    afunc = vec_func_dict[meas]
+    measmx = np.zeros(freqmx.nnz, dtype=np.float32)
+    for start, end, rowids in iter_nnz_chunks(freqmx, chunksize=chunksize):
+        colids = freqmx.indices[start:end]
         # prepare: c_a_b, c_a_nb, c_na_b, c_na_nb
-        c_a_b = data[i]
-        c_a_nb = row_sum_vec[rowid] - c_a_b
-        c_na_b = col_sum_vec[colid] - c_a_b
+        c_a_b = freqmx.data[start:end].astype(np.float64)
+        c_a_nb = row_sum_vec[rowids] - c_a_b
+        c_na_b = col_sum_vec[colids] - c_a_b
         c_na_nb = tot_sum - c_a_nb - c_na_b - c_a_b
-        measmx[i] = afunc(c_a_b, c_na_b, c_a_nb, c_na_nb)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            measmx[start:end] = afunc(c_a_b, c_na_b, c_a_nb, c_na_nb)
 
-    measmx = sp.csr_matrix((measmx, (row, col)), shape=freqmx.shape)
+    measmx = sp.csr_matrix((measmx, freqmx.indices.copy(), freqmx.indptr.copy()), shape=freqmx.shape)
     return measmx
 
 
+def iter_nnz_chunks(spmx, chunksize=CHUNKSIZE):
+    """Iterate over chunks of the nonzero values of a CSR matrix.
+
+    Parameters
+    ----------
+    spmx : scipy.sparse.csr_matrix
+    chunksize : int
+        Max number of values of a chunk. If None, all values are in one chunk.
+
+    Returns
+    -------
+    generator of (start, end, rowids)
+        The chunk covers `spmx.data[start:end]` (and `spmx.indices[start:end]`),
+        `rowids` are the row indices of these values.
+    """
+    nnz = spmx.nnz
+    chunksize = chunksize if chunksize else max(nnz, 1)
+    for start in range(0, nnz, chunksize):
+        end = min(start + chunksize, nnz)
+        rowids = np.searchsorted(spmx.indptr, np.arange(start, end), side='right') - 1
+        yield start, end, rowids
+
+
 # deprecated
 def pairwise_association(c_a_b, c_na_b, c_a_nb, c_na_nb, meas='ppmi'):
     func_dict = {
@@ -320,6 +335,89 @@ def calc_log_ratio(c_a_b, c_na_b, c_a_nb, c_na_nb):
     return logr
 
 
+def adjust_arr(arr):
+    """for log calculation, the array version of `adjust_val()`"""
+    return np.where(arr == 0, 0.0000000001, np.where(arr == 1, 0.9999999999, arr))
+
+
+def calc_pmi_vec(o11, o21, o12, o22):
+    """Calculate PMI values of arrays, see `calc_pmi()`"""
+    N = o11 + o21 + o12 + o22
+    e11 = adjust_arr((o11 + o12) * (o11 + o21) / N)
+    return np.log(adjust_arr(o11 / e11))
+
+
+def calc_ppmi_vec(o11, o21, o12, o22):
+    """Calculate PPMI values of arrays, see `calc_ppmi()`"""
+    pmi = calc_pmi_vec(o11, o21, o12, o22)
+    return np.where(pmi < 0.0, 0.0, pmi)
+
+
+def calc_lik_vec(o11, o21, o12, o22):
+    """Calculate log-likelihood values of arrays, see `calc_lik()`"""
+    p1 = adjust_arr(o11 / (o11 + o21))
+    p2 = adjust_arr(o12 / (o12 + o22))
+    p = adjust_arr((o11 + o12) / (o11 + o12 + o21 + o22))
+    return 2.0 * (
+        o11 * np.log(p1) + o21 * np.log(1.0 - p1) +
+        o12 * np.log(p2) + o22 * np.log(1.0 - p2) -
+        o11 * np.log(p)  - o21 * np.log(1.0 - p)  -
+        o12 * np.log(p)  - o22 * np.log(1.0 - p)
+    )
+
+
+def calc_chisq_vec(o11, o21, o12, o22):
+    """Calculate chi-square values of arrays, see `calc_chisq()`"""
+    return (
+        (o11 + o21 + o12 + o22) *
+        (((o11 * o22) - (o21 * o12)) ** 2) /
+        ((o11 + o21) * (o11 + o12) * (o21 + o22) * (o12 + o22))
+    )
+
+
+def calc_zscore_vec(o11, o21, o12, o22):
+    """Calculate z-score values of arrays, see `calc_zscore()`"""
+    N = o11 + o21 + o12 + o22
+    e11 = ((o11 + o21) * (o11 + o12)) / N  # E11 = R1 * C1 / N
+    return (o11 - e11) / np.sqrt(e11)
+
+
+def calc_dice_vec(o11, o21, o12, o22):
+    """Calculate Dice values of arrays, see `calc_dice()`"""
+    return 2 * o11 / ((o11 + o12) + (o11 + o21))
+
+
+def calc_deltap_vec(o11, o21, o12, o22):
+    """Calculate delta P values of arrays, see `calc_deltap()`"""
+    return o11 / (o11 + o12) - o21 / (o21 + o22)
+
+
+def calc_deltap_coll_vec(o11, o21, o12, o22):
+    """Calculate delta P (collocate) values of arrays, see `calc_deltap_coll()`"""
+    return o11 / (o11 + o21) - o12 / (o12 + o22)
+
+
+def calc_log_ratio_vec(o11, o21, o12, o22):
+    """Calculate log ratio values of arrays, see `calc_log_ratio()`"""
+    ratio = np.where(o21 != 0, (o11 / (o11 + o12)) / (o21 / (o21 + o22)), 1.0)
+    return np.log(adjust_arr(ratio))
+
+
+# association measures computed on arrays (of c_a_b, c_na_b, c_a_nb, c_na_nb)
+vec_func_dict = {
+    'pmi': calc_pmi_vec,
+    'ppmi': calc_ppmi_vec,
+    'lik': calc_lik_vec,
+    'llik': calc_lik_vec,
+    'chisq': calc_chisq_vec,
+    'zscore': calc_zscore_vec,
+    'dice': calc_dice_vec,
+    'deltap': calc_deltap_vec,
+    'deltapColl': calc_deltap_coll_vec,
+    'logratio': calc_log_ratio_vec,
+}
+
+
 def entropy(values):
     """Compute the entropy of a data set"""
     e = 0.0
@@ -338,7 +436,7 @@ def adjust_val(val):
 
 
 @timeit
-def compute_distance(measMTX, axis=0, metric='cosine'):
+def compute_distance(measMTX, axis=0, metric='cosine', blocksize=BLOCKSIZE, dtype=np.float64, filename=None):
     """Compute distance matrix from association measure matrix
 
     Parameters
@@ -349,6 +447,13 @@ def compute_distance(measMTX, axis=0, metric='cosine'):
     metric : str
         'cosine' (default), 'euclidean', 'cityblock', 'l1', 'l2', 'manhattan'
         metrics that are valid in *sklearn.metrics.pairwise_distances*
+    blocksize : int
+        Number of rows of the blocks of the distance matrix computed at once.
+    dtype : numpy.dtype
+        Data type of the distance matrix, i.e. `numpy.float32` to halve its size.
+    filename : str, optional
+        If provided, the distance matrix is a memory-mapped '.npy' file (see `numpy.lib.format.open_memmap`).
+        For a sparse matrix of the nearest rows, see `compute_cosine()` with `topk`.
 
     Returns
     -------
@@ -357,14 +462,12 @@ def compute_distance(measMTX, axis=0, metric='cosine'):
     """
     if axis == 0:
         measmx = measMTX.matrix
-        items = measMTX.row_items  # row-by-row (word-by-word) distance matrix
+        items = measMTX.row_index  # row-by-row (word-by-word) distance matrix
     elif axis == 1:
         measmx = measMTX.matrix.transpose()
-        items = measMTX.col_items  # column-by-column (context-by-context) distance matrix
+        items = measMTX.col_index  # column-by-column (context-by-context) distance matrix
     else:
         raise ValueError("Axis should be 0 or 1!")
-    if isinstance(measmx, sp.spmatrix):
-        measmx = measmx.toarray()  # faster if transform to numpy.ndarray first
     dtypes = {
         'cosine': 'cos',
         'cos': 'cos',
@@ -376,19 +479,148 @@ def compute_distance(measMTX, axis=0, metric='cosine'):
     }
     if metric not in dtypes:
         raise NotImplementedError("Unknown metric {}".format(metric))
-    distmx = calc_distance(measmx, metric=metric)
+    distmx = calc_distance(measmx, metric=metric, blocksize=blocksize, dtype=dtype, filename=filename)
 
     kwargs = {
         'matrix': distmx, 'row_items': items, 'col_items': items,  # necessary parameters
-        'category': 'distance', 'metric': dtypes[metric],          # unnecessary, just for info
+        'category': 'distance', 'metric': dtypes[metric],  # just for info
+        'deep': False,
     }
     return measMTX.__class__(**kwargs)
 
 
-def calc_distance(measmx, metric='cosine'):
-    """Call sklearn.metrics.pairwise_distances function to calculate distance matrix."""
-    distmx = pairwise_distances(measmx, metric=metric)
-    return distmx
+def calc_distance(measmx, metric='cosine', blocksize=BLOCKSIZE, dtype=np.float64, filename=None):
+    """Calculate the (row-by-row) distance matrix by blocks of rows, see `calc_pairwise()`.
+    Sparse matrices are not transformed to dense ones.
+    """
+    return calc_pairwise(measmx, metric=metric, similarity=False, blocksize=blocksize,
+                         dtype=dtype, filename=filename)
+
+
+def calc_pairwise(measmx, metric='cosine', similarity=False, blocksize=BLOCKSIZE, dtype=np.float64,
+                  filename=None, topk=None):
+    """Calculate the (row-by-row) distance or similarity matrix by blocks of rows.
+
+    For the cosine metric, the rows are normalized once and each block is the product of
+    the normalized rows of the block and the transposed normalized matrix (sparse if the matrix is sparse).
+    The cosine similarities of the diagonal are set to 1.0 (distances to 0.0).
+    For the other metrics, each block is computed by `sklearn.metrics.pairwise_distances`.
+    Only a dense block (`blocksize` rows) exists at a time besides the output.
+
+    Parameters
+    ----------
+    measmx : scipy.sparse.spmatrix or numpy.ndarray
+    metric : str
+    similarity : bool
+        Compute similarities instead of distances (only for 'cosine').
+    blocksize : int
+    dtype : numpy.dtype
+    filename : str, optional
+        If provided, the output is a memory-mapped '.npy' file.
+    topk : int, optional
+        If provided (only for cosine similarities), only the `topk` largest similarities of each row
+        are kept in a sparse matrix.
+
+    Returns
+    -------
+    numpy.ndarray (or numpy.memmap) of shape (n, n),
+    or scipy.sparse.csr_matrix with `topk` values per row if `topk` is provided.
+
+    Notes
+    -----
+    The sparse `topk` matrix is only computed for similarities, because a pair which is not kept reads as 0.0:
+    a similarity of 0.0 is at most as similar as the kept pairs (for non-negative vectors),
+    whereas a distance of 0.0 would mean identical.
+    Kept pairs are stored explicitly, even if their similarity is 0.0.
+    """
+    n = measmx.shape[0]
+    iscos = metric in ('cosine', 'cos')
+    if topk is not None and not similarity:
+        raise ValueError("The sparse topk matrix is only computed for similarities (see the notes)!")
+    if similarity and not iscos:
+        raise NotImplementedError("Not implement this similarity metric: {}".format(metric))
+    if iscos:
+        if sp.issparse(measmx):
+            normmx = preprocessing.normalize(measmx.tocsr().astype(np.float64), norm='l2')
+            normT = normmx.transpose().tocsr()
+        else:
+            normmx = preprocessing.normalize(np.asarray(measmx, dtype=np.float64), norm='l2')
+            normT = normmx.T
+    elif sp.issparse(measmx):
+        measmx = measmx.tocsr()
+
+    if topk is None:
+        if filename:
+            out = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=(n, n))
+        else:
+            out = np.empty((n, n), dtype=dtype)
+    else:
+        topk = min(topk, n)
+        rows, cols, vals = [], [], []
+
+    for start in range(0, n, blocksize):
+        end = min(start + blocksize, n)
+        if iscos:
+            block = normmx[start:end].dot(normT)
+            block = block.toarray() if sp.issparse(block) else np.asarray(block)
+            if not similarity:
+                block = np.clip(1.0 - block, 0.0, 2.0)
+        else:
+            block = pairwise_distances(measmx[start:end], measmx, metric=metric)
+        # the diagonal values
+        block[np.arange(end - start), np.arange(start, end)] = 1.0 if similarity else 0.0
+
+        if topk is None:
+            out[start:end] = block
+        else:
+            idx = np.argpartition(-block if similarity else block, topk - 1, axis=1)[:, :topk]
+            rows.append(np.repeat(np.arange(start, end), topk))
+            cols.append(idx.ravel())
+            vals.append(np.take_along_axis(block, idx, axis=1).ravel().astype(dtype))
+
+    if topk is None:
+        if filename:
+            out.flush()
+        return out
+    if n == 0:
+        return sp.csr_matrix((n, n), dtype=dtype)
+    return sp.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n))
+
+
+def iter_cosine_blocks(leftmx, rightmx, blocksize=BLOCKSIZE):
+    """Iterate over the cosine similarities between the rows of two matrices by blocks of (left) rows.
+    Both matrices are normalized once, and sparse matrices are not transformed to dense ones,
+    only the yielded blocks are dense.
+
+    Parameters
+    ----------
+    leftmx : scipy.sparse.spmatrix or numpy.ndarray
+    rightmx : scipy.sparse.spmatrix or numpy.ndarray
+    blocksize : int
+        Number of (left) rows of the blocks computed at once.
+
+    Yields
+    ------
+    (start, block) : tuple
+        The first (left) row of the block and a dense array of shape (<= blocksize, number of right rows).
+        Nothing is yielded if `leftmx` has no rows.
+    """
+    normmxs = []
+    for mx in (leftmx, rightmx):
+        mx = mx.tocsr().astype(np.float64) if sp.issparse(mx) else np.asarray(mx, dtype=np.float64)
+        # `preprocessing.normalize` does not accept a matrix without rows
+        normmxs.append(preprocessing.normalize(mx, norm='l2') if mx.shape[0] > 0 else mx)
+    normmx, normT = normmxs[0], normmxs[1].transpose()
+    if sp.issparse(normT):
+        normT = normT.tocsr()
+
+    for start in range(0, normmx.shape[0], blocksize):
+        block = normmx[start:start + blocksize]
+        if sp.issparse(block) or not sp.issparse(normT):
+            block = block.dot(normT)
+        else:  # a dense block cannot be multiplied by a sparse matrix
+            block = normT.transpose().dot(block.transpose()).transpose()
+        yield start, block.toarray() if sp.issparse(block) else np.asarray(block)
 
 
 def compute_cos(measMTX, axis=0):
@@ -396,34 +628,38 @@ def compute_cos(measMTX, axis=0):
 
 
 @timeit
-def compute_cosine(measMTX, axis=0):
-    """
+def compute_cosine(measMTX, axis=0, blocksize=BLOCKSIZE, dtype=np.float64, filename=None, topk=None):
+    """Compute cosine similarity matrix, by blocks of rows (see `calc_pairwise()`).
 
     Parameters
     ----------
     measMTX : :class:`~qlvl.TypeTokenMatrix`
+    axis : int
+        0 (row) or 1 (column)
+    blocksize : int
+        Number of rows of the blocks of the similarity matrix computed at once.
+    dtype : numpy.dtype
+        Data type of the similarity matrix, i.e. `numpy.float32` to halve its size.
+    filename : str, optional
+        If provided, the similarity matrix is a memory-mapped '.npy' file.
+    topk : int, optional
+        If provided, only the `topk` largest similarities of each row are kept in a sparse matrix.
 
     """
     if axis == 0:
         measmx = measMTX.matrix
-        items = measMTX.row_items
+        items = measMTX.row_index
     elif axis == 1:
         measmx = measMTX.matrix.transpose()
-        items = measMTX.col_items
+        items = measMTX.col_index
     else:
         raise ValueError("Axis should be 0 or 1!")
-    if isinstance(measmx, sp.spmatrix):
-        measmx = measmx.toarray()
 
-    # sklearn.metrics.pairwise.cosine_similarity returns a symmetric numpy.ndarray
-    cosmx = cosine_similarity(measmx)
-    # convert diagonal values into real ones
-    # TODO: check if there are other ways to correct this error?
-    for i in range(cosmx.shape[0]):
-        cosmx[i, i] = 1.0
+    cosmx = calc_pairwise(measmx, metric='cosine', similarity=True, blocksize=blocksize,
+                          dtype=dtype, filename=filename, topk=topk)
 
     args = (cosmx, items, items)
-    kwargs = {'category': 'similarity', 'metric': 'cos'}
+    kwargs = {'category': 'similarity', 'metric': 'cos', 'deep': False}
     return measMTX.__class__(*args, **kwargs)
 
 
@@ -454,12 +690,12 @@ def compute_simrank(simMTX, reverse=False):
     simrank_mtx[rJ, rInd] = I.ravel()
 
     metric = simMTX.metric if 'metric' in simMTX.__dict__ else 'cos'
-    args = (simrank_mtx, simMTX.row_items, simMTX.col_items)
+    args = (simrank_mtx, simMTX.row_index, simMTX.col_index)
     kwargs = {'category': 'rank', 'metric': metric}
     return simMTX.__class__(*args, **kwargs)
 
 
-def compute_token_weights(tcPositionMTX, twMTX, booleanize = True, tokenFormat='lemma/pos'):
+def compute_token_weights(tcPositionMTX, twMTX, booleanize = True, tokenFormat='lemma/pos', chunksize=CHUNKSIZE):
     """Compute token-by-context weight matrix.
     Build token weights from a token-by-context matrix and
     a type-by-context weight matrix.
@@ -488,7 +724,9 @@ def compute_token_weights(tcPositionMTX, twMTX, booleanize = True, tokenFormat='
     
     tokenFormat : str
         whether settings['token'] has both lemma and part-of-speech information (default) or just lemma information
-    
+    chunksize : int
+        Max number of nonzero values (of `tcPositionMTX`) computed at once.
+
     Returns
     -------
     token weight matrix : :class:`~qlvl.TypeTokenMatrix`
@@ -497,39 +735,56 @@ def compute_token_weights(tcPositionMTX, twMTX, booleanize = True, tokenFormat='
     -----
     This function will transform all explicit zeros in type-by-context weight matrix to implicit zeros.
     So, if those explicit zeros a important, be careful of them.
+    The weights are only looked up for the nonzero values of `tcPositionMTX`,
+    so neither matrix is densified and the memory scales with their numbers of nonzero values.
     """
     # check the column items of tcPositionMTX and twMTX are in the same order
     col_items1, col_items2 = tcPositionMTX.col_items, twMTX.col_items
     if col_items1 != col_items2:
         raise ValueError("Columns of the two matrices are not in the same order ")
 
-    missing_types = []
-    tokens = tcPositionMTX.row_items
-    types = set(twMTX.row_items)  # set of target types
-    tcmx_type = np.bool if booleanize else tcPositionMTX.matrix.dtype
-    bool_tcmx = tcPositionMTX.matrix.astype(tcmx_type, copy=True).toarray()
-    twmx = twMTX.matrix.toarray()  # transform to dense matrix (numpy.ndarray)
-    resmx = np.zeros(bool_tcmx.shape)
-    for i, tok in enumerate(tokens):
-        # normally the last two parts of token string are filename and line number
-        # while the first one or two parts of token string are 'lemma' or 'lemma/pos'
-        # so split token string by '/' from right twice -> 'lemma' or 'lemma/pos', 'fname', 'lid'
-        # type_ = '/'.join(tok.rsplit('/', 2)[:-2])
-        # change 2023.04.11: flexible softcoding of token id (given corpora with different structure)
-        type_ = '/'.join(tok.split('/')[:2]) if tokenFormat == 'lemma/pos' else tok.split('/')[0]
-        if type_ not in types:
-            missing_types.append(type_)
-            continue
-        idx = twMTX.row_items.index(type_)
-        resmx[i] = bool_tcmx[i] * twmx[idx]  # use boolean masks to select weights of corresponding indices
+    # map every token (row) to the row index of its type in twMTX, -1 if the type is missing
+    # normally the last two parts of token string are filename and line number
+    # while the first one or two parts of token string are 'lemma' or 'lemma/pos'
+    # change 2023.04.11: flexible softcoding of token id (given corpora with different structure)
+    type2id = twMTX.item2rowid  # target type -> row index
+    if tokenFormat == 'lemma/pos':
+        token_types = ['/'.join(tok.split('/')[:2]) for tok in tcPositionMTX.row_items]
+    else:
+        token_types = [tok.split('/')[0] for tok in tcPositionMTX.row_items]
+    type_ids = np.fromiter((type2id.get(t, -1) for t in token_types), dtype=np.int64, count=len(token_types))
+    missing_types = [t for t, i in zip(token_types, type_ids) if i < 0]
+
+    tcmx = sp.csr_matrix(tcPositionMTX.matrix)
+    tcmx.sort_indices()
+    twmx = sp.csr_matrix(twMTX.matrix)
+    twmx.sum_duplicates()  # -> sorted indices
+    # every nonzero value of twmx has the sorted key: row * ncols + col
+    ncols = twmx.shape[1]
+    twrows = np.repeat(np.arange(twmx.shape[0], dtype=np.int64), np.diff(twmx.indptr))
+    twkeys = twrows * ncols + twmx.indices
+
+    tcdata = tcmx.data.astype(bool) if booleanize else tcmx.data
+    weights = np.zeros(tcmx.nnz, dtype=np.float64)
+    for start, end, rowids in iter_nnz_chunks(tcmx, chunksize=chunksize):
+        trows = type_ids[rowids]
+        found = trows >= 0
+        keys = trows * ncols + tcmx.indices[start:end]
+        pos = np.searchsorted(twkeys, keys)
+        pos[pos >= len(twkeys)] = 0
+        found &= (twkeys[pos] == keys) if len(twkeys) > 0 else False
+        # use boolean masks to select weights of corresponding indices
+        weights[start:end][found] = tcdata[start:end][found] * twmx.data[pos[found]]
 
     if len(missing_types) > 0:
         logger.warning("Missing types in type-weight matrix:\n{}...".format(str(missing_types[:7])))
-    tok_weight_mtx = sp.csr_matrix(resmx)
-    return tcPositionMTX.__class__(tok_weight_mtx, tcPositionMTX.row_items, tcPositionMTX.col_items)
+    tok_weight_mtx = sp.csr_matrix((weights, tcmx.indices.copy(), tcmx.indptr.copy()), shape=tcmx.shape)
+    tok_weight_mtx.eliminate_zeros()
+    return tcPositionMTX.__class__(tok_weight_mtx, tcPositionMTX.row_index, tcPositionMTX.col_index, deep=False)
 
 
-def compute_token_vectors(tcWeightMTX, soccMTX, operation='addition', normalization='l1'): # by Stefano
+def compute_token_vectors(tcWeightMTX, soccMTX, operation='addition', normalization='l1',
+                          blocksize=BLOCKSIZE, workers=1): # by Stefano
     """Compute token vectors.
     Build token vectors from a token weights (token-by-context weight matrix) and
     a second order matrix.
@@ -544,6 +799,10 @@ def compute_token_vectors(tcWeightMTX, soccMTX, operation='addition', normalizat
         'addition', 'multiplication','weightedmean'
     normalization: str
         'l1', 'l2', 'no'
+    blocksize : int
+        Number of token rows computed at once.
+    workers : int
+        Number of threads computing the blocks of rows.
 
     Returns
     -------
@@ -552,6 +811,7 @@ def compute_token_vectors(tcWeightMTX, soccMTX, operation='addition', normalizat
     Note
     -----
     Values for "normalization" are regulated by sklearn.preprocessing.normalize()
+    The product is computed in sparse blocks of rows, so the token vectors are never densified.
     """
     # check pre-requisites
     # 1. Matrix type
@@ -567,55 +827,129 @@ def compute_token_vectors(tcWeightMTX, soccMTX, operation='addition', normalizat
     if isequalset:
         if isequallist:
             # they are exactly the same item list
-            right_mtx = soccMTX.get_matrix()
+            right_mtx = soccMTX.matrix
         else:
             # they have the same intermediate item set
             # but the item lists may have different order
             rightMTX = soccMTX.reorder(tcWeightMTX.col_items)
-            right_mtx = rightMTX.get_matrix()
+            right_mtx = rightMTX.matrix
             # NOTE: we could reorder soccMTX here, because the reorder() method returns a new Matrix
     else:
         raise ValueError("Provided second order collocate matrix inconsistent with token-context weight matrix!")
 
-    left_mtx = tcWeightMTX.get_matrix()
+    # the matrices are only read, so they are not copied
+    left_mtx = sp.csr_matrix(tcWeightMTX.matrix)
+    right_mtx = sp.csr_matrix(right_mtx)
 
     if operation == 'addition':
         logger.info("  Operation: addition 'token-feature weight matrix' X 'socc matrix'...")
-        product_mtx = dot_addition(left_mtx, right_mtx)
+        kernel = dot_addition
     elif operation == 'weightedmean': # addition by Stefano (2021.02.09)
         logger.info("  Operation: weighted mean 'token-feature weight matrix' X 'socc matrix'...")
-        left_mtx_weightsum = left_mtx.sum(axis=1)
-        weightedMTX = left_mtx.dot(right_mtx)/left_mtx_weightsum
-        product_mtx = np.nan_to_num(weightedMTX)
+        kernel = dot_weightedmean
     elif operation == 'multiplication':
         logger.info("  Operation: multiplication...")
-        product_mtx = dot_multiplication(left_mtx, right_mtx)
+        kernel = dot_multiplication
     else:
         raise ValueError("Operation must be 'addition', 'multiplication' or 'weightedmean'.")
+    product_mtx = dot_blocks(left_mtx, right_mtx, kernel, blocksize=blocksize, workers=workers)
 
-    product_mtx = sp.csr_matrix(product_mtx)
     if normalization != 'no': # addition by Stefano 2021.02.09, adapted by Mariana 2021.08.20
         product_mtx = preprocessing.normalize(product_mtx, norm=normalization)
-    return tcWeightMTX.__class__(product_mtx, tcWeightMTX.row_items, soccMTX.col_items)
+    return tcWeightMTX.__class__(product_mtx, tcWeightMTX.row_index, soccMTX.col_index, deep=False)
+
+
+def dot_blocks(mtx_l, mtx_r, kernel, blocksize=BLOCKSIZE, workers=1):
+    """Apply a (sparse) dot kernel to blocks of rows of the left matrix and stack the results.
+
+    Parameters
+    ----------
+    mtx_l : scipy.sparse.csr_matrix
+    mtx_r : scipy.sparse.csr_matrix
+    kernel : function
+        `kernel(block_l, mtx_r)` returns the sparse product of a block of rows.
+    blocksize : int
+        Number of rows of a block.
+    workers : int
+        If larger than 1, the blocks are computed by a pool of threads
+        (the sparse products and numpy sorting release the GIL).
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+    """
+    m = mtx_l.shape[0]
+    blocksize = blocksize if blocksize else max(m, 1)
+
+    def compute(start):
+        return kernel(mtx_l[start:start + blocksize], mtx_r)
+
+    starts = range(0, m, blocksize)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            blocks = list(executor.map(compute, starts))
+    else:
+        blocks = [compute(start) for start in starts]
+    if len(blocks) == 0:
+        return sp.csr_matrix((m, mtx_r.shape[1]), dtype=np.float64)
+    return sp.vstack(blocks, format='csr')
 
 
 def dot_addition(mtx_l, mtx_r):
-    """Dot addition of two matrices"""
+    """Dot addition of two matrices (sparse product)"""
     # check mtx type
     assert isinstance(mtx_l, sp.csr_matrix)
     assert isinstance(mtx_r, sp.csr_matrix)
-    return mtx_l.dot(mtx_r).toarray()
+    return mtx_l.dot(mtx_r).astype(np.float64).tocsr()
+
+
+def dot_weightedmean(mtx_l, mtx_r):
+    """Dot addition of two matrices, divided by the row sums (weights) of the left matrix.
+    The rows of zero weight sum are empty.
+    """
+    product = dot_addition(mtx_l, mtx_r)
+    weightsum = np.asarray(mtx_l.sum(axis=1), dtype=np.float64).ravel()
+    with np.errstate(divide='ignore'):
+        inv = np.where(weightsum != 0, 1.0 / weightsum, 0.0)
+    product = sp.diags(inv).dot(product).tocsr()
+    product.eliminate_zeros()
+    return product
 
 
 def dot_multiplication(mtx_l, mtx_r):
-    """Dot multiplication of two matrices"""
-    m = mtx_l.shape[0]
-    n = mtx_r.shape[1]
-    product_mtx = np.ones((m, n), dtype=np.float64)
-    for i in range(m):
-        for k in range(n):
-            for j in range(mtx_l.shape[1]):
-                if mtx_l[i, j] == 0.0 or mtx_r[j, k]:
-                    continue
-                product_mtx[i, k] *= mtx_l[i, j] * mtx_r[j, k]
-    return product_mtx
+    """Dot multiplication of two matrices:
+    `product[i, k]` is the product of `mtx_l[i, j] * mtx_r[j, k]` over all `j` where both values are nonzero
+    (and zero if there is no such `j`).
+    The terms are expanded and multiplied per (i, k) pair, so the memory scales with
+    the number of terms (the flops of the sparse product) of the rows of `mtx_l`.
+    """
+    mtx_l, mtx_r = sp.csr_matrix(mtx_l), sp.csr_matrix(mtx_r)
+    m, n = mtx_l.shape[0], mtx_r.shape[1]
+    # nonzero values of the left matrix: (i, j, l_ij)
+    lrows = np.repeat(np.arange(m, dtype=np.int64), np.diff(mtx_l.indptr))
+    lcols, lvals = mtx_l.indices, mtx_l.data
+    nonzero = lvals != 0
+    lrows, lcols, lvals = lrows[nonzero], lcols[nonzero], lvals[nonzero]
+    # expand each (i, j) with the values of row j of the right matrix: (i, k, l_ij * r_jk)
+    lens = np.diff(mtx_r.indptr)[lcols]
+    total = int(lens.sum())
+    if total == 0:
+        return sp.csr_matrix((m, n), dtype=np.float64)
+    offsets = np.repeat(mtx_r.indptr[lcols] - (np.cumsum(lens) - lens), lens)
+    ridx = offsets + np.arange(total)
+    rvals = mtx_r.data[ridx].astype(np.float64)
+    terms = np.repeat(lvals.astype(np.float64), lens) * rvals
+    keys = np.repeat(lrows, lens) * n + mtx_r.indices[ridx]
+    nonzero = rvals != 0
+    terms, keys = terms[nonzero], keys[nonzero]
+    if len(keys) == 0:
+        return sp.csr_matrix((m, n), dtype=np.float64)
+    # multiply the terms of each (i, k) pair
+    order = np.argsort(keys, kind='stable')
+    keys, terms = keys[order], terms[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    values = np.multiply.reduceat(terms, starts)
+    keys = keys[starts]
+    product = sp.csr_matrix((values, (keys // n, keys % n)), shape=(m, n))
+    product.eliminate_zeros()
+    return product
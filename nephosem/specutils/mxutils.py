@@ -29,7 +29,9 @@ from nephosem.core import matrix
 
 __all__ = ['transform_dict_to_spmatrix', 'transform_spmatrix_to_dict',
            'transform_nodes_to_matrix', 'transform_indices',
-           'merge_two_matrices', 'merge_matrices']
+           'merge_two_matrices', 'merge_matrices',
+           'union_items', 'index_mapping', 'remap_spmatrix', 'sum_spmatrices',
+           'align_spmatrix', 'merge_spmatrices']
 
 logger = logging.getLogger(__name__)
 
@@ -134,6 +136,14 @@ def transform_spmatrix_to_dict(spmatrix, rowid2item, colid2item, verbose=False):
 
 def transform_nodes_to_matrix(type2toks, colloc_fmt = 'lemma/pos'):
     """Transform type nodes to token matrix.
+    The values are the positions of the collocates, negative for the left ones
+    and positive for the right ones. When a collocate appears more than once
+    in the window of a token, the right-most position is kept.
+
+    The matrix is built straight from the token stores of the type nodes:
+    column ids are assigned as the collocates are first seen, and the
+    (row, column, position) entries are collected in integer arrays
+    which are turned into one CSR matrix at the end.
 
     Parameters
     ----------
@@ -150,25 +160,85 @@ def transform_nodes_to_matrix(type2toks, colloc_fmt = 'lemma/pos'):
         if not isinstance(type2toks, list):
             raise ValueError("Please pass a dict or a list")
         type2toks = {str(tp): tp for tp in type2toks}
-    # transform type2toks dict into token_context boolean matrix
-    tok2collocs = {}
-    col_collocs = set()
+
+    row_items, item2rowid = [], dict()
+    col_items, item2colid = [], dict()
+    # entries are collected per token (numbered over all stores), `tok_rows` maps tokens to rows
+    tok_rows, toks, cols, positions = [], [], [], []
+    ntoks_seen = 0
     for tpstr, tpnode in type2toks.items():
-        for tok in tpnode.tokens:
-            cleft = {colloc.to_colloc(colloc_fmt=colloc_fmt): (i - len(tok.lcollocs))
-                     for i, colloc in enumerate(tok.lcollocs)}
-            cright = {colloc.to_colloc(colloc_fmt=colloc_fmt): i + 1
-                      for i, colloc in enumerate(tok.rcollocs)}
-            tok2collocs[str(tok)] = {**cleft, **cright}
-            col_collocs = col_collocs.union(set(tok2collocs[str(tok)].keys()))
-    row_items = list(tok2collocs.keys())
-    col_items = list(col_collocs)
-    tokmx = transform_dict_to_spmatrix(tok2collocs, row_items, col_items)
+        store = tpnode.store
+        ntoks = len(store)
+        if ntoks == 0:
+            continue
+        # row id of each token (a token string seen before gets its old row)
+        tokrows = np.empty(ntoks, dtype=np.int64)
+        for i in range(ntoks):
+            tok_str = store.token_str(i)
+            rowid = item2rowid.get(tok_str)
+            if rowid is None:
+                rowid = item2rowid[tok_str] = len(row_items)
+                row_items.append(tok_str)
+            tokrows[i] = rowid
+        tok_rows.append(tokrows)
+        tokoffset, ntoks_seen = ntoks_seen, ntoks_seen + ntoks
+
+        ids = np.frombuffer(store.colloc_ids, dtype=np.int32) if len(store.colloc_ids) else np.zeros(0, dtype=np.int32)
+        if len(ids) == 0:
+            continue
+        # column ids of the collocate items of this store, in order of first appearance
+        colloc_strs = store.item_strs(colloc_fmt)
+        uniq, first = np.unique(ids, return_index=True)
+        itemcols = np.full(len(store.items), -1, dtype=np.int64)
+        for j in uniq[np.argsort(first, kind='stable')]:
+            colloc = colloc_strs[j]
+            colid = item2colid.get(colloc)
+            if colid is None:
+                colid = item2colid[colloc] = len(col_items)
+                col_items.append(colloc)
+            itemcols[j] = colid
+
+        ptr = np.frombuffer(store.colloc_ptr, dtype=np.int64)
+        nleft = np.frombuffer(store.token_nleft, dtype=np.int32).astype(np.int64)
+        counts = np.diff(ptr)
+        offsets = np.arange(len(ids), dtype=np.int64) - np.repeat(ptr[:-1], counts)
+        nleft = np.repeat(nleft, counts)
+        pos = offsets - nleft
+        pos[pos >= 0] += 1
+        toks.append(np.repeat(np.arange(tokoffset, tokoffset + ntoks, dtype=np.int64), counts))
+        cols.append(itemcols[ids])
+        positions.append(pos)
+
+    if len(toks) == 0:
+        raise ValueError("Error: the input matrix is empty!!!")
+    tok_rows = np.concatenate(tok_rows)
+    toks = np.concatenate(toks)
+    cols = np.concatenate(cols)
+    positions = np.concatenate(positions)
+    # a repeated token string replaces the earlier token of the same row
+    lasttok = np.full(len(row_items), -1, dtype=np.int64)
+    np.maximum.at(lasttok, tok_rows, np.arange(len(tok_rows)))
+    keep = lasttok[tok_rows[toks]] == toks
+    rows, cols, positions = tok_rows[toks[keep]], cols[keep], positions[keep]
+
+    # sort by (row, col), keeping the entry order within ties, and keep the last entry of each pair
+    order = np.lexsort((cols, rows))
+    rows, cols, positions = rows[order], cols[order], positions[order]
+    last = np.ones(len(rows), dtype=bool)
+    last[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    rows, cols, positions = rows[last], cols[last], positions[last]
+
+    nrows, ncols = len(row_items), len(col_items)
+    indptr = np.zeros(nrows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=nrows), out=indptr[1:])
+    tokmx = sp.csr_matrix((positions, cols, indptr), shape=(nrows, ncols))
     return matrix.TypeTokenMatrix(tokmx, row_items, col_items)
 
 
 def merge_two_matrices(mtx1, mtx2):
     """Merge two (TypeTokenMatrix) matrices.
+    The row items and the column items of the merged matrix are the (sorted) unions
+    of the items of the two matrices. See `merge_spmatrices()`.
 
     Parameters
     ----------
@@ -183,41 +253,191 @@ def merge_two_matrices(mtx1, mtx2):
         raise ValueError("The given two matrices are not the same type!")
 
     # check whether these two matrices have same row items and column items
-    consistent = [True, True]
-    if mtx1.row_items != mtx2.row_items:
-        consistent[0] = False
-    if mtx1.col_items != mtx2.col_items:
-        consistent[1] = False
-
-    if consistent[0] and consistent[1]:
+    if mtx1.row_items == mtx2.row_items and mtx1.col_items == mtx2.col_items:
         # these matrices have same row items and column items
         # then just add the scipy sparse matrices
         spmtx = mtx1.matrix + mtx2.matrix
         return mtx1.__class__(spmtx, mtx1.row_items, mtx1.col_items)
-    else:
-        if not consistent[0]:  # row items inconsistent
-            # row_items = sorted(set(mtx1.row_items) + set(mtx2.row_items))
-            # rowmapping = {v:k for k, v in enumerate(row_items)}
-            raise NotImplementedError
-        if not consistent[1]:  # col items inconsistent
-            # union the two column item lists
-            col_items = sorted(set(mtx1.col_items).union(set(mtx2.col_items)))
-            # transform two sparse matrices
-            spmx1 = transform_indices(mtx1, col_items)
-            spmx2 = transform_indices(mtx2, col_items)
-            spmx = spmx1 + spmx2
-            return mtx1.__class__(spmx, mtx1.row_items, col_items)
+    spmx, row_items, col_items = merge_matrices([mtx1, mtx2])
+    return mtx1.__class__(spmx, row_items, col_items, deep=False)
 
 
 def transform_indices(mtx, new_col_items):
-    """"""
-    spmx = mtx.matrix
+    """Move the columns of a matrix to their indices in a new (larger) list of column items.
+
+    Parameters
+    ----------
+    mtx : :class:`~nephosem.TypeTokenMatrix`
+    new_col_items : list of str
+        Must contain all column items of `mtx`.
+
+    Returns
+    -------
+    :class:`~scipy.sparse.csr_matrix`
+    """
     glbitem2glbidx = {v: k for k, v in enumerate(new_col_items)}
-    subidx2glbidx = [glbitem2glbidx[it] for i, it in enumerate(mtx.col_items)]
-    # time cost bottleneck (the size of matrix.indices is large)
-    newindices = np.array([subidx2glbidx[i] for i in spmx.indices])
-    newspmx = sp.csr_matrix((spmx.data, newindices, spmx.indptr), shape=(spmx.shape[0], len(new_col_items)))
-    return newspmx
+    colmap = index_mapping(mtx.col_items, glbitem2glbidx)
+    shape = (mtx.shape[0], len(new_col_items))
+    return remap_spmatrix(mtx.matrix, shape, colmap=colmap).tocsr()
+
+
+def align_spmatrix(spmx, row_items, col_items, new_row_items=None, new_col_items=None):
+    """Align a matrix to new (larger) lists of row items and column items.
+    The rows and columns of the new items which are not in the matrix are empty.
+
+    Parameters
+    ----------
+    spmx : :class:`~scipy.sparse.spmatrix` or numpy.ndarray
+    row_items : list of str
+    col_items : list of str
+    new_row_items : list of str, optional
+        Must contain all `row_items`. If None, rows are not moved.
+    new_col_items : list of str, optional
+        Must contain all `col_items`. If None, columns are not moved.
+
+    Returns
+    -------
+    :class:`~scipy.sparse.csr_matrix`
+    """
+    rowmap = colmap = None
+    # the items could be lists or tuples (of a matrix)
+    if new_row_items is not None and tuple(new_row_items) != tuple(row_items):
+        rowmap = index_mapping(row_items, {e: i for i, e in enumerate(new_row_items)})
+    if new_col_items is not None and tuple(new_col_items) != tuple(col_items):
+        colmap = index_mapping(col_items, {e: i for i, e in enumerate(new_col_items)})
+    shape = (len(row_items if new_row_items is None else new_row_items),
+             len(col_items if new_col_items is None else new_col_items))
+    return remap_spmatrix(spmx, shape, rowmap=rowmap, colmap=colmap).tocsr()
+
+
+def merge_spmatrices(spmatrices, row_item_lists, col_item_lists, maxnnz=None):
+    """Merge (sum) matrices which may have different row items and column items.
+    The row (column) items of the merged matrix are the sorted union of the row (column) items
+    of all matrices. The indices of each matrix are remapped to the merged items by lookup tables,
+    and the values of all matrices are summed at once (see `sum_spmatrices()`).
+
+    Parameters
+    ----------
+    spmatrices : list of :class:`~scipy.sparse.spmatrix` (or numpy.ndarray)
+    row_item_lists : list of list of str
+        Row items of each matrix.
+    col_item_lists : list of list of str
+        Column items of each matrix.
+    maxnnz : int, optional
+        Max number of values waiting to be summed.
+
+    Returns
+    -------
+    tuple :
+        spmatrix (:class:`~scipy.sparse.csr_matrix`), row_items, col_items
+    """
+    row_items = union_items(row_item_lists)
+    col_items = union_items(col_item_lists)
+    shape = (len(row_items), len(col_items))
+    item2rowid = {e: i for i, e in enumerate(row_items)}
+    item2colid = {e: i for i, e in enumerate(col_items)}
+
+    # the items could be lists or tuples (of a matrix)
+    row_tuple, col_tuple = tuple(row_items), tuple(col_items)
+
+    def remapped():
+        for spmx, rows, cols in zip(spmatrices, row_item_lists, col_item_lists):
+            rowmap = None if tuple(rows) == row_tuple else index_mapping(rows, item2rowid)
+            colmap = None if tuple(cols) == col_tuple else index_mapping(cols, item2colid)
+            yield remap_spmatrix(spmx, shape, rowmap=rowmap, colmap=colmap)
+
+    spmx = sum_spmatrices(remapped(), shape, maxnnz=maxnnz)
+    return spmx, row_items, col_items
+
+
+def union_items(item_lists):
+    """Alphabetically sorted union of many item lists."""
+    items = set()
+    for item_list in item_lists:
+        items.update(item_list)
+    return sorted(items)
+
+
+def index_mapping(items, item2id):
+    """Array mapping the (local) indices of the items to their (global) indices in `item2id`.
+    This is the lookup table used by `remap_spmatrix()`.
+
+    Parameters
+    ----------
+    items : list of str
+    item2id : dict
+        Item -> global index mapping.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    return np.fromiter((item2id[e] for e in items), dtype=np.int64, count=len(items))
+
+
+def remap_spmatrix(spmx, shape, rowmap=None, colmap=None):
+    """Move the values of a sparse matrix to new row and column indices.
+    The indices are transformed at once by the lookup tables (see `index_mapping()`).
+
+    Parameters
+    ----------
+    spmx : :class:`~scipy.sparse.spmatrix`
+    shape : tuple
+        Shape of the new matrix.
+    rowmap : numpy.ndarray, optional
+        Old row index -> new row index. If None, rows are not moved.
+    colmap : numpy.ndarray, optional
+        Old column index -> new column index. If None, columns are not moved.
+
+    Returns
+    -------
+    :class:`~scipy.sparse.coo_matrix`
+    """
+    coomx = sp.coo_matrix(spmx)
+    row = coomx.row if rowmap is None else rowmap[coomx.row]
+    col = coomx.col if colmap is None else colmap[coomx.col]
+    return sp.coo_matrix((coomx.data, (row, col)), shape=shape)
+
+
+def sum_spmatrices(spmatrices, shape, maxnnz=None):
+    """Sum sparse matrices of the same shape.
+    The (row, col, value) triplets of the matrices are concatenated and the duplicates are summed at once.
+    When `maxnnz` is given, at most (about) this number of triplets are kept before they are summed
+    into the result, so `spmatrices` could be a generator which loads the matrices one by one.
+
+    Parameters
+    ----------
+    spmatrices : iterable of :class:`~scipy.sparse.spmatrix`
+    shape : tuple
+    maxnnz : int, optional
+        Max number of triplets waiting to be summed.
+
+    Returns
+    -------
+    :class:`~scipy.sparse.csr_matrix` or None if there is no matrix.
+    """
+    total = None
+    rows, cols, data = [], [], []
+    nnz = 0
+
+    def reduce_batch(total):
+        if len(data) == 0:
+            return total
+        batch = sp.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                              shape=shape).tocsr()  # duplicates are summed here
+        del rows[:], cols[:], data[:]
+        return batch if total is None else total + batch
+
+    for spmx in spmatrices:
+        coomx = sp.coo_matrix(spmx)
+        rows.append(coomx.row)
+        cols.append(coomx.col)
+        data.append(coomx.data)
+        nnz += coomx.nnz
+        if maxnnz and nnz >= maxnnz:
+            total = reduce_batch(total)
+            nnz = 0
+    return reduce_batch(total)
 
 
 def merge_matrices(matrices):
@@ -254,20 +474,10 @@ def merge_matrices(matrices):
         for i in range(1, len(matrices)):
             spmx += matrices[i].matrix
         return spmx, row_items, col_items
-    else:  # transform sub-matrices to Python dict of dict and merge
-        mxdict_list = []
-        row_items, col_items = set(), set()
-        for mx in matrices:
-            mxdict = transform_spmatrix_to_dict(mx.matrix, mx.row_items, mx.col_items)
-            mxdict_list.append(mxdict)
-            row_items = row_items | set(mx.row_items)  # construct union row items
-            col_items = col_items | set(mx.col_items)  # construct union column items
-
-        mxdict = merge_matrix_dict(mxdict_list)
-        row_items = sorted(row_items)  # transform dict to list
-        col_items = sorted(col_items)
-        spmx = transform_dict_to_spmatrix(mxdict, row_items, col_items)
-        return spmx, row_items, col_items
+    else:  # align the sub-matrices to the union of their row items and column items and sum them
+        return merge_spmatrices([mx.matrix for mx in matrices],
+                                [mx.row_items for mx in matrices],
+                                [mx.col_items for mx in matrices])
 
 
 def merge_matrix_dict(mxdict_list):
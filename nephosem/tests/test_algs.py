@@ -9,8 +9,12 @@ import numpy as np
 import pytest
 import random
 import scipy.cluster.hierarchy as sch
+import scipy.sparse as sp
+from scipy.spatial.distance import pdist, squareform
 
+from nephosem.core.matrix import TypeTokenMatrix
 from nephosem.models import cbc
+from nephosem.specutils import mxcalc
 
 curdir = os.path.dirname(os.path.realpath(__file__))
 
@@ -50,6 +54,20 @@ def X():
     yield X
 
 
+@pytest.fixture()
+def groups():
+    rng = np.random.RandomState(0)
+    # elements of 6 groups sharing context profiles
+    lam = rng.gamma(0.3, 1.0, (6, 300))[rng.randint(0, 6, 120)] * rng.gamma(2.0, 1.0, (120, 1))
+    freq = rng.poisson(lam).astype(float)
+    freq[freq.sum(1) == 0, 0] = 1
+    items = ['w{:03d}'.format(i) for i in range(120)]
+    freqmx = TypeTokenMatrix(sp.csr_matrix(freq), items, ['c{:03d}'.format(j) for j in range(300)])
+    measmx = mxcalc.compute_ppmi(freqmx)
+    distmx = mxcalc.compute_distance(measmx)
+    yield items, freqmx, measmx, distmx
+
+
 class TestAlgs(object):
     def test_flat_clusters(self, X):
         Z = sch.linkage(X, 'single')
@@ -70,6 +88,14 @@ class TestAlgs(object):
         clusters = Counter(clusters)
         assert minsize in clusters.values()
 
+    def test_cut_tree(self, X):
+        Z = sch.linkage(X, method='average')
+        for t in np.unique(Z[:, 2]).tolist() + [0.0, 100.0]:
+            expected = sch.fcluster(Z, t, criterion='distance')
+            clusts = cbc.cut_tree(Z, t)
+            # same partition, the cluster numbers may differ
+            assert len(set(zip(expected, clusts))) == len(set(expected)) == len(set(clusts))
+
     def test_score_cluster(self):
         pass
 
@@ -101,21 +127,151 @@ class TestAlgs(object):
             glbclust = cbc.sub2glb(cluster, subitems, glbitems)
             assert glbclust == glbidx
 
-    def test_cbc_step1(self):
-        pass
+    def test_cbc_step1(self, monkeypatch):
+        X = np.random.RandomState(0).rand(30, 5)
+        items = ['e{:02d}'.format(i) for i in range(30)]
+        distmx = TypeTokenMatrix(squareform(pdist(X, 'cosine')), items, items)
+        L = cbc.cbc_step1_single(items, distmx=distmx, k=10)
+        assert len(L) > 0
+        # the batched kernel gives the clusters of the per-element `linkage`/`fcluster` loop
+        distarr = distmx.matrix
+        refL = []
+        for rid in range(len(items)):
+            nbrs = [i for i in np.argsort(distarr[rid], kind='stable')[:11] if i != rid]
+            subdist = distarr[np.ix_(nbrs, nbrs)]
+            Z = sch.linkage(squareform(subdist, checks=False), method='average')
+            fcids = sch.fcluster(Z, np.median(Z[:, 2]), criterion='distance')
+            for cid in np.unique(fcids):
+                ids = np.flatnonzero(fcids == cid)
+                score = (1.0 - subdist[np.ix_(ids, ids)])[np.triu_indices(len(ids), 1)].mean() if len(ids) > 1 else -1
+                refL.append((round(score, 8), sorted(items[nbrs[i]] for i in ids)))
+        assert sorted((round(s, 8), sorted(c)) for s, c in L) == sorted(refL)
+        # the workers share the (memory-mapped) distance matrix and send back the same clusters
+        monkeypatch.setattr(cbc, 'cpu_count', lambda: 3)
+        multiL = cbc.cbc_step1_multicore(items, distmx=distmx, k=10)
+        assert sorted(multiL) == sorted(L)
+
+    def test_cbc_resume(self, groups, tmpdir, monkeypatch):
+        items, freqmx, measmx, distmx = groups
+        rundir = str(tmpdir.join('run'))
+        Cs, Rs = cbc.CBC(items, freqmx, measmx=measmx, distmx=distmx, k=20, theta2=0.5).cluster(
+            multicore=False, rundir=rundir)
+        assert len(Cs) > 1
+        assert cbc.load_recursions(rundir, items) == (Cs, Rs)
+
+        # crash in the last recursion, then resume with the matrices of the run directory
+        os.remove(os.path.join(rundir, cbc.RECURSION_FNAME.format(len(Cs))))
+        resumed = cbc.CBC.load(rundir)
+        assert resumed.params == cbc.CBC(items, freqmx, measmx=measmx, distmx=distmx, k=20, theta2=0.5).params
+        calls = []
+        major_steps = cbc.major_steps
+        monkeypatch.setattr(cbc, 'major_steps', lambda *args, **kwargs: calls.append(1) or major_steps(*args, **kwargs))
+        assert resumed.cluster(multicore=False, rundir=rundir) == (Cs, Rs)
+        assert len(calls) == 1
+
+        # the errors of the steps are raised, other parameters cannot be resumed
+        monkeypatch.setattr(cbc, 'major_steps', lambda *args, **kwargs: 1 / 0)
+        with pytest.raises(ZeroDivisionError):
+            resumed.cluster(multicore=False, rundir=rundir, resume=False)
+        assert cbc.load_recursions(rundir, items) == ([], [])
+        with pytest.raises(ValueError):
+            cbc.CBC(items, freqmx, measmx=measmx, distmx=distmx, k=10).cluster(multicore=False, rundir=rundir)
+
+    def test_cbc_rundir_matrices(self, groups, tmpdir):
+        items, freqmx, measmx, distmx = groups
+        # other matrices of the same elements
+        freqmx2 = TypeTokenMatrix(freqmx.matrix[::-1], items, freqmx.col_items)
+        measmx2 = mxcalc.compute_ppmi(freqmx2)
+        distmx2 = mxcalc.compute_distance(measmx2)
+        rundir = str(tmpdir.join('run'))
+        cbc.CBC(items, freqmx, measmx=measmx, distmx=distmx, k=20, theta2=0.5).cluster(multicore=False, rundir=rundir)
+        # a new run in the same directory replaces the matrices of the previous run
+        CR = cbc.CBC(items, freqmx2, measmx=measmx2, distmx=distmx2, k=20, theta2=0.5, workers=2).cluster(
+            multicore=True, rundir=rundir, resume=False)
+        expected = cbc.CBC(items, freqmx2, measmx=measmx2, distmx=distmx2, k=20, theta2=0.5).cluster(
+            multicore=False, rundir=str(tmpdir.join('fresh')))
+        assert CR == expected
+        loaded = cbc.CBC.load(rundir)
+        assert loaded.distmx.equal(distmx2) and loaded.freqmx.equal(freqmx2)
+        # a run with other matrices is not resumed
+        with pytest.raises(ValueError):
+            cbc.CBC(items, freqmx, measmx=measmx, distmx=distmx, k=20, theta2=0.5).cluster(
+                multicore=False, rundir=rundir)
+        assert loaded.cluster(multicore=False, rundir=rundir) == expected
+
+    def test_cbc_no_committee(self, groups, tmpdir):
+        items, freqmx, measmx, distmx = groups
+        kwargs = dict(measmx=measmx, distmx=distmx, k=5, theta1=0.9, theta2=0.9, t=0.3)
+        rundir = str(tmpdir.join('run'))
+        # the last recursion finds no committee, the run ends with its elements as residues
+        Cs, Rs = cbc.CBC(items, freqmx, **kwargs).cluster(multicore=False, rundir=rundir)
+        assert len(Cs) > 1 and Cs[-1] == [] and Rs[-1] == Rs[-2]
+        assert cbc.load_recursions(rundir, items) == (Cs, Rs)
+        # resume before the last recursion
+        os.remove(os.path.join(rundir, cbc.RECURSION_FNAME.format(len(Cs))))
+        assert cbc.CBC.load(rundir).cluster(multicore=False, rundir=rundir) == (Cs, Rs)
+        # nothing left to do after the last recursion
+        assert cbc.CBC(items, freqmx, **kwargs).cluster(multicore=False, rundir=rundir) == (Cs, Rs)
 
     def test_cbc_step2(self):
         L = [(0.5, [1, 2, 3]), (0.3, [0, 3, 5]), (0.1, [3, 4, 6]), (0.4, [2, 4, 5]), (0.2, [3, 5, 6])]
         sortedL = cbc.cbc_step2(L)
         assert [0.5, 0.4, 0.3, 0.2, 0.1] == [maxv for maxv, _ in sortedL]
 
+    def test_calc_committee_vectors(self):
+        rng = np.random.RandomState(0)
+        freqarr = rng.poisson(1.0, size=(8, 6)).astype(float)
+        comms = [[0, 1, 2], [3, 5], [0, 1, 2]]
+        commx = cbc.calc_committee_vectors(comms, freqmx=freqarr)
+        # sparse frequency matrix
+        assert np.allclose(cbc.calc_committee_vectors(comms, freqmx=sp.csr_matrix(freqarr)).toarray(), commx.toarray())
+        # committees of a subset of rows (residues) are the same as on the submatrix
+        rows = np.array([7, 2, 4, 0, 6])
+        commvecs = cbc.CommitteeVectors(sp.csr_matrix(freqarr), rows=rows)
+        subcommx = cbc.calc_committee_vectors([[0, 2], [1, 3, 4]], commvecs=commvecs)
+        assert np.allclose(subcommx.toarray(),
+                           cbc.calc_committee_vectors([[0, 2], [1, 3, 4]], freqmx=freqarr[rows]).toarray())
+
     def test_remove_duplicate(self):
         L = [(0.5, [1, 2, 3]), (0.4, [2, 4, 5]), (0.40000000004, [2, 5, 4]), (0.3, [0, 3, 5]), (0.2, [3, 5, 6]), (0.1, [3, 4, 6])]
         diffL = cbc.remove_duplicate(L)
         assert [v for v, c in diffL] == [0.5, 0.4, 0.3, 0.2, 0.1]
 
+    def test_get_merged_committee(self):
+        commx = np.array([[1.0, 0.0, 0.0], [0.9, 0.1, 0.0], [0.0, 1.0, 0.0], [0.8, 0.0, 0.2], [0.0, 0.0, 1.0]])
+        simmx = commx.dot(commx.T) / np.outer(np.linalg.norm(commx, axis=1), np.linalg.norm(commx, axis=1))
+        expected = [(0, 1), (2, -1), (3, -1), (4, -1)]
+        assert cbc.get_merged_committee(simmx, theta=0.5) == expected
+        # similarities computed by blocks of the (sparse) committee matrix
+        assert cbc.get_merged_committee(commx=sp.csr_matrix(commx), theta=0.5, blocksize=2) == expected
+
+    def test_get_merged_committee_pair(self):
+        # two similar committees are merged (the least similar committee of a row is also a candidate)
+        commx = sp.csr_matrix(np.array([[1.0, 0.0], [0.9, 0.1]]))
+        assert cbc.get_merged_committee(commx=commx, theta=0.5) == [(0, 1)]
+        assert cbc.get_merged_committee(commx=commx, theta=0.999) == [(0, -1), (1, -1)]
+
+    def test_no_committee(self):
+        # no committee matrix (rows)
+        assert cbc.get_merged_committee(commx=sp.csr_matrix((0, 3))) == []
+        maxidx, maxsim = cbc.most_similar(sp.csr_matrix((0, 3)), sp.csr_matrix(np.eye(3)))
+        assert len(maxidx) == len(maxsim) == 0
+        # only singletons in step 1, so no committee in step 2
+        freqarr = np.random.RandomState(0).poisson(1.0, size=(4, 3)).astype(float)
+        L = [(-1, [e]) for e in 'abcd']
+        comms, commx = cbc.cbc_step2(L, elements=list('abcd'), freqmx=sp.csr_matrix(freqarr),
+                                     ppmimx=sp.csr_matrix(freqarr))
+        assert comms == []
+        assert commx.shape == (0, 3)
+
     def test_cbc_step3(self):
-        pass
+        elements = ['a', 'b', 'c', 'd']
+        measmx = sp.csr_matrix(np.array([[1.0, 0.0], [0.0, 1.0], [1.0, 1.0], [1.0, 0.1]]))
+        commx = sp.csr_matrix(np.array([[1.0, 0.0], [0.0, 1.0]]))
+        R, comms = cbc.cbc_step3(elements, measmx=measmx, comms=[['a'], ['c']], commx=commx, theta=0.9, blocksize=3)
+        # 'c' is not similar enough to any committee, 'd' is added to the first one
+        assert R == ['c']
+        assert comms == [['a', 'd'], ['c', 'b']]
 
     def test_calc_meas_vec(self):
         pass
@@ -5,12 +5,16 @@ Test functions for dependency graph
 import os
 import pytest
 import pandas as pd
+from collections import deque
 from copy import deepcopy
 
 import nephosem
 from nephosem.conf import ConfigLoader
 from nephosem.core.terms import CorpusFormatter
 from nephosem.deprel.basic import SentenceGraph, TemplateGraph
+from nephosem.core import graph as core_graph
+from nephosem.models.deprel import DepRelCounter
+from nephosem.specutils.deputils import tree_match, subtree_match, target_anchors
 
 rootdir = nephosem.rootdir
 curdir = os.path.dirname(os.path.realpath(__file__))
@@ -118,3 +122,95 @@ class TestSentenceGraph(object):
     def test_init(self, orgsent, exsent):
         sent_g = SentenceGraph(sentence=orgsent.split('\n'))
         sent_g = SentenceGraph(nodes=exsent[0], edges=exsent[1])
+
+
+class TestPatternMatcher(object):
+    def test_tree_match(self, exsent):
+        v_labels, e_labels = exsent
+        nodes = {i: {'LEMMA': lb.split('/')[0], 'POS': lb.split('/')[1]} for i, lb in v_labels.items()}
+        edges = {e: {'DEPREL': rel} for e, rel in e_labels.items()}
+        sentence = core_graph.SentenceGraph(nodes=nodes, edges=edges)
+        pattern = core_graph.PatternGraph(nodes={1: {'POS': '(V)\\w*'}, 2: {'POS': '(N)\\w*'}, 3: {'POS': '(N)\\w*'}},
+                                          edges={(1, 2): {'DEPREL': '(dobj)'}, (1, 3): {'DEPREL': '(dobj)'}})
+        macro = core_graph.MacroGraph(pattern, target_idx=2, target_filter=None)
+        assert tree_match(sentence, macro)
+        matched = [{fn: attrs['LEMMA'] for fn, attrs in m.items()} for m in macro.matched_nodes]
+        assert matched == [{1: 'give', 2: 'girl', 3: 'apple'}, {1: 'give', 2: 'apple', 3: 'girl'}]
+        assert [m[(1, 2)]['DEPREL'] for m in macro.matched_edges] == ['dobj', 'dobj']
+
+        # same matches (and order) as the level-matching algorithm
+        expected = core_graph.MacroGraph(pattern, target_idx=2, target_filter=None)
+        subtree_match(sentence=sentence, macro=expected, lmatches=deque([[{1: 3}]]))
+        assert macro.matched_nodes == expected.matched_nodes
+        assert macro.matched_edges == expected.matched_edges
+
+        # anchored at the target node
+        anchored = core_graph.MacroGraph(pattern, target_idx=2, target_filter=None)
+        anchored.target_node_attrs = {'LEMMA': 1}
+        anchors = target_anchors(sentence, anchored, {'apple'})
+        assert anchors == [sentence.tree.pos[8]]
+        assert tree_match(sentence, anchored, anchors=anchors)
+        assert anchored.matched_nodes == macro.matched_nodes[1:]
+        assert not tree_match(sentence, anchored, anchors=target_anchors(sentence, anchored, {'boy'}))
+
+    def test_counter(self, exsent):
+        v_labels, e_labels = exsent
+        nodes = {i: {'LEMMA': lb.split('/')[0], 'POS': lb.split('/')[1]} for i, lb in v_labels.items()}
+        edges = {e: {'DEPREL': rel} for e, rel in e_labels.items()}
+        sentence = core_graph.SentenceGraph(nodes=nodes, edges=edges)
+        pattern = core_graph.PatternGraph(nodes={1: {'LEMMA': '(\\w+)', 'POS': '(V)\\w*'},
+                                                 2: {'LEMMA': '(\\w+)', 'POS': '(N)\\w*'}},
+                                          edges={(1, 2): {'DEPREL': '(\\w*obj)'}})
+        macro = core_graph.MacroGraph(pattern, target_idx=2, feature_idx=1, target_filter=None)
+        macro.target_node_attrs = {'LEMMA': 1}
+        macro.feature_node_attrs = {'LEMMA': 1}
+        assert tree_match(sentence, macro)
+
+        counter = DepRelCounter()
+        counter.update(macro)
+        counter.update(macro, start=1)
+        assert len(counter) == 2
+        spmx, targets, features = counter.to_shard()
+        counts = {(targets[i], features[j]): spmx[i, j] for i, j in zip(*spmx.nonzero())}
+        assert counts == {('girl', 'give'): 1, ('apple', 'give'): 2}
+        assert DepRelCounter().to_shard() is None
+
+    def test_sentence_graph(self, orgsent):
+        settings = ConfigLoader().settings
+        settings['line-machine'] = '([^\t]+)\t([^\t]+)\t([^\t]+)\t([^\t]+)\t([^\t]+)\t([^\t]+)'
+        settings['separator-line-machine'] = '</s>'
+        settings['global-columns'] = 'FORM,POS,LEMMA,ID,HEAD,DEPREL'
+        settings['node-attr'] = 'FORM,POS,LEMMA'
+        settings['edge-attr'] = 'DEPREL'
+        settings['currID'], settings['headID'] = 'ID', 'HEAD'
+        settings['type'] = settings['colloc'] = 'LEMMA/POS'
+        settings['token'] = 'LEMMA/POS/FID/LID'
+        formatter = CorpusFormatter(settings)
+        lines = [(lid, line.replace('for 9', 'for\t9')) for lid, line in enumerate(orgsent.split('\n'), 1) if line]
+        sentence = core_graph.SentenceGraph(sentence=lines, formatter=formatter)
+        assert sentence.istree
+        assert sentence.nodes[3] == {'FORM': 'gives', 'POS': 'V', 'LEMMA': 'give', 'lid': 3}
+        assert sentence.nodes[0] == {}  # the root
+        assert sentence.edges[(3, 5)]['DEPREL'] == 'dobj'
+        assert list(sentence.successors(3)) == [2, 5, 8]
+        assert list(sentence.predecessors(3)) == [0]
+        assert sentence.out_degree(3) == 3
+        assert sorted(sentence.graph.edges) == sorted(sentence.edges)
+
+        # added nodes and edges are seen by the matching
+        pattern = core_graph.PatternGraph(nodes={1: {'POS': '(V)\\w*'}, 2: {'POS': '(RB)'}},
+                                          edges={(1, 2): {'DEPREL': '(advmod)'}})
+        macro = core_graph.MacroGraph(pattern, target_idx=2, target_filter=None)
+        assert not tree_match(sentence, macro)
+        sentence.add_node(11, FORM='today', POS='RB', LEMMA='today', lid=11)
+        sentence.add_edge(11, 3, 11, DEPREL='advmod')
+        assert sentence.istree
+        assert list(sentence.successors(3)) == [2, 5, 8, 11]
+        assert sentence.edges[(3, 11)] == {'id': 11, 'DEPREL': 'advmod'}
+        assert (3, 11) in sentence.graph.edges
+        assert tree_match(sentence, macro)
+        assert [m[2]['LEMMA'] for m in macro.matched_nodes] == ['today']
+
+        # 'gives' depends on 'boy', which depends on 'gives'
+        lines[2] = (3, 'gives\tV\tgive\t3\t2\tROOT')
+        assert not core_graph.SentenceGraph(sentence=lines, formatter=formatter).istree
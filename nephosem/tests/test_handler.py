@@ -0,0 +1,38 @@
+"""
+Test Handler Classes
+"""
+
+import multiprocessing as mp
+
+import numpy as np
+import pytest
+
+from nephosem.core.handler import Paralleler, SharedResultQueue
+
+
+def _put_results(res_queue, results):
+    for res in results:
+        res_queue.put(res)
+
+
+class TestParalleler(object):
+    def test_shared_result_queue(self, tmpdir):
+        results = [-1, 'sub.0', None, {'a/NN': 3, 'b/VB': 1}, [np.arange(5), 'x']]
+        res_queue = SharedResultQueue(tmpdir=str(tmpdir))
+        worker = mp.Process(target=_put_results, args=(res_queue, results))
+        worker.start()
+        res_queue.collect([worker])
+        worker.join()
+
+        assert res_queue.qsize() == len(results)
+        assert res_queue.get() == -1
+        assert res_queue.get() == 'sub.0'
+        assert res_queue.get() is None
+        assert res_queue.get() == {'a/NN': 3, 'b/VB': 1}
+        arr, s = res_queue.get()
+        assert np.array_equal(arr, np.arange(5)) and s == 'x'
+        assert res_queue.empty()
+
+    def test_unknown_transport(self):
+        with pytest.raises(ValueError):
+            Paralleler(transport='pipe')
@@ -156,14 +156,14 @@ class TestTypeTokenMatrix(object):
         new_col_items = ['col2', 'col0', 'col3', 'col1']
 
         reospMTX = spMTX.reorder(new_row_items)
-        assert reospMTX.row_items == new_row_items
+        assert reospMTX.row_items == tuple(new_row_items)
         reospMTX = spMTX.reorder(new_col_items, axis=1)
-        assert reospMTX.col_items == new_col_items
+        assert reospMTX.col_items == tuple(new_col_items)
 
         reonmMTX = nmMTX.reorder(new_row_items)
-        assert reonmMTX.row_items == new_row_items
+        assert reonmMTX.row_items == tuple(new_row_items)
         reonmMTX = nmMTX.reorder(new_col_items, axis=1)
-        assert reonmMTX.col_items == new_col_items
+        assert reonmMTX.col_items == tuple(new_col_items)
 
     def test_operators(self, spMTX, nmMTX, sqMTX):
         # test sparse
@@ -232,9 +232,66 @@ class TestTypeTokenMatrix(object):
         assert concspMTX.col_items == spMTX.col_items
         assert concspMTX.matrix != sp.hstack([spMTX.matrix, spMTX2.matrix])
 
+        # different column items are aligned to their union
+        spMTX2 = TypeTokenMatrix(sp.csr_matrix(np.array([[1, 2], [3, 0]])), ['row3', 'row4'], ['col1', 'col9'])
+        concspMTX = spMTX.concatenate(spMTX2, axis=0)
+        assert concspMTX.col_items == spMTX.col_items + ('col9',)
+        assert concspMTX.matrix[3:].toarray().tolist() == [[0, 1, 0, 0, 2], [0, 3, 0, 0, 0]]
+        assert (concspMTX.matrix[:3, :4] != spMTX.matrix).nnz == 0
+
         spMTX2 = spMTX.copy()
         spMTX2.col_items = ['col4', 'col5', 'col6', 'col7']
         concspMTX = spMTX.concatenate(spMTX2, axis=1)
         assert concspMTX.row_items == spMTX.row_items
         assert concspMTX.col_items == (spMTX.col_items + spMTX2.col_items)
-        assert concspMTX.matrix != sp.vstack([spMTX.matrix, spMTX2.matrix])
\ No newline at end of file
+        assert concspMTX.matrix != sp.vstack([spMTX.matrix, spMTX2.matrix])
+
+    def test_save_load(self, spMTX, nmMTX, tmp_path):
+        spMTX.row_items = ('röw0',) + spMTX.row_items[1:]  # non-ascii item
+        for mtx, name in [(spMTX, 'sp'), (nmMTX, 'nm')]:
+            # old packed format
+            fname = str(tmp_path / '{}.pac'.format(name))
+            mtx.save(fname, verbose=False)
+            loaded = TypeTokenMatrix.load(fname)
+            assert loaded.row_items == mtx.row_items and loaded.equal(mtx)
+            # memory-mappable container
+            basename = str(tmp_path / name)
+            mtx.save(basename, mmap=True, verbose=False)
+            for mmap in [False, True]:
+                loaded = TypeTokenMatrix.load(basename, mmap=mmap)
+                assert loaded.row_items == mtx.row_items and loaded.col_items == mtx.col_items
+                assert loaded.equal(mtx)
+            data = loaded.matrix.data if sp.issparse(loaded.matrix) else loaded.matrix
+            assert not data.flags.writeable  # read-only memory map
+
+    def test_load_container_square(self, nmMTX, sqMTX, tmp_path, monkeypatch):
+        for mtx, name in [(sqMTX, 'sq'), (nmMTX, 'nm')]:
+            mtx.save_container(str(tmp_path / name), verbose=False)
+        # the symmetry of a loaded dense matrix is not checked on the whole matrix again
+        from nephosem.core import matrix
+        monkeypatch.setattr(matrix, 'check_symmetric', lambda arr: pytest.fail("symmetry checked"))
+        for mtx, name in [(sqMTX, 'sq'), (nmMTX, 'nm')]:
+            loaded = TypeTokenMatrix.load_container(str(tmp_path / '{}.mmx'.format(name)), mmap=True)
+            assert type(loaded._mxbehavior) is type(mtx._mxbehavior)
+
+    def test_item_index(self, spMTX, nmMTX, sqMTX):
+        # derived matrices with the same items share the (immutable) items and their mapping
+        assert isinstance(spMTX.row_items, tuple) and isinstance(spMTX.col_items, tuple)
+        assert (spMTX > 0).row_index is spMTX.row_index
+        assert spMTX.transpose().row_index is spMTX.col_index
+        assert spMTX.submatrix(row=['row2', 'row0']).col_index is spMTX.col_index
+        assert spMTX.reorder(['col3', 'col2', 'col1', 'col0'], axis=1).row_index is spMTX.row_index
+        assert spMTX.item2rowid == {'row0': 0, 'row1': 1, 'row2': 2}
+        # the items of a derived matrix cannot be changed in place (which would corrupt the shared mapping)
+        derived = spMTX > 0
+        with pytest.raises(TypeError):
+            derived.row_items[0] = 'changed'
+        derived.row_items = ('changed',) + derived.row_items[1:]
+        assert derived.item2rowid == {'changed': 0, 'row1': 1, 'row2': 2}
+        assert spMTX.item2rowid == {'row0': 0, 'row1': 1, 'row2': 2}
+        assert spMTX.submatrix(row=['row0']).row_items == ('row0',)
+        # a new item list gets a new index
+        spMTX2 = spMTX.copy()
+        spMTX2.row_items = ['row3', 'row4', 'row5']
+        assert spMTX2.item2rowid['row4'] == 1 and 'row0' not in spMTX2.item2rowid
+        assert '_rowindex' not in spMTX.meta_data
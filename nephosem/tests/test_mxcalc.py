@@ -10,6 +10,7 @@ import pandas as pd
 import pytest
 import scipy.sparse as sp
 from scipy.spatial.distance import squareform
+from sklearn.metrics import pairwise_distances
 
 from nephosem import Vocab, TypeTokenMatrix
 from nephosem.specutils import mxcalc
@@ -159,3 +160,109 @@ class TestCalcFuncs(object):
         for c, p in zip(cases, pmis):
             pmi = mxcalc.calc_pmi(c[0], c[1], c[2], c[3])
             assert abs(pmi - p) < 0.00000001
+
+    def test_calc_association_vec(self, spMTX, nfreq, cfreq):
+        # the array computation should give the same values as the scalar functions
+        func_dict = {
+            'pmi': mxcalc.calc_pmi, 'ppmi': mxcalc.calc_ppmi, 'lik': mxcalc.calc_lik,
+            'chisq': mxcalc.calc_chisq, 'zscore': mxcalc.calc_zscore, 'dice': mxcalc.calc_dice,
+            'deltap': mxcalc.calc_deltap, 'deltapColl': mxcalc.calc_deltap_coll,
+            'logratio': mxcalc.calc_log_ratio,
+        }
+        N = max(nfreq.sum(), cfreq.sum())
+        nfarr = np.array([nfreq[e] for e in spMTX.row_items])
+        cfarr = np.array([cfreq[e] for e in spMTX.col_items])
+        coomx = spMTX.matrix.tocoo()
+        for meas, func in func_dict.items():
+            for chunksize in [None, 5]:
+                measmx = mxcalc.calc_association(spMTX.matrix, nfreq=nfarr, cfreq=cfarr, N=N,
+                                                 meas=meas, chunksize=chunksize)
+                for i, j, o11 in zip(coomx.row, coomx.col, coomx.data):
+                    o12 = nfarr[i] - o11
+                    o21 = cfarr[j] - o11
+                    o22 = N - o11 - o12 - o21
+                    expected = func(o11, o21, o12, o22)
+                    assert abs(measmx[i, j] - expected) < 0.00001 * max(1.0, abs(expected))
+
+    def test_compute_distance(self, spMTX, tmpdir):
+        arr = spMTX.matrix.toarray()
+        for metric in ['cosine', 'euclidean', 'manhattan']:
+            distMTX = mxcalc.compute_distance(spMTX, metric=metric, blocksize=2)
+            assert np.allclose(distMTX.matrix, pairwise_distances(arr, metric=metric))
+        distMTX = mxcalc.compute_distance(spMTX, axis=1, blocksize=5, dtype=np.float32,
+                                          filename=str(tmpdir.join('dist.npy')))
+        assert distMTX.matrix.dtype == np.float32
+        assert np.allclose(distMTX.matrix, pairwise_distances(arr.T, metric='cosine'), atol=1e-6)
+        # a sparse topk matrix is only computed for similarities (a pair which is not kept reads as 0.0)
+        with pytest.raises(TypeError):
+            mxcalc.compute_distance(spMTX, topk=2)
+        with pytest.raises(ValueError):
+            mxcalc.calc_pairwise(spMTX.matrix, similarity=False, topk=2)
+
+    def test_compute_cosine(self, spMTX):
+        arr = spMTX.matrix.toarray()
+        expected = 1.0 - pairwise_distances(arr, metric='cosine')
+        cosMTX = mxcalc.compute_cosine(spMTX, blocksize=2)
+        assert np.allclose(cosMTX.matrix, expected)
+        # only keep the 2 most similar items of each row (including itself)
+        topMTX = mxcalc.compute_cosine(spMTX, topk=2)
+        assert topMTX.matrix.nnz == 2 * spMTX.shape[0]
+        for i in range(spMTX.shape[0]):
+            assert np.allclose(np.sort(topMTX.matrix[i].data), np.sort(expected[i])[-2:])
+        assert np.allclose(topMTX.matrix.diagonal(), 1.0)
+
+    def test_iter_cosine_blocks(self, spMTX):
+        arr = spMTX.matrix.toarray()
+        expected = 1.0 - pairwise_distances(arr, arr[:2], metric='cosine')
+        for left, right in [(spMTX.matrix, spMTX.matrix[:2]), (arr, arr[:2]), (arr, spMTX.matrix[:2])]:
+            blocks = list(mxcalc.iter_cosine_blocks(left, right, blocksize=2))
+            assert [start for start, _ in blocks] == list(range(0, arr.shape[0], 2))
+            assert np.allclose(np.vstack([block for _, block in blocks]), expected)
+
+    def test_compute_token_weights(self, spMTX):
+        rng = np.random.RandomState(0)
+        tokens = ['{}/fname/{}'.format(t, i) for i, t in enumerate(['dog', 'cat', 'dog', 'tea', 'coffee', 'cat'])]
+        tcarr = rng.randint(0, 3, size=(len(tokens), spMTX.shape[1]))
+        tcPositionMTX = TypeTokenMatrix(sp.csr_matrix(tcarr), tokens, spMTX.col_items)
+        twmx = spMTX.matrix.astype(np.float64)
+        twmx.data *= np.arange(1, twmx.nnz + 1)  # distinct weights
+        twMTX = TypeTokenMatrix(twmx, spMTX.row_items, spMTX.col_items)
+        twarr = twmx.toarray()
+        type2row = {'dog': 0, 'cat': 1, 'coffee': 2}
+        for booleanize in [True, False]:
+            expected = np.zeros(tcarr.shape)
+            for i, tok in enumerate(tokens):
+                type_ = tok.split('/')[0]
+                if type_ in type2row:  # 'tea' is a missing type
+                    expected[i] = (tcarr[i].astype(bool) if booleanize else tcarr[i]) * twarr[type2row[type_]]
+            tokMTX = mxcalc.compute_token_weights(tcPositionMTX, twMTX, booleanize=booleanize,
+                                                  tokenFormat='lemma', chunksize=5)
+            assert tokMTX.row_items == tuple(tokens)
+            assert np.allclose(tokMTX.matrix.toarray(), expected)
+            assert tokMTX.matrix.nnz == np.count_nonzero(expected)
+
+    def test_compute_token_vectors(self, spMTX):
+        rng = np.random.RandomState(0)
+        tcarr = rng.rand(7, 3) * (rng.rand(7, 3) > 0.4)
+        socarr = (rng.rand(3, 12) - 0.3) * (rng.rand(3, 12) > 0.5)
+        tokens = ['tok{}'.format(i) for i in range(7)]
+        tcWeightMTX = TypeTokenMatrix(sp.csr_matrix(tcarr), tokens, spMTX.row_items)
+        soccMTX = TypeTokenMatrix(sp.csr_matrix(socarr), spMTX.row_items, spMTX.col_items)
+        # brute force products
+        added = tcarr.dot(socarr)
+        weightsum = tcarr.sum(axis=1, keepdims=True)
+        means = np.divide(added, weightsum, out=np.zeros_like(added), where=weightsum != 0)
+        multiplied = np.zeros(added.shape)
+        for i in range(7):
+            for k in range(12):
+                terms = [tcarr[i, j] * socarr[j, k] for j in range(3) if tcarr[i, j] != 0 and socarr[j, k] != 0]
+                multiplied[i, k] = np.prod(terms) if terms else 0.0
+        for operation, expected in [('addition', added), ('weightedmean', means), ('multiplication', multiplied)]:
+            for workers in [1, 2]:
+                tokvecs = mxcalc.compute_token_vectors(tcWeightMTX, soccMTX, operation=operation,
+                                                       normalization='no', blocksize=3, workers=workers)
+                assert sp.issparse(tokvecs.matrix)
+                assert np.allclose(tokvecs.matrix.toarray(), expected)
+        tokvecs = mxcalc.compute_token_vectors(tcWeightMTX, soccMTX, normalization='l1', blocksize=2)
+        norms = np.abs(added).sum(axis=1, keepdims=True)
+        assert np.allclose(tokvecs.matrix.toarray(), np.divide(added, norms, out=np.zeros_like(added), where=norms != 0))
@@ -7,6 +7,7 @@ import os
 import pytest
 
 from nephosem import TypeTokenMatrix
+from nephosem.core.terms import TokenStore, TypeNode
 from nephosem.specutils import mxutils
 
 curdir = os.path.dirname(os.path.realpath(__file__))
@@ -47,3 +48,39 @@ class TestMxUtils(object):
         resmx, resrow, rescol = mxutils.merge_matrices(matrices)
         print(TypeTokenMatrix(resmx, resrow, rescol))
         assert False
+
+    def test_sum_spmatrices(self, matrices):
+        row_items = mxutils.union_items(mx.row_items for mx in matrices)
+        col_items = mxutils.union_items(mx.col_items for mx in matrices)
+        assert row_items == ['a', 'b', 'c', 'f'] and col_items == ['b', 'c', 'd', 'e']
+        item2rowid = {e: i for i, e in enumerate(row_items)}
+        item2colid = {e: i for i, e in enumerate(col_items)}
+        shape = (len(row_items), len(col_items))
+        spmxs = [mxutils.remap_spmatrix(mx.matrix, shape,
+                                        rowmap=mxutils.index_mapping(mx.row_items, item2rowid),
+                                        colmap=mxutils.index_mapping(mx.col_items, item2colid))
+                 for mx in matrices]
+        expected = [[1, 2, 0, 0], [0, 4, 0, 4], [0, 0, 7, 3], [0, 4, 1, 0]]
+        for maxnnz in [None, 1, 5]:
+            resmx = mxutils.sum_spmatrices(iter(spmxs), shape, maxnnz=maxnnz)
+            assert resmx.toarray().tolist() == expected
+
+    def test_merge_two_matrices(self, matrices):
+        mx1, mx2 = matrices
+        resmx = mxutils.merge_two_matrices(mx1, mx2)
+        assert resmx.row_items == ('a', 'b', 'c', 'f')
+        assert resmx.col_items == ('b', 'c', 'd', 'e')
+        assert resmx.matrix.toarray().tolist() == [[1, 2, 0, 0], [0, 4, 0, 4], [0, 0, 7, 3], [0, 4, 1, 0]]
+        assert resmx.equal(mx1.merge(mx2))
+
+    def test_transform_nodes_to_matrix(self):
+        store = TokenStore(token_fmt='word/pos/fid/lid', colloc_fmt='lemma/pos')
+        the, girl, boy = ('the', 'the', 'AT0'), ('girl', 'girl', 'NN1'), ('boys', 'boy', 'NN2')
+        store.append(('is', 'be', 'VVB'), 'f', 3, [the, girl], [the])
+        store.append(('was', 'be', 'VVD'), 'f', 7, [boy], [])
+        tpnode = TypeNode(type_str='be', type_fmt='lemma', tokens=store)
+        resmx = mxutils.transform_nodes_to_matrix([tpnode])
+        assert resmx.row_items == ('is/VVB/f/3', 'was/VVD/f/7')
+        assert resmx.col_items == ('the/AT0', 'girl/NN1', 'boy/NN2')
+        # the right-most position of a repeated collocate is kept
+        assert resmx.matrix.toarray().tolist() == [[1, -1, 0], [0, 0, -1]]
@@ -0,0 +1,68 @@
+"""
+Test NeighborIndex Class
+"""
+
+import pytest
+import numpy as np
+import scipy.sparse as sp
+
+from nephosem import TypeTokenMatrix, NeighborIndex
+
+
+@pytest.fixture()
+def ppmiMTX():
+    rng = np.random.RandomState(42)
+    arr = rng.rand(30, 20)
+    arr[arr < 0.7] = 0.0
+    row_items = ['row{}'.format(i) for i in range(30)]
+    col_items = ['col{}'.format(i) for i in range(20)]
+    yield TypeTokenMatrix(sp.csr_matrix(arr), row_items, col_items)
+
+
+def brute_force(mtx, item, k):
+    arr = mtx.matrix.toarray()
+    norms = np.linalg.norm(arr, axis=1)
+    norms[norms == 0] = 1.0
+    arr = arr / norms[:, None]
+    sims = arr.dot(arr.T)
+    rid = mtx.row_items.index(item)
+    sims[rid, rid] = -np.inf
+    return [mtx.row_items[i] for i in np.argsort(-sims[rid], kind='stable')[:k]], np.sort(sims[rid])[::-1][:k]
+
+
+class TestNeighborIndex(object):
+    def test_query(self, ppmiMTX):
+        index = NeighborIndex(ppmiMTX, blocksize=7)
+        for item in ['row0', 'row13', 'row29']:
+            _, expected = brute_force(ppmiMTX, item, 5)
+            res = index.query(item, k=5, return_similarity=True)
+            assert item not in [e for e, _ in res]
+            assert np.allclose([s for _, s in res], expected)
+
+    def test_query_batch(self, ppmiMTX):
+        index = NeighborIndex(ppmiMTX, blocksize=4)
+        items = ['row{}'.format(i) for i in range(0, 30, 3)]
+        res = index.query_batch(items, k=6, return_similarity=True)
+        for item, neighbors in zip(items, res):
+            assert neighbors == index.query(item, k=6, return_similarity=True)
+
+    def test_table(self, ppmiMTX):
+        index = NeighborIndex(ppmiMTX, blocksize=8)
+        scored = index.query_batch(ppmiMTX.row_items, k=4, return_similarity=True)
+        index.build_table(10)
+        looked_up = index.query_batch(ppmiMTX.row_items, k=4, return_similarity=True)
+        for a, b in zip(scored, looked_up):
+            assert np.allclose([s for _, s in a], [s for _, s in b], atol=1e-6)
+
+    def test_most_similar(self, ppmiMTX):
+        expected, _ = brute_force(ppmiMTX, 'row5', 3)
+        assert ppmiMTX.most_similar('row5', k=3, metric='cosine') == expected
+        # a sparse similarity matrix (of the `topk` similarities) is sorted by its values
+        simMTX = TypeTokenMatrix(sp.csr_matrix(ppmiMTX.neighbor_index().scores(np.arange(30))),
+                                 ppmiMTX.row_items, ppmiMTX.row_items)
+        assert simMTX.most_similar('row5', k=3, descending=True) == expected
+        distMTX = TypeTokenMatrix(sp.csr_matrix(np.array([[0.0, 0.7, 0.2], [0.7, 0.0, 0.4], [0.2, 0.4, 0.0]]) + 1.0),
+                                  ['a', 'b', 'c'], ['a', 'b', 'c'])
+        assert distMTX.most_similar('a', k=2) == ['c', 'b']
+        assert 'row5' not in ppmiMTX.neighbor_index(topk=5).query('row5', k=5)
+        assert '_nnindex' not in ppmiMTX.meta_data
@@ -9,7 +9,7 @@ from copy import deepcopy
 
 import nephosem
 from nephosem.conf import ConfigLoader
-from nephosem.core.terms import CorpusFormatter, ItemNode, TypeNode, TokenNode
+from nephosem.core.terms import CorpusFormatter, ItemNode, TypeNode, TokenNode, TokenStore
 
 rootdir = nephosem.rootdir
 curdir = os.path.dirname(os.path.realpath(__file__))
@@ -151,6 +151,35 @@ class TestTokenNode(object):
         assert tpnode.token == 'is/VVB/unknown/-1'
 
 
+class TestTokenStore(object):
+    def test_store(self):
+        store = TokenStore(token_fmt='word/pos/fid/lid', colloc_fmt='lemma/pos')
+        store.append(('is', 'be', 'VVB'), 'fname', 3,
+                     [('the', 'the', 'AT0'), ('girl', 'girl', 'NN1')], [('happy', 'happy', 'AJ0')])
+        store.append(('was', 'be', 'VVD'), 'fname2', 7, [], [('the', 'the', 'AT0')])
+        assert len(store) == 2
+        assert len(store.items) == 5  # items are interned
+        assert store.token_str(0) == 'is/VVB/fname/3'
+
+        tok = store[1]  # TokenNode view
+        assert isinstance(tok, TokenNode)
+        assert tok.token == 'was/VVD/fname2/7'
+        assert tok.lspan == 0 and [c.to_colloc() for c in tok.rcollocs] == ['the/AT0']
+        assert [c.to_colloc() for c in store[0].lcollocs] == ['the/AT0', 'girl/NN1']
+        assert list(store.iter_collocs())[0] == ('is/VVB/fname/3', ['the/AT0', 'girl/NN1', 'happy/AJ0'], 2)
+
+        # round trip through TokenNode objects
+        tpnode = TypeNode(type_str='be', type_fmt='lemma', tokens=list(store))
+        assert tpnode.freq == 2
+        assert [str(t) for t in tpnode.tokens] == ['is/VVB/fname/3', 'was/VVD/fname2/7']
+        assert sorted(c.to_colloc() for c in tpnode.collocs) == ['girl/NN1', 'happy/AJ0', 'the/AT0']
+
+        merged = TypeNode.merge([tpnode, TypeNode(type_str='be', type_fmt='lemma', tokens=store.select([1]))])
+        assert merged.freq == 3
+        assert [str(t) for t in merged.tokens] == ['is/VVB/fname/3', 'was/VVD/fname2/7', 'was/VVD/fname2/7']
+        assert tpnode.sample(n=1, method='first').tokens[0].token == 'is/VVB/fname/3'
+
+
 class TestWindow(object):
     def test_init(self):
         pass
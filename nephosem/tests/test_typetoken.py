@@ -5,10 +5,15 @@ import os
 import time
 import datetime
 import pytest
+from collections import defaultdict
+from queue import Queue
 
 import nephosem
 from nephosem.conf import ConfigLoader
+from nephosem import Vocab, TypeTokenMatrix
 from nephosem.tests.utils import datapath
+from nephosem.utils import read_fnames_of_corpus
+from nephosem.core.handler import FileShard, read_lines
 from nephosem.models.typetoken import ItemFreqHandler, ColFreqHandler
 from nephosem.models.typetoken import TypeToken
 
@@ -89,3 +94,142 @@ class TestTypeToken(object):
         print(colfreq1)
         print(colfreq2)
         # assert False
+
+    def test_col_freq_engines(self, settings):
+        # the 'array' engine should produce the same matrix as the 'dict' engine
+        settings['separator-line-machine'] = '</s>'
+        settings['single-boundary-machine'] = '</s>'
+        settings['left-span'] = 2
+        settings['right-span'] = 3
+        fnames = read_fnames_of_corpus(settings['corpus-path'])
+        row_vocab = Vocab(freq_dict)
+        for col_vocab in [None, row_vocab[row_vocab.freq > 1]]:
+            cfhan = ColFreqHandler(settings, row_vocab=row_vocab, col_vocab=col_vocab)
+            mtx_dict = defaultdict(lambda: defaultdict(int))
+            cfhan.chunk_col_vocab = Vocab()
+            for fname in fnames:
+                cfhan._do_process_job(fname, mtx_dict=mtx_dict)
+            col_items = (cfhan.chunk_col_vocab if cfhan.nocolvocab else cfhan.col_vocab).get_item_list()
+            colfreq1 = cfhan.dict2matrix(mtx_dict, row_vocab.get_item_list(), col_items)
+
+            cfhan = ColFreqHandler(settings, row_vocab=row_vocab, col_vocab=col_vocab, engine='array')
+            counter = cfhan.make_counter()
+            for fname in fnames:
+                cfhan._do_process_job(fname, counter=counter)
+            colfreq2 = counter.to_matrix()
+            assert colfreq1.equal(colfreq2)
+            assert colfreq1.matrix.dtype == colfreq2.matrix.dtype
+
+    def test_col_freq_chunks(self, settings):
+        # spilling the matrix of a worker into many tmp files should not change the result
+        settings['separator-line-machine'] = '</s>'
+        settings['single-boundary-machine'] = '</s>'
+        fnames = read_fnames_of_corpus(settings['corpus-path'])
+        row_vocab = Vocab(freq_dict)
+
+        def run_worker(cfhan):
+            job_queue, res_queue = Queue(), Queue()
+            for fname in fnames:
+                job_queue.put(fname)
+            job_queue.put(None)
+            cfhan._worker_loop(job_queue, res_queue)
+            return res_queue
+
+        for engine in ColFreqHandler.engines:
+            for col_vocab in [None, row_vocab[row_vocab.freq > 1]]:
+                cfhan = ColFreqHandler(settings, row_vocab=row_vocab, col_vocab=col_vocab,
+                                       engine=engine, chunksize=None)
+                res_queue = run_worker(cfhan)
+                assert res_queue.qsize() == 1
+                colfreq1 = cfhan._process_results(res_queue)
+
+                cfhan = ColFreqHandler(settings, row_vocab=row_vocab, col_vocab=col_vocab,
+                                       engine=engine, chunksize=50)
+                res_queue = run_worker(cfhan)
+                assert res_queue.qsize() > 1
+                colfreq2 = cfhan._process_results(res_queue)
+                assert colfreq1.equal(colfreq2)
+
+    def test_shard_file(self, settings):
+        settings['separator-line-machine'] = '</s>'
+        settings['single-boundary-machine'] = '</s>'
+        fname = datapath('StanfDepSents.conll')
+        row_vocab = Vocab(freq_dict)
+        cfhan = ColFreqHandler(settings, row_vocab=row_vocab, shardsize=200)
+        jobs = cfhan.make_jobs([fname])
+        assert len(jobs) > 1 and all(isinstance(job, FileShard) for job in jobs)
+        # the shards cover all lines (with the same line numbers) and start after a separator line
+        lines = list(read_lines(fname))
+        assert [lid_line for job in jobs for lid_line in read_lines(job)] == lines
+        for job in jobs[1:]:
+            assert lines[job.lid - 1][1].strip() == '</s>'
+
+        # processing the shards gives the same result as processing the whole file
+        for engine in ColFreqHandler.engines:
+            cfhan = ColFreqHandler(settings, row_vocab=row_vocab, engine=engine)
+            colfreqs = []
+            for fnames in [[fname], jobs]:
+                if engine == 'array':
+                    counter = cfhan.make_counter()
+                    for job in fnames:
+                        cfhan._do_process_job(job, counter=counter)
+                    colfreqs.append(counter.to_matrix())
+                else:
+                    mtx_dict = cfhan.new_mtx_dict()
+                    cfhan.chunk_col_vocab = Vocab()
+                    for job in fnames:
+                        cfhan._do_process_job(job, mtx_dict=mtx_dict)
+                    col_items = cfhan.chunk_col_vocab.get_item_list()
+                    colfreqs.append(cfhan.dict2matrix(mtx_dict, row_vocab.get_item_list(), col_items))
+            assert colfreqs[0].equal(colfreqs[1])
+
+    def test_shard_line_boundaries(self, settings, tmpdir):
+        # a file and its shards are split into the same lines, whatever other line boundaries they contain
+        settings['separator-line-machine'] = '</s>'
+        settings['single-boundary-machine'] = '</s>'
+        fname = str(tmpdir.join('boundaries.conll'))
+        words = ['a\rb', 'c\x0bd', 'e\x1cf', 'g\x85h', 'i\u2028j', 'k\x1el']
+        with open(fname, 'w', encoding='utf-8', newline='') as fout:
+            for i in range(20):
+                fout.write('<s>\n{}\tNN\n</s>\n'.format(words[i % len(words)]))
+        lines = list(read_lines(fname))
+        assert len(lines) == 60
+        cfhan = ColFreqHandler(settings, row_vocab=Vocab(freq_dict), shardsize=50)
+        jobs = cfhan.make_jobs([fname])
+        assert len(jobs) > 1
+        assert [lid_line for job in jobs for lid_line in read_lines(job)] == lines
+
+    def test_shard_by_budget(self, settings):
+        settings['separator-line-machine'] = '</s>'
+        settings['single-boundary-machine'] = '</s>'
+        fname = datapath('StanfDepSents.conll')
+        row_vocab = Vocab(freq_dict)
+        # without a memory budget, the files are not split
+        cfhan = ColFreqHandler(settings, row_vocab=row_vocab)
+        assert cfhan.make_jobs([fname]) == [fname]
+        # a given shardsize is kept
+        cfhan = ColFreqHandler(settings, row_vocab=row_vocab, chunkbytes=100 * 200, shardsize=10 ** 9)
+        assert cfhan.make_jobs([fname]) == [fname]
+
+        for engine in ColFreqHandler.engines:
+            cfhan = ColFreqHandler(settings, row_vocab=row_vocab, engine=engine,
+                                   chunkbytes=ColFreqHandler.nnzbytes[engine] * 200)
+            jobs = cfhan.make_jobs([fname])
+            assert len(jobs) > 1 and all(isinstance(job, FileShard) for job in jobs)
+            # every tmp matrix of the worker stays within about twice the budget
+            job_queue, res_queue = Queue(), Queue()
+            for job in jobs:
+                job_queue.put(job)
+            job_queue.put(None)
+            cfhan._worker_loop(job_queue, res_queue)
+            assert res_queue.qsize() > 1
+            for tmp_fname in list(res_queue.queue):
+                assert TypeTokenMatrix.load(tmp_fname, pack=False).matrix.nnz <= 2 * cfhan.chunk_limit
+            colfreq = cfhan._process_results(res_queue)
+
+            cfhan = ColFreqHandler(settings, row_vocab=row_vocab, engine=engine, chunksize=None)
+            job_queue, res_queue = Queue(), Queue()
+            job_queue.put(fname)
+            job_queue.put(None)
+            cfhan._worker_loop(job_queue, res_queue)
+            assert colfreq.equal(cfhan._process_results(res_queue))
@@ -188,3 +188,59 @@ class TestVocab(object):
                 fout.write('{}\t{}\n'.format(k, v))
         new_vocab = Vocab.load(filename, fmt='plain')
         assert new_vocab.equal(vocab)
+
+    def test_setitem(self, vocab):
+        vocab = vocab.copy()
+        vocab['bcd/NN2'] = 5  # existing item
+        vocab['new/NN0'] = 7  # new item
+        assert vocab['bcd/NN2'] == 5 and vocab['new/NN0'] == 7
+        assert vocab.get_dict()['new/NN0'] == 7
+        assert len(vocab) == 7 and vocab.sum() == 27
+        vocab.increment('new/NN0', inc=-3)  # subtract
+        assert vocab['new/NN0'] == 4
+        vocab.update({'new/NN0': -4, 'Abc/NP0': 1})
+        assert vocab['new/NN0'] == 0 and vocab['Abc/NP0'] == 4
+
+    def test_freq_dict(self, vocab):
+        # a new dict from get_dict() does not change the vocab
+        d = vocab.get_dict()
+        d['Abc/NP0'] = 10
+        assert vocab['Abc/NP0'] == 3
+        # the frequency dict is a live view of the vocab
+        freq_dict = vocab.freq_dict
+        assert list(freq_dict.items()) == list(vocab.items())
+        assert freq_dict['Abc/NP0'] == 3 and 'Abc/NP0' in freq_dict and 'xyz/NN0' not in freq_dict
+        assert freq_dict == vocab.get_dict()
+        assert vocab.get_item_list(sorting='freq', descending=True)[0] != 'Abc/NP0'
+        freq_dict['Abc/NP0'] = 100
+        freq_dict['new/NN0'] = 1
+        assert vocab['Abc/NP0'] == 100 and vocab['new/NN0'] == 1 and len(freq_dict) == len(vocab)
+        assert vocab.get_item_list(sorting='freq', descending=True)[0] == 'Abc/NP0'  # the sorted views are updated
+        del freq_dict['new/NN0']
+        assert 'new/NN0' not in vocab
+        with pytest.raises(KeyError):
+            freq_dict['new/NN0']
+        # setting a new dict replaces the items
+        vocab.freq_dict = {'a/NN0': 2, 'b/NN0': 1}
+        assert vocab.get_item_list(sorting='freq', descending=True) == ['a/NN0', 'b/NN0'] and vocab.FILTERPRESENT
+        vocab.freq_dict = {}
+        assert len(vocab) == 0 and not vocab.FILTERPRESENT
+
+    def test_equal_values(self, vocab):
+        other = Vocab(dict(reversed(list(vocab.get_dict().items()))))  # other order
+        assert vocab.equal(other) and other.equal(vocab)
+        other['Abc/NP0'] = 4
+        assert not vocab.equal(other)
+        other = vocab.copy()
+        other['new/NN0'] = 0
+        assert not vocab.equal(other) and not other.equal(vocab)
+
+    def test_save_load(self, vocab, tmp_path):
+        vocab = vocab.copy()
+        vocab['röw/NN0'] = 2  # non-ascii item
+        for fmt in ['json', 'plain']:
+            filename = str(tmp_path / 'test.{}.vocab'.format(fmt))
+            vocab.save(filename, fmt=fmt, verbose=False)
+            loaded = Vocab.load(filename, fmt=fmt)
+            assert loaded.equal(vocab)
+            assert loaded.get_dict() == vocab.get_dict()